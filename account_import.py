@@ -0,0 +1,70 @@
+# account_import.py — アカウント在庫ファイル（CSV / TSV / email:password）の読み取り
+import csv
+from typing import Optional
+
+DELIMITERS = ("\t", ",", ":")
+
+
+def _valid_email(email: str) -> bool:
+    local, at, domain = email.partition("@")
+    return bool(at and local and domain) and "@" not in domain and not any(c.isspace() or c in ",:" for c in email)
+
+
+def detect_delimiter(line: str) -> Optional[str]:
+    """見出し行 または 1件目の行から、ファイル全体の区切り文字を決める。決められなければ None"""
+    line = line.strip()
+    at = line.find("@")
+    if at >= 0:
+        # メールアドレスのドメインには区切り文字が入らないので、@ の後で最初に現れたものが区切り文字
+        found = [(line.find(d, at), d) for d in DELIMITERS if line.find(d, at) >= 0]
+        return min(found)[1] if found else None
+    for d in DELIMITERS:
+        if d in line:
+            return d
+    return None
+
+
+def parse_account_line(line: str, delimiter: str) -> Optional[dict]:
+    """1行を delimiter で読む。メールアドレスとパスワードの2項目に一意に分けられなければ None
+
+    email:password 形式はアドレスの後の最初の「:」で分けるので、パスワードに「:」「,」やタブを含んでもよい。
+    CSV / TSV は項目がちょうど2つの行だけを受け付ける（引用符なしの「,」やタブを含むパスワードは区切れないため）。
+    """
+    line = line.strip()
+    if delimiter == ":":
+        sep = line.find(":", line.find("@"))
+        if "@" not in line or sep < 0:
+            return None
+        fields = [line[:sep], line[sep + 1:]]
+    elif delimiter == ",":
+        fields = next(csv.reader([line]), [])
+    elif delimiter == "\t":
+        fields = line.split("\t")
+    else:
+        return None
+    if len(fields) != 2:
+        return None
+    email, password = fields[0].strip(), fields[1].strip()
+    if not _valid_email(email) or not password:
+        return None
+    return {"email": email, "password": password}
+
+
+def parse_account_lines(lines):
+    """ファイルの各行を読み、(行番号, アカウント) を順に返す。読めない行はアカウントが None
+
+    区切り文字は最初の行（見出し または 1件目）で一度だけ決め、以降の行もその形式で読む。
+    空行と見出し行（@ を含まない最初の行）は返さない。
+    """
+    delimiter = None
+    first = True
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        if delimiter is None:
+            delimiter = detect_delimiter(line)
+        if first:
+            first = False
+            if "@" not in line:
+                continue
+        yield line_no, parse_account_line(line, delimiter)
@@ -0,0 +1,321 @@
+# bench.py — 購入処理の負荷試験（PayPay と Discord を偽物に置き換えてオフラインで実行する）
+#
+#   python bench.py --guilds 20 --buyers 50 --latency 0.05 --failure-rate 0.02
+#
+# PayModal.on_submit / give_item_automatically / update_panel を多数のギルドで同時に動かし、
+# 1秒あたりの購入数・レイテンシ（p50 / p99）・イベントループの遅延・売り越しや二重配送を報告する。
+import argparse
+import asyncio
+import csv
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# ------------------------
+# PayPay の偽物
+# ------------------------
+class FakePayPay:
+    """link_check / link_receive だけを持つ PayPay クライアント。呼び出しはスレッドプールで実行される"""
+
+    def __init__(self, latency: float, failure_rate: float):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.links = {}       # link_id -> 金額
+        self.received = {}    # link_id -> 受け取り回数
+        self._lock = threading.Lock()
+
+    def issue_link(self, amount: int) -> str:
+        link_id = f"bench{random.getrandbits(64):016x}"
+        with self._lock:
+            self.links[link_id] = amount
+        return f"https://pay.paypay.ne.jp/{link_id}"
+
+    def _wait(self):
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.failure_rate:
+            raise RuntimeError("bench: 疑似的な PayPay エラー")
+
+    def link_check(self, link: str):
+        self._wait()
+        link_id = link.rstrip("/").split("/")[-1]
+        with self._lock:
+            amount = self.links.get(link_id, 0)
+            status = "COMPLETED" if self.received.get(link_id) else "PENDING"
+        return {"payload": {
+            "sender": {"displayName": "bench", "externalId": link_id},
+            "pendingP2PInfo": {"amount": amount},
+            "message": {"data": {"status": status}},
+        }}
+
+    def link_receive(self, link: str, password=None):
+        self._wait()
+        link_id = link.rstrip("/").split("/")[-1]
+        with self._lock:
+            self.received[link_id] = self.received.get(link_id, 0) + 1
+
+
+# ------------------------
+# Discord の偽物
+# ------------------------
+class FakeAsset:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.mention = f"<@{user_id}>"
+        self.display_avatar = FakeAsset()
+        self.deliveries = []  # 受け取った配送1件ごとのアカウント（email）のリスト
+
+    async def send(self, content=None, *, embed=None, embeds=None, file=None, files=None, **kwargs):
+        emails = []
+        for e in ([embed] if embed else []) + list(embeds or []):
+            emails += [f.value for f in e.fields if "メールアドレス" in f.name]
+        for f in ([file] if file else []) + list(files or []):
+            text = f.fp.read().decode("utf-8-sig", errors="replace")
+            emails += [row[0] for row in csv.reader(io.StringIO(text)) if row and "@" in row[0]]
+        # 大口注文の続き（embed なしの添付のみ）は直前の配送の一部として数える
+        if embed is None and not embeds and self.deliveries:
+            self.deliveries[-1].extend(emails)
+        else:
+            self.deliveries.append(emails)
+
+
+class FakeMessage:
+    def __init__(self, message_id=0):
+        self.id = message_id
+        self.edits = 0
+
+    async def edit(self, **kwargs):
+        self.edits += 1
+        return self
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.sent = 0
+        self.messages = {}
+
+    def get_partial_message(self, message_id: int):
+        return self.messages.setdefault(message_id, FakeMessage(message_id))
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage()
+
+
+class FakeResponse:
+    async def defer(self, **kwargs):
+        pass
+
+    async def send_message(self, *args, **kwargs):
+        pass
+
+
+class FakeFollowup:
+    async def send(self, *args, **kwargs):
+        return FakeMessage()
+
+
+class FakeInteraction:
+    def __init__(self, guild_id: int, user: FakeUser):
+        self.guild_id = guild_id
+        self.user = user
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+# ------------------------
+# ベンチマーク本体
+# ------------------------
+async def watch_loop_lag(samples: list, stop: asyncio.Event, interval=0.01):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+async def run(args):
+    import bot
+
+    loop_lag = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(watch_loop_lag(loop_lag, stop))
+
+    channels, users, guilds = {}, {}, []
+    def get_channel(channel_id):
+        return channels.get(channel_id)
+    async def fetch_user(user_id):
+        return users[user_id]
+    bot.bot.get_channel = get_channel
+    bot.bot.fetch_user = fetch_user
+    bot.bot.get_guild = lambda guild_id: None
+    async def wait_until_ready():
+        pass
+    bot.bot.wait_until_ready = wait_until_ready
+    bot.order_workers.start()
+
+    # ギルド毎に PayPay・チャンネル・パネル・在庫を用意する
+    for g in range(args.guilds):
+        guild_id = 10_000 + g
+        channel_id = guild_id * 10
+        channels[channel_id] = FakeChannel(channel_id)
+        paypay = FakePayPay(args.latency, args.failure_rate)
+        config = {"paypay_access_token": "bench", "log_channel": channel_id, "pay_channel": channel_id}
+        bot.save_json(bot.get_data_path(guild_id, "config.json"), config)
+        bot.paypay_pool.put(guild_id, paypay, config)
+
+        panel_id = str(guild_id * 100)
+        bot.save_json(bot.get_data_path(guild_id, "panels.json"), {panel_id: {"channel": channel_id, "title": "bench"}})
+        stock_item = bot.item_store.allocate_item_id(guild_id, panel_id)
+        bot.item_store.put_item(guild_id, stock_item, {"panel_id": panel_id, "name": "在庫型", "price": 100, "stock": args.stock, "url": "https://example.com"})
+        account_item = bot.item_store.allocate_item_id(guild_id, panel_id)
+        bot.item_store.put_item(guild_id, account_item, {"panel_id": panel_id, "name": "アカウント型", "price": 100, "stock": 0, "kind": "account"})
+        bot.item_store.add_accounts(guild_id, account_item, [{"email": f"g{g}-{n}@bench.example", "password": "pw"} for n in range(args.stock)])
+        guilds.append({"id": guild_id, "panel": panel_id, "paypay": paypay, "items": [stock_item, account_item]})
+
+    latencies = []
+    delivered = {}  # (guild_id, item_id) -> 配送した個数
+    purchases = []  # (guild, item_id, 個数, 購入者)
+    next_user = 1
+
+    def new_user():
+        nonlocal next_user
+        user = users[next_user] = FakeUser(next_user)
+        next_user += 1
+        return user
+
+    async def buy_via_modal(guild, item_id, count):
+        user = new_user()
+        link = guild["paypay"].issue_link(100 * count)
+        modal = bot.PayModal(item_id, user.id)
+        # モーダルの入力値を直接埋める（Discord から送られてくる値の代わり）
+        modal.link_input._value = link
+        modal.count_input._value = str(count)
+        modal.password_input._value = ""
+        started = time.perf_counter()
+        await modal.on_submit(FakeInteraction(guild["id"], user))
+        latencies.append(time.perf_counter() - started)
+        purchases.append((guild, item_id, count, user))
+
+    async def give_directly(guild, item_id, count):
+        user = new_user()
+        started = time.perf_counter()
+        await bot.give_item_automatically(user, guild["id"], item_id, count=count)
+        latencies.append(time.perf_counter() - started)
+        purchases.append((guild, item_id, count, user))
+
+    async def refresh_panels(guild):
+        for _ in range(args.buyers // 10 + 1):
+            await bot.update_panel(guild["id"], guild["panel"])
+            await asyncio.sleep(0.01)
+
+    tasks = []
+    for guild in guilds:
+        for _ in range(args.buyers):
+            item_id = random.choice(guild["items"])
+            count = random.randint(1, args.max_count)
+            if random.random() < args.direct_ratio:
+                tasks.append(give_directly(guild, item_id, count))
+            else:
+                tasks.append(buy_via_modal(guild, item_id, count))
+        tasks.append(refresh_panels(guild))
+    random.shuffle(tasks)
+
+    started = time.perf_counter()
+    await asyncio.gather(*tasks)
+    # 支払いを受け取った注文はワーカーが配送するので、配送が終わるまで待つ
+    await bot.order_workers.wait_idle()
+    elapsed = time.perf_counter() - started
+    # パネル更新とログ送信の遅延分を待ってから止める
+    await asyncio.sleep(max(bot.PANEL_REFRESH_DELAY, bot.LOG_BATCH_WINDOW) + 0.2)
+    stop.set()
+    await lag_task
+
+    # 売り越し・二重配送の確認
+    problems = []
+    successful = 0
+    for guild, item_id, count, user in purchases:
+        if len(user.deliveries) > 1:
+            problems.append(f"二重配送: guild={guild['id']} item={item_id} user={user.id} DM={len(user.deliveries)}通")
+        if user.deliveries:
+            successful += 1
+            delivered[(guild["id"], item_id)] = delivered.get((guild["id"], item_id), 0) + count
+    for guild in guilds:
+        for link_id, times in guild["paypay"].received.items():
+            if times > 1:
+                problems.append(f"二重受け取り: guild={guild['id']} link={link_id} {times}回")
+        for item_id in guild["items"]:
+            item = bot.item_store.get_item(guild["id"], item_id)
+            sent = delivered.get((guild["id"], item_id), 0)
+            remaining = item.get("stock", 0)
+            if sent > args.stock:
+                problems.append(f"売り越し: guild={guild['id']} item={item_id} 在庫{args.stock} / 配送{sent}")
+            elif sent + remaining != args.stock:
+                problems.append(f"在庫の不一致: guild={guild['id']} item={item_id} 在庫{args.stock} / 配送{sent} / 残り{remaining}")
+        emails = [e for g, _, _, u in purchases if g is guild for d in u.deliveries for e in d]
+        if len(emails) != len(set(emails)):
+            problems.append(f"アカウントの重複配送: guild={guild['id']} {len(emails) - len(set(emails))}件")
+
+    bot.state_store.flush()
+
+    print(f"ギルド数: {args.guilds} / 購入試行: {len(purchases)} / 配送成功: {successful}")
+    print(f"所要時間: {elapsed:.2f}s / 購入数: {successful / elapsed:.1f} 件/秒")
+    print(f"レイテンシ: p50 {percentile(latencies, 50) * 1000:.1f}ms / p99 {percentile(latencies, 99) * 1000:.1f}ms / 最大 {max(latencies, default=0) * 1000:.1f}ms")
+    print(f"イベントループ遅延: p99 {percentile(loop_lag, 99) * 1000:.1f}ms / 最大 {max(loop_lag, default=0) * 1000:.1f}ms")
+    print(f"パネル編集: {sum(m.edits for c in channels.values() for m in c.messages.values())}回 / ログ送信: {sum(c.sent for c in channels.values())}回")
+    if problems:
+        print(f"❌ 問題 {len(problems)}件")
+        for problem in problems[:50]:
+            print(f"  - {problem}")
+        return 1
+    print("✅ 売り越し・二重配送なし")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="購入処理のオフライン負荷試験")
+    parser.add_argument("--guilds", type=int, default=20, help="ギルド数")
+    parser.add_argument("--buyers", type=int, default=50, help="ギルドあたりの購入試行数")
+    parser.add_argument("--stock", type=int, default=30, help="商品あたりの初期在庫")
+    parser.add_argument("--max-count", type=int, default=2, help="1回の購入個数の上限")
+    parser.add_argument("--latency", type=float, default=0.05, help="PayPay 呼び出し1回の平均レイテンシ（秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.02, help="PayPay 呼び出しの失敗率")
+    parser.add_argument("--direct-ratio", type=float, default=0.2, help="give_item_automatically を直接呼ぶ割合")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json", help="商品データの保存先")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    # データは一時ディレクトリに書く（bot は import 時に設定を読むので先に環境変数を用意する）
+    workdir = tempfile.mkdtemp(prefix="vending-bench-")
+    os.environ.setdefault("PANEL_REFRESH_DELAY", "0.05")
+    os.environ.setdefault("LOG_BATCH_WINDOW", "0.05")
+    os.environ["STORAGE_BACKEND"] = args.backend
+    os.environ["SQLITE_PATH"] = os.path.join(workdir, "store.sqlite3")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    print(f"作業ディレクトリ: {workdir}")
+
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,25 @@ import asyncio
 from discord.ext import commands
 from discord import app_commands, Interaction, Embed, ButtonStyle, ui
 import json, os
-from datetime import datetime, timedelta, timezone
+import csv, io
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta, timezone
 from PayPaython_mobile import PayPay, PayPayLoginError
 from Crypto.Cipher import AES
 from base64 import b64encode, b64decode
 import hashlib
+import random
 from dotenv import load_dotenv
 from typing import Optional
 from ticket import TicketView
+from storage import GuildStateStore, OrderQueue, SalesLedger, UsedLinkRegistry, create_item_backend, is_account_item
+from search import SearchIndex
+from account_import import parse_account_lines
+from metrics import MetricsRegistry
 import os
+import signal
 import sys
 import time
 
@@ -24,59 +34,218 @@ TOKEN = os.getenv("BOT_TOKEN") or "YOUR_TOKEN"  # .env に BOT_TOKEN=... を入
 BASE_DATA_DIR = "data"
 GLOBAL_LOG_CHANNEL_ID = 1373603824773763092
 DISCORD_CHANNEL = 1373603824773763092
-
-intents = discord.Intents.all()
-intents.message_content = True
-intents.members = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+DATA_FLUSH_INTERVAL = float(os.getenv("DATA_FLUSH_INTERVAL", "5"))  # メモリ上の変更をディスクへ書き戻す間隔（秒）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # 商品データの保存先: json（items.json）/ sqlite
+SQLITE_PATH = os.getenv("SQLITE_PATH") or os.path.join(BASE_DATA_DIR, "store.sqlite3")
+PAYPAY_WORKERS = int(os.getenv("PAYPAY_WORKERS", "8"))  # PayPay 通信用スレッド数（全ギルド共通）
+PAYPAY_GUILD_CONCURRENCY = int(os.getenv("PAYPAY_GUILD_CONCURRENCY", "2"))  # 1ギルドあたりの同時 PayPay 通信数
+PAYPAY_TIMEOUT = float(os.getenv("PAYPAY_TIMEOUT", "20"))  # PayPay 通信1回あたりのタイムアウト（秒）
+PAYPAY_QUEUE_TIMEOUT = float(os.getenv("PAYPAY_QUEUE_TIMEOUT", "10"))  # 空きスレッド・ギルドの枠を待つ時間の上限（秒）
+PAYPAY_REFRESH_INTERVAL = float(os.getenv("PAYPAY_REFRESH_INTERVAL", str(12 * 3600)))  # トークンを更新する間隔（秒）
+SECRET_CACHE_TTL = float(os.getenv("SECRET_CACHE_TTL", "600"))  # 復号したトークンをメモリに保持する時間（秒）
+USED_LINK_RETENTION_DAYS = float(os.getenv("USED_LINK_RETENTION_DAYS", "90"))  # 使用済みリンクの記録を残す日数
+SALES_HOURLY_RETENTION_DAYS = float(os.getenv("SALES_HOURLY_RETENTION_DAYS", "90"))  # 時間別の売上集計を残す日数（日別は無期限）
+BULK_IMPORT_MAX_BYTES = int(os.getenv("BULK_IMPORT_MAX_BYTES", str(20 * 1024 * 1024)))  # 在庫一括追加ファイルの上限サイズ
+BULK_IMPORT_CHUNK = 1000  # 在庫一括追加で一度に書き込む件数
+PANEL_REFRESH_DELAY = float(os.getenv("PANEL_REFRESH_DELAY", "2"))  # パネル更新要求をまとめる待ち時間（秒）
+LOG_BATCH_WINDOW = float(os.getenv("LOG_BATCH_WINDOW", "1.5"))  # 購入ログをまとめて送るまでの待ち時間（秒）
+DELIVERY_ATTACHMENT_THRESHOLD = min(int(os.getenv("DELIVERY_ATTACHMENT_THRESHOLD", "12")), 12)  # これを超えるアカウント数はファイルで送る（embed は25フィールドまでなので12件が上限）
+DELIVERY_FILE_ACCOUNTS = int(os.getenv("DELIVERY_FILE_ACCOUNTS", "5000"))  # 1ファイルあたりのアカウント数
+DELIVERY_FILES_PER_MESSAGE = 10  # 1メッセージに添付できるファイル数の上限
+ORDER_WORKERS = int(os.getenv("ORDER_WORKERS", "4"))  # 注文の配送を行うワーカー数
+ORDER_MAX_ATTEMPTS = int(os.getenv("ORDER_MAX_ATTEMPTS", "8"))  # 配送をあきらめるまでの試行回数
+ORDER_RETRY_DELAY = float(os.getenv("ORDER_RETRY_DELAY", "5"))  # 配送の再試行までの待ち時間（秒・試行毎に倍）
+SUPERVISOR_MAX_FAILURES = int(os.getenv("SUPERVISOR_MAX_FAILURES", "5"))  # 接続失敗がこの回数続いたらプロセスごと再起動
+SUPERVISOR_BACKOFF_BASE = float(os.getenv("SUPERVISOR_BACKOFF_BASE", "2"))  # 再接続までの待ち時間（秒・失敗毎に倍）
+SUPERVISOR_BACKOFF_MAX = float(os.getenv("SUPERVISOR_BACKOFF_MAX", "300"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 計測値を公開する HTTP ポート（0 なら公開しない・クラスタ毎に +CLUSTER_ID）
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# シャーディング: SHARDED=1 で AutoShardedBot を使う。launcher.py から起動するとクラスタ毎に以下が渡される
+SHARDED = os.getenv("SHARDED") == "1" or bool(os.getenv("SHARD_COUNT"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None  # 全体のシャード数（空なら Discord の推奨値）
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS", "").split(",") if i.strip()] or None  # このプロセスが受け持つシャード
+CLUSTER_ID = int(os.getenv("CLUSTER_ID", "0"))
+CLUSTER_COUNT = int(os.getenv("CLUSTER_COUNT", "1"))
+CLUSTER_STATS_DIR = os.path.join(BASE_DATA_DIR, "cluster_stats")  # クラスタ毎のサーバー数・ユーザー数
+EXTENSIONS = [name.strip() for name in os.getenv("EXTENSIONS", "ticket,認証,embed,参加ログ,vending_giveaway_stats").split(",") if name.strip()]
+# 省メモリモード: 必要な intents だけを要求し、メンバーはキャッシュしない（必要なときに fetch_member する）
+LEAN_MODE = os.getenv("LEAN_MODE") == "1"
+LEAN_EXTRA_INTENTS = [name.strip() for name in os.getenv("LEAN_EXTRA_INTENTS", "").split(",") if name.strip()]  # 例: message_content,guild_messages
+# 拡張ごとに追加で必要な intents（参加ログはメンバーの参加・退出イベントを受け取る）
+EXTENSION_INTENTS = {"参加ログ": ["members"]}
+
+def build_intents() -> discord.Intents:
+    if not LEAN_MODE:
+        intents = discord.Intents.all()
+        intents.message_content = True
+        intents.members = True
+        return intents
+    # 自販機・スラッシュコマンド・ボタンはギルド情報（チャンネル・ロール）があれば動く
+    intents = discord.Intents.none()
+    intents.guilds = True
+    for name in EXTENSIONS:
+        for flag in EXTENSION_INTENTS.get(name, []):
+            setattr(intents, flag, True)
+    for flag in LEAN_EXTRA_INTENTS:
+        setattr(intents, flag, True)
+    return intents
+
+intents = build_intents()
+client_options = {}
+if LEAN_MODE:
+    client_options = {"chunk_guilds_at_startup": False, "member_cache_flags": discord.MemberCacheFlags.none()}
+if SHARDED:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **client_options)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, **client_options)
 tree = bot.tree
 
+def owns_guild(guild_id: int) -> bool:
+    """このプロセスが受け持つシャードのギルドか（ギルド毎のデータは受け持ちのプロセスだけが触る）"""
+    if SHARD_COUNT is None or SHARD_IDS is None:
+        return True
+    return (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+# ------------------------
+# 計測（METRICS_PORT を設定すると /metrics で Prometheus 形式を返す）
+# ------------------------
+metrics = MetricsRegistry()
+purchase_stage_seconds = metrics.histogram("vending_purchase_stage_seconds", "購入処理の段階ごとの所要時間（秒）", ["stage"])
+purchases_total = metrics.counter("vending_purchases_total", "購入処理の結果ごとの件数（success / failure / oversell / rejected）", ["result"])
+purchase_errors_total = metrics.counter("vending_purchase_errors_total", "購入処理の段階ごとのエラー件数", ["stage"])
+purchases_in_flight = metrics.gauge("vending_purchases_in_flight", "処理中の購入数")
+orders_total = metrics.counter("vending_orders_total", "注文の配送結果ごとの件数（delivered / retry / failed）", ["result"])
+orders_outstanding = metrics.gauge("vending_orders_outstanding", "配送待ち・再試行待ちの注文数")
+event_loop_lag_seconds = metrics.gauge("vending_event_loop_lag_seconds", "イベントループの遅延（秒）")
+
 # ------------------------
 # ユーティリティ関数
 # ------------------------
+# ギルドデータは state_store がメモリに保持し、バックグラウンドでまとめて書き戻す
+state_store = GuildStateStore(BASE_DATA_DIR, flush_interval=DATA_FLUSH_INTERVAL)
+
 def get_data_path(guild_id: int, filename: str) -> str:
-    guild_dir = os.path.join(BASE_DATA_DIR, str(guild_id))
-    os.makedirs(guild_dir, exist_ok=True)
-    return os.path.join(guild_dir, filename)
+    return state_store.path(guild_id, filename)
 
 def load_json(path):
-    if not os.path.exists(path):
-        return {}
-    with open(path, "r", encoding="utf-8") as f:
-        try:
-            return json.load(f)
-        except Exception:
-            return {}
+    # 返り値はキャッシュそのもの。変更した場合は save_json で dirty にすること
+    return state_store.load(path)
 
 def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    state_store.save(path, data)
+
+# 商品（items）は item_store 経由で読み書きする。json 版は items.json + ジャーナル、sqlite 版は SQLite
+# items.json → SQLite の移行はクラスタ 0 だけが行う（複数プロセスが同じギルドを同時に移行しないように）
+item_store = create_item_backend(STORAGE_BACKEND, state_store, SQLITE_PATH, migrate=CLUSTER_ID == 0)
+
+# PayPaython_mobile は同期 HTTP クライアントなので、イベントループを止めないよう専用スレッドで実行する
+paypay_executor = ThreadPoolExecutor(max_workers=PAYPAY_WORKERS, thread_name_prefix="paypay")
+_paypay_guild_limits = {}
+
+async def run_paypay(guild_id, func, *args):
+    """PayPay の同期 API を専用スレッドプールで実行する（ギルド毎の同時実行数・タイムアウト付き）
+
+    タイムアウト時は asyncio.TimeoutError を送出する。スレッド側の処理は止まらないので、
+    ギルドの枠はスレッドが実際に終わるまで返さない（1ギルドの呼び出しが固まっても全スレッドを占有しない）。
+    実行のタイムアウト（PAYPAY_TIMEOUT）はスレッドで実行が始まってから数え、それまでの
+    ギルドの枠・空きスレッド待ちには別の上限（PAYPAY_QUEUE_TIMEOUT）を設ける。
+    """
+    limit = _paypay_guild_limits.get(guild_id)
+    if limit is None:
+        limit = _paypay_guild_limits[guild_id] = asyncio.Semaphore(PAYPAY_GUILD_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + PAYPAY_QUEUE_TIMEOUT
+    await asyncio.wait_for(limit.acquire(), PAYPAY_QUEUE_TIMEOUT)
+    started = asyncio.Event()
+
+    def call():
+        loop.call_soon_threadsafe(started.set)
+        return func(*args)
+
+    def release(_):
+        try:
+            loop.call_soon_threadsafe(limit.release)
+        except RuntimeError:
+            pass  # イベントループが既に閉じている
+
+    try:
+        future = paypay_executor.submit(call)
+    except BaseException:
+        limit.release()
+        raise
+    future.add_done_callback(release)
+    try:
+        await asyncio.wait_for(started.wait(), max(0.0, deadline - loop.time()))
+    except asyncio.TimeoutError:
+        # 他のギルドの呼び出しでスレッドが埋まっている。取り消せたら諦める（取り消す直前に始まっていたら実行を待つ）
+        if future.cancel():
+            raise
+    except asyncio.CancelledError:
+        future.cancel()  # まだ始まっていなければ取り消す（始まっていれば終わった時に枠を返す）
+        raise
+    return await asyncio.wait_for(asyncio.wrap_future(future), PAYPAY_TIMEOUT)
+
+@functools.lru_cache(maxsize=8)
+def _derive_key(key: str) -> bytes:
+    return hashlib.sha256(key.encode()).digest()
+
+_encrypt_key = None
+
+def get_encrypt_key() -> str:
+    # TOKEN_ENCRYPT_KEY は起動中に変わらないので一度だけ読む
+    global _encrypt_key
+    if _encrypt_key is None:
+        _encrypt_key = os.getenv("TOKEN_ENCRYPT_KEY")
+    return _encrypt_key
 
 def encrypt_token(token, key):
-    key = hashlib.sha256(key.encode()).digest()
+    key = _derive_key(key)
     cipher = AES.new(key, AES.MODE_EAX)
     ciphertext, tag = cipher.encrypt_and_digest(token.encode())
     return b64encode(cipher.nonce + tag + ciphertext).decode()
 
 def decrypt_token(encrypted: str, key: str) -> str:
-    key = hashlib.sha256(key.encode()).digest()
+    key = _derive_key(key)
     data = b64decode(encrypted)
     nonce, tag, ciphertext = data[:16], data[16:32], data[32:]
     cipher = AES.new(key, AES.MODE_EAX, nonce=nonce)
     return cipher.decrypt_and_verify(ciphertext, tag).decode()
 
+class SecretCache:
+    """config.json の暗号化トークンを復号した結果を TTL 付きでメモリに保持する（ディスク上は暗号化のまま）"""
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}  # (guild_id, field) -> (暗号文, 平文, 期限)
+
+    def get(self, guild_id, config: dict, field: str) -> str:
+        encrypted = config[field]
+        entry = self._entries.get((guild_id, field))
+        now = time.monotonic()
+        # 暗号文が書き換わっていれば（再登録・更新後）キャッシュは使わない
+        if entry and entry[0] == encrypted and entry[2] > now:
+            return entry[1]
+        plain = decrypt_token(encrypted, get_encrypt_key())
+        self._entries[(guild_id, field)] = (encrypted, plain, now + self.ttl)
+        return plain
+
+    def invalidate(self, guild_id):
+        for key in [k for k in self._entries if k[0] == guild_id]:
+            del self._entries[key]
+
+secret_cache = SecretCache(SECRET_CACHE_TTL)
+
+# 使用済みリンクはメモリ上の索引で判定し、used_links.log に追記する
+used_links = UsedLinkRegistry(state_store, USED_LINK_RETENTION_DAYS * 86400)
+
 def is_already_used(link_id: str, guild_id: int) -> bool:
-    used_links = load_json(get_data_path(guild_id, "used_links.json"))
-    return link_id in used_links
+    return used_links.is_used(guild_id, link_id)
 
 def mark_link_as_used(link_id: str, guild_id: int):
-    used_links = load_json(get_data_path(guild_id, "used_links.json"))
-    used_links[link_id] = True
-    save_json(get_data_path(guild_id, "used_links.json"), used_links)
+    used_links.mark(guild_id, link_id)
 
 def format_item_stock_display(item: dict) -> str:
-    if "accounts" in item:
-        if item.get("stock", 0) > 0 and item.get("accounts"):
+    if is_account_item(item):
+        if item.get("stock", 0) > 0:
             return str(item["stock"])
         else:
             return "在庫なし"
@@ -88,70 +257,348 @@ def format_item_stock_display(item: dict) -> str:
     except Exception:
         return "在庫エラー"
 
+# ------------------------
+# PayPay クライアント管理（ギルド毎にログイン済みクライアントを使い回す）
+# ------------------------
+class PayPayPoolError(Exception):
+    """購入者に表示するタイトルと説明を持つ PayPay 接続エラー"""
+    def __init__(self, title: str, description: str):
+        super().__init__(description)
+        self.title = title
+        self.description = description
+
+class PayPayClientPool:
+    def __init__(self):
+        self._clients = {}  # guild_id -> (PayPay, ログインに使った暗号化アクセストークン)
+        self._locks = {}
+        self._retry_at = {}
+        self._refresh_task = None
+
+    def _lock(self, guild_id):
+        lock = self._locks.get(guild_id)
+        if lock is None:
+            lock = self._locks[guild_id] = asyncio.Lock()
+        return lock
+
+    def put(self, guild_id, paypay: PayPay, config: dict):
+        self._clients[guild_id] = (paypay, config.get("paypay_access_token"))
+
+    def invalidate(self, guild_id):
+        self._clients.pop(guild_id, None)
+
+    async def get(self, guild_id) -> PayPay:
+        config = load_json(get_data_path(guild_id, "config.json"))
+        entry = self._clients.get(guild_id)
+        if entry and entry[1] == config.get("paypay_access_token"):
+            return entry[0]
+        # 同じギルドで同時にログインが走らないようにまとめる
+        async with self._lock(guild_id):
+            entry = self._clients.get(guild_id)
+            if entry and entry[1] == config.get("paypay_access_token"):
+                return entry[0]
+            return await self._login(guild_id, config)
+
+    async def _login(self, guild_id, config) -> PayPay:
+        try:
+            with purchase_stage_seconds.time(stage="token_decrypt"):
+                access_token = secret_cache.get(guild_id, config, "paypay_access_token")
+        except Exception as e:
+            purchase_errors_total.inc(stage="token_decrypt")
+            raise PayPayPoolError("復号エラー", f"アクセストークンの復号に失敗しました。\n```\n{e.__class__.__name__}: {str(e)}\n```")
+        try:
+            with purchase_stage_seconds.time(stage="paypay_login"):
+                paypay = await run_paypay(guild_id, functools.partial(PayPay, access_token=access_token))
+                await run_paypay(guild_id, paypay.alive)
+                profile = await run_paypay(guild_id, paypay.get_profile)
+            paypay.user_id = getattr(profile, "userId", None) or getattr(profile, "externalId", None)
+        except asyncio.TimeoutError:
+            purchase_errors_total.inc(stage="paypay_login")
+            raise PayPayPoolError("PayPay応答なし", "PayPayからの応答がありません。時間をおいて再度お試しください。")
+        except PayPayLoginError:
+            return await self._refresh(guild_id, config)
+        self.put(guild_id, paypay, config)
+        return paypay
+
+    async def _refresh(self, guild_id, config) -> PayPay:
+        if "paypay_refresh_token" not in config:
+            raise PayPayPoolError("ログイン失敗", "アクセストークンが無効で、リフレッシュトークンも存在しません。")
+        secret_key = get_encrypt_key()
+        try:
+            refresh_token = secret_cache.get(guild_id, config, "paypay_refresh_token")
+            temp = await run_paypay(guild_id, PayPay)
+            await run_paypay(guild_id, temp.token_refresh, refresh_token)
+            paypay = await run_paypay(guild_id, functools.partial(PayPay, access_token=temp.access_token))
+        except Exception:
+            self.invalidate(guild_id)
+            raise PayPayPoolError("トークン更新失敗", "リフレッシュトークンでの再ログインに失敗しました。")
+        config["paypay_access_token"] = encrypt_token(temp.access_token, secret_key)
+        config["paypay_refresh_token"] = encrypt_token(temp.refresh_token, secret_key)
+        config["paypay_token_refreshed_at"] = time.time()
+        save_json(get_data_path(guild_id, "config.json"), config)
+        secret_cache.invalidate(guild_id)
+        # 古いリフレッシュトークンは使えなくなるので、新しいトークンはすぐにディスクへ書き出す
+        await state_store.flush_async()
+        self.put(guild_id, paypay, config)
+        return paypay
+
+    async def refresh(self, guild_id) -> PayPay:
+        async with self._lock(guild_id):
+            return await self._refresh(guild_id, load_json(get_data_path(guild_id, "config.json")))
+
+    async def call(self, guild_id, method: str, *args):
+        """キャッシュ済みクライアントで API を呼ぶ。トークン切れなら一度だけ更新して再試行する"""
+        paypay = await self.get(guild_id)
+        try:
+            return await run_paypay(guild_id, getattr(paypay, method), *args)
+        except PayPayLoginError:
+            paypay = await self.refresh(guild_id)
+            return await run_paypay(guild_id, getattr(paypay, method), *args)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(60)
+            now = time.time()
+            for guild in list(bot.guilds):
+                config = load_json(get_data_path(guild.id, "config.json"))
+                if "paypay_refresh_token" not in config:
+                    continue
+                if now - config.get("paypay_token_refreshed_at", 0) < PAYPAY_REFRESH_INTERVAL or now < self._retry_at.get(guild.id, 0):
+                    continue
+                try:
+                    await self.refresh(guild.id)
+                    print(f"✅ PayPayトークンを更新しました: guild={guild.id}")
+                except PayPayPoolError as e:
+                    # 失敗したら10分後に再試行する（購入時にも更新を試みる）
+                    self._retry_at[guild.id] = now + 600
+                    print(f"⚠️ PayPayトークン更新エラー: guild={guild.id}: {e.description}")
+
+    def start(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.get_running_loop().create_task(self._refresh_loop())
+        return self._refresh_task
+
+paypay_pool = PayPayClientPool()
+
+# ------------------------
+# 検索インデックス（オートコンプリート用）
+# ------------------------
+# ギルド毎に初回利用時に作り、以降は追加・削除のたびにその分だけ更新する
+class CatalogSearch:
+    def __init__(self):
+        self._items = {}     # guild_id -> SearchIndex（key: item_id）
+        self._panels = {}    # guild_id -> SearchIndex（key: panel_id）
+        self._channels = {}  # guild_id -> SearchIndex（key: str(channel_id)）
+
+    def items(self, guild_id) -> SearchIndex:
+        index = self._items.get(guild_id)
+        if index is None:
+            index = self._items[guild_id] = SearchIndex()
+            for item_id, item in item_store.items(guild_id).items():
+                index.add(item_id, item.get("name", "不明"), item_id)
+        return index
+
+    def item_changed(self, guild_id, item_id, item: dict):
+        if guild_id in self._items:
+            self._items[guild_id].add(item_id, item.get("name", "不明"), item_id)
+
+    def item_removed(self, guild_id, *item_ids):
+        if guild_id in self._items:
+            for item_id in item_ids:
+                self._items[guild_id].remove(item_id)
+
+    def panels(self, guild_id) -> SearchIndex:
+        index = self._panels.get(guild_id)
+        if index is None:
+            index = self._panels[guild_id] = SearchIndex()
+            for panel_id, panel in load_json(get_data_path(guild_id, "panels.json")).items():
+                index.add(panel_id, panel.get("title", "自販機パネル"), panel_id)
+        return index
+
+    def panel_changed(self, guild_id, panel_id, panel: dict):
+        if guild_id in self._panels:
+            self._panels[guild_id].add(panel_id, panel.get("title", "自販機パネル"), panel_id)
+
+    def panel_removed(self, guild_id, panel_id):
+        if guild_id in self._panels:
+            self._panels[guild_id].remove(panel_id)
+
+    def channels(self, guild: discord.Guild) -> SearchIndex:
+        index = self._channels.get(guild.id)
+        if index is None:
+            index = self._channels[guild.id] = SearchIndex()
+            for channel in guild.text_channels:
+                index.add(str(channel.id), channel.name)
+        return index
+
+    def channel_changed(self, channel):
+        if channel.guild.id in self._channels and isinstance(channel, discord.TextChannel):
+            self._channels[channel.guild.id].add(str(channel.id), channel.name)
+
+    def channel_removed(self, channel):
+        if channel.guild.id in self._channels:
+            self._channels[channel.guild.id].remove(str(channel.id))
+
+catalog_search = CatalogSearch()
+
+@bot.listen()
+async def on_guild_channel_create(channel):
+    catalog_search.channel_changed(channel)
+
+@bot.listen()
+async def on_guild_channel_update(before, after):
+    catalog_search.channel_changed(after)
+
+@bot.listen()
+async def on_guild_channel_delete(channel):
+    catalog_search.channel_removed(channel)
+
 # ------------------------
 # ビュー／ボタン類（自販機・配布系）
 # ------------------------
+# Select は1つに25件までなので、それを超える選択肢はページ送りで見せる
+class PagedSelectView(ui.View):
+    PAGE_SIZE = 25
+
+    def __init__(self, options, placeholder, on_select, timeout=180):
+        super().__init__(timeout=timeout)
+        self.options = options
+        self.placeholder = placeholder
+        self.on_select = on_select
+        self.page = 0
+        self.select = ui.Select(placeholder=placeholder, options=options[:self.PAGE_SIZE])
+        self.select.callback = self.select_callback
+        self.add_item(self.select)
+        if self.page_count > 1:
+            self.prev_button = ui.Button(label="◀️", style=discord.ButtonStyle.primary)
+            self.next_button = ui.Button(label="▶️", style=discord.ButtonStyle.primary)
+            self.prev_button.callback = self.prev_page
+            self.next_button.callback = self.next_page
+            self.add_item(self.prev_button)
+            self.add_item(self.next_button)
+            self.render()
+
+    @property
+    def page_count(self) -> int:
+        return max(1, -(-len(self.options) // self.PAGE_SIZE))
+
+    def render(self):
+        start = self.page * self.PAGE_SIZE
+        self.select.options = self.options[start:start + self.PAGE_SIZE]
+        self.select.placeholder = f"{self.placeholder}（{self.page + 1} / {self.page_count}）"
+        self.prev_button.disabled = self.page == 0
+        self.next_button.disabled = self.page >= self.page_count - 1
+
+    async def select_callback(self, interaction: Interaction):
+        await self.on_select(interaction, self.select.values[0])
+
+    async def prev_page(self, interaction: Interaction):
+        self.page = max(0, self.page - 1)
+        self.render()
+        await interaction.response.edit_message(view=self)
+
+    async def next_page(self, interaction: Interaction):
+        self.page = min(self.page_count - 1, self.page + 1)
+        self.render()
+        await interaction.response.edit_message(view=self)
+
+# 在庫一覧の embed と購入セレクトの選択肢は、パネルの版数が変わるまで使い回す
+class PanelRenderCache:
+    def __init__(self):
+        self._entries = {}  # (guild_id, panel_id, kind) -> (版数, 描画結果)
+
+    def get(self, guild_id, panel_id, kind, build):
+        key = (guild_id, panel_id, kind)
+        version = item_store.panel_version(guild_id, panel_id)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        value = build(item_store.panel_items(guild_id, panel_id))
+        self._entries[key] = (version, value)
+        return value
+
+    def forget(self, guild_id, panel_id):
+        for key in [k for k in self._entries if k[:2] == (guild_id, panel_id)]:
+            del self._entries[key]
+
+panel_render_cache = PanelRenderCache()
+
+def build_purchase_options(items: dict) -> list:
+    options = []
+    for item_id, item in items.items():
+        if is_account_item(item):
+            if item.get("stock", 0) > 0:
+                stock_display = str(item["stock"])
+            else:
+                continue
+        else:
+            stock_display = "♾️" if item.get("stock", 0) == 0 else f"残: {item.get('stock')}"
+        options.append(discord.SelectOption(label=item.get("name", "不明"), value=item_id, description=f"¥{item.get('price',0)} {stock_display}"))
+    return options
+
+def build_stock_embed(items: dict) -> Embed:
+    item_texts = []
+    for count, item in enumerate(items.values(), 1):
+        stock_display = format_item_stock_display(item)
+        item_texts.append(f"{count}. {item.get('name','不明')}\n{item.get('description','説明なし')}\n価格: ¥{item.get('price',0)}（在庫: {stock_display}）")
+    return Embed(title="📦在庫一覧", description="\n\n".join(item_texts) if item_texts else "商品がありません。", color=discord.Color.blurple())
+
 class PurchaseView(ui.View):
     def __init__(self, panel_id):
         super().__init__(timeout=None)
-        self.add_item(PurchaseButton(panel_id))
-        self.add_item(CheckStockButton(panel_id))
-
-class PurchaseButton(ui.Button):
-    def __init__(self, panel_id):
-        super().__init__(label="購入する", style=discord.ButtonStyle.green, custom_id=f"purchase:{panel_id}")
+        self.add_item(PanelButton("purchase", panel_id))
+        self.add_item(PanelButton("stock", panel_id))
+
+# パネルのボタンは custom_id（purchase:<panel_id> / stock:<panel_id>）から都度復元する。
+# setup_hook で1回登録するだけなので、パネルがいくつあっても起動時の処理やメモリは増えない
+class PanelButton(ui.DynamicItem[ui.Button], template=r"(?P<action>purchase|stock):(?P<panel_id>.+)"):
+    BUTTONS = {
+        "purchase": ("購入する", discord.ButtonStyle.green),
+        "stock": ("在庫確認", discord.ButtonStyle.blurple),
+    }
+
+    def __init__(self, action, panel_id):
+        label, style = self.BUTTONS[action]
+        super().__init__(ui.Button(label=label, style=style, custom_id=f"{action}:{panel_id}"))
+        self.action = action
         self.panel_id = panel_id
 
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: ui.Button, match):
+        return cls(match["action"], match["panel_id"])
+
+    def resolve_panel_id(self, interaction: Interaction):
+        # 以前はボタンに入力された識別IDが入っていたので、その場合はメッセージID（= パネルのキー）で引き直す
+        panels = load_json(get_data_path(interaction.guild_id, "panels.json"))
+        if self.panel_id not in panels and interaction.message and str(interaction.message.id) in panels:
+            return str(interaction.message.id)
+        return self.panel_id
+
     async def callback(self, interaction: Interaction):
-        guild_id = interaction.guild_id
-        items = load_json(get_data_path(guild_id, "items.json"))
-        options = []
-        for item_id, item in items.items():
-            if item.get("panel_id") != self.panel_id:
-                continue
-            if "accounts" in item:
-                if item.get("stock", 0) > 0 and item.get("accounts"):
-                    stock_display = str(item["stock"])
-                else:
-                    continue
-            else:
-                stock_display = "♾️" if item.get("stock", 0) == 0 else f"残: {item.get('stock')}"
-            options.append(discord.SelectOption(label=item.get("name", "不明"), value=item_id, description=f"¥{item.get('price',0)} {stock_display}"))
+        panel_id = self.resolve_panel_id(interaction)
+        if self.action == "purchase":
+            await self.purchase(interaction, panel_id)
+        else:
+            await self.check_stock(interaction, panel_id)
+
+    async def purchase(self, interaction: Interaction, panel_id):
+        options = panel_render_cache.get(interaction.guild_id, panel_id, "options", build_purchase_options)
 
         if not options:
             await interaction.response.send_message("在庫がありません。", ephemeral=True)
             return
 
-        view = ItemSelectView(options)
+        view = ItemSelectView(list(options))
         await interaction.response.send_message("商品を選んでください", view=view, ephemeral=True)
 
-class CheckStockButton(ui.Button):
-    def __init__(self, panel_id):
-        super().__init__(label="在庫確認", style=discord.ButtonStyle.blurple, custom_id=f"stock:{panel_id}")
-        self.panel_id = panel_id
-
-    async def callback(self, interaction: Interaction):
-        guild_id = interaction.guild_id
-        items = load_json(get_data_path(guild_id, "items.json"))
-        item_texts = []
-        count = 1
-        for item in items.values():
-            if item.get("panel_id") == self.panel_id:
-                stock_display = format_item_stock_display(item)
-                item_texts.append(f"{count}. {item.get('name','不明')}\n{item.get('description','説明なし')}\n価格: ¥{item.get('price',0)}（在庫: {stock_display}）")
-                count += 1
-        embed = Embed(title="📦在庫一覧", description="\n\n".join(item_texts) if item_texts else "商品がありません。", color=discord.Color.blurple())
+    async def check_stock(self, interaction: Interaction, panel_id):
+        embed = panel_render_cache.get(interaction.guild_id, panel_id, "stock", build_stock_embed)
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
-class ItemSelectView(ui.View):
+class ItemSelectView(PagedSelectView):
     def __init__(self, options):
-        super().__init__(timeout=None)
-        select = ui.Select(placeholder="商品を選択", options=options)
-        select.callback = self.select_callback
-        self.add_item(select)
+        super().__init__(options, "商品を選択", self.item_selected, timeout=None)
 
-    async def select_callback(self, interaction: Interaction):
-        selected_id = interaction.data['values'][0]
+    async def item_selected(self, interaction: Interaction, selected_id):
         await interaction.response.send_modal(PayModal(selected_id, interaction.user.id))
 
 # ------------------------
@@ -172,13 +619,28 @@ class PayModal(ui.Modal, title="支払い情報を入力"):
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
         guild_id = interaction.guild_id
-        items = load_json(get_data_path(guild_id, "items.json"))
-        config = load_json(get_data_path(guild_id, "config.json"))
         pay_link = self.link_input.value.strip()
         link_id = pay_link.rstrip("/").split("/")[-1]
 
-        item = items.get(self.item_id)
+        # 使用済み・処理中のリンクは PayPay に問い合わせる前に弾く
+        if not used_links.claim(guild_id, link_id):
+            purchases_total.inc(result="rejected")
+            return await interaction.followup.send("このリンクはすでに使用済みか、処理中です。", ephemeral=True)
+        # process_payment の中で success / oversell / rejected に書き換える
+        self.outcome = "failure"
+        try:
+            with purchases_in_flight.track(), purchase_stage_seconds.time(stage="total"):
+                await self.process_payment(interaction, pay_link, link_id)
+        finally:
+            used_links.release(guild_id, link_id)
+            purchases_total.inc(result=self.outcome)
+
+    async def process_payment(self, interaction: discord.Interaction, pay_link: str, link_id: str):
+        guild_id = interaction.guild_id
+
+        item = item_store.get_item(guild_id, self.item_id)
         if not item:
+            self.outcome = "rejected"
             return await interaction.followup.send("指定された商品が存在しません。", ephemeral=True)
 
         item_name = item.get("name", "不明な商品")
@@ -190,43 +652,27 @@ class PayModal(ui.Modal, title="支払い情報を入力"):
         try:
             purchase_count = int(self.count_input.value.strip())
         except ValueError:
+            self.outcome = "rejected"
             return await interaction.followup.send("購入個数は数値で入力してください。", ephemeral=True)
+        if purchase_count < 1:
+            self.outcome = "rejected"
+            return await interaction.followup.send("購入個数は1以上で入力してください。", ephemeral=True)
 
         total_price = item_price * purchase_count
 
         embed = Embed(title="お支払い状況", description="🕒支払いリンクを確認中...", color=discord.Color.orange())
         status_msg = await interaction.followup.send(embed=embed, ephemeral=True)
 
-        secret_key = os.getenv("TOKEN_ENCRYPT_KEY")
-        try:
-            access_token = decrypt_token(config["paypay_access_token"], secret_key)
-        except Exception as e:
-            return await status_msg.edit(embed=Embed(title="復号エラー", description=f"アクセストークンの復号に失敗しました。\n```\n{e.__class__.__name__}: {str(e)}\n```", color=discord.Color.red()))
-
-        # PayPay 接続
+        # PayPay 接続（ログイン済みクライアントを使い回す）
         try:
-            paypay = PayPay(access_token=access_token)
-            paypay.alive()
-            profile = paypay.get_profile()
-            paypay.user_id = getattr(profile, "userId", None) or getattr(profile, "externalId", None)
-        except PayPayLoginError:
-            if "paypay_refresh_token" in config:
-                try:
-                    refresh_token = decrypt_token(config["paypay_refresh_token"], secret_key)
-                    temp = PayPay()
-                    temp.token_refresh(refresh_token)
-                    config["paypay_access_token"] = encrypt_token(temp.access_token, secret_key)
-                    config["paypay_refresh_token"] = encrypt_token(temp.refresh_token, secret_key)
-                    save_json(get_data_path(guild_id, "config.json"), config)
-                    paypay = PayPay(access_token=temp.access_token)
-                except Exception:
-                    return await status_msg.edit(embed=Embed(title="トークン更新失敗", description="リフレッシュトークンでの再ログインに失敗しました。", color=discord.Color.red()))
-            else:
-                return await status_msg.edit(embed=Embed(title="ログイン失敗", description="アクセストークンが無効で、リフレッシュトークンも存在しません。", color=discord.Color.red()))
+            await paypay_pool.get(guild_id)
+        except PayPayPoolError as e:
+            return await status_msg.edit(embed=Embed(title=e.title, description=e.description, color=discord.Color.red()))
 
         # 支払いリンク確認
         try:
-            link_info = paypay.link_check(pay_link)
+            with purchase_stage_seconds.time(stage="link_check"):
+                link_info = await paypay_pool.call(guild_id, "link_check", pay_link)
             sender_name = link_info.get("payload", {}).get("sender", {}).get("displayName", "不明な送信者")
             sender_icon = link_info.get("payload", {}).get("sender", {}).get("photoUrl", None)
             sender_id = link_info.get("payload", {}).get("sender", {}).get("externalId", "不明なID")
@@ -245,48 +691,62 @@ class PayModal(ui.Modal, title="支払い情報を入力"):
             await status_msg.edit(embed=updated_embed)
 
         except Exception as e:
+            purchase_errors_total.inc(stage="link_check")
             return await status_msg.edit(embed=Embed(title="リンクエラー", description=f"支払いリンクの確認に失敗しました。\n```\n{str(e)}\n```", color=discord.Color.red()))
 
         if amount < total_price:
+            self.outcome = "rejected"
             return await status_msg.edit(embed=Embed(title="支払い金額不足", description=f"必要金額: {total_price}円\n支払金額: {amount}円", color=discord.Color.red()))
 
         if status in ["COMPLETED", "SUCCESS"]:
             mark_link_as_used(link_id, guild_id)
+            self.outcome = "rejected"
             return await status_msg.edit(embed=Embed(title="受け取り済みリンク", description="このリンクはすでに受け取り済みです。", color=discord.Color.red()))
 
+        # 在庫の確保（受け取り前に確保し、同じ商品の同時購入で売り越さないようにする）
+        reserved = item_store.consume(guild_id, self.item_id, purchase_count)
+        if reserved is None:
+            self.outcome = "oversell"
+            return await status_msg.edit(embed=Embed(title="在庫不足", description=f"{item_name} の在庫が足りません。支払いは受け取っていません。", color=discord.Color.red()))
+
         # 受け取り処理
         receive_password = (self.password_input.value or "").strip() or None
+        order_data = {
+            "item_id": self.item_id,
+            "item": {"name": item_name, "url": item.get("url"), "panel_id": item.get("panel_id")},
+            "count": purchase_count,
+            "total_price": total_price,
+            "accounts": reserved,
+            "buyer_id": self.buyer_id,
+            "payment": {"link": pay_link, "sender_name": sender_name, "sender_id": sender_id, "sender_icon": sender_icon},
+        }
         try:
-            if receive_password:
-                paypay.link_receive(pay_link, receive_password)
-            else:
-                paypay.link_receive(pay_link)
+            with purchase_stage_seconds.time(stage="link_receive"):
+                if receive_password:
+                    await paypay_pool.call(guild_id, "link_receive", pay_link, receive_password)
+                else:
+                    await paypay_pool.call(guild_id, "link_receive", pay_link)
+        except asyncio.TimeoutError:
+            purchase_errors_total.inc(stage="link_receive")
+            # 受け取れたかどうか分からないので、確保した在庫は戻さずに要確認の注文として残す（/注文確認 で対応する）
+            order = order_queue.enqueue(guild_id, order_data, status="review")
+            print(f"⚠️ link_receive タイムアウト: guild={guild_id} item={self.item_id} order={order['id']}")
+            mark_link_as_used(link_id, guild_id)
+            return await status_msg.edit(embed=Embed(title="受け取り確認中", description=f"PayPayからの応答がありません。支払いが受け取られている可能性があるため、管理者にお問い合わせください。\n注文ID: `{order['id']}`", color=discord.Color.orange()))
         except Exception as e:
+            purchase_errors_total.inc(stage="link_receive")
+            item_store.release(guild_id, self.item_id, reserved, purchase_count)
             return await status_msg.edit(embed=Embed(title="受け取り失敗", description=f"支払いの受け取りに失敗しました。\n```\n{str(e)}\n```", color=discord.Color.red()))
-
-        # 商品送信
-        try:
-            buyer = await bot.fetch_user(self.buyer_id)
-            success = await give_item_automatically(buyer, guild_id, self.item_id, count=purchase_count)
-        except Exception as e:
-            return await status_msg.edit(embed=Embed(title="商品送信失敗", description=f"商品送信時にエラーが発生しました。\n```\n{str(e)}\n```", color=discord.Color.red()))
-
-        if success:
-            await status_msg.edit(embed=Embed(title="商品送信完了", description=f"{buyer.mention} に商品（{item_name} x{purchase_count}）を送信しました。", color=discord.Color.green()))
-        else:
-            await status_msg.edit(embed=Embed(title="商品送信失敗", description="商品をDMに送る際に問題が発生しました。", color=discord.Color.red()))
-
         mark_link_as_used(link_id, guild_id)
 
-        pay_channel = bot.get_channel(config.get("pay_channel"))
-        if pay_channel:
-            log_embed = Embed(title="購入ログ", description=f"{sender_name} (PayPay ID: {sender_id}) が {item_name} x{purchase_count} を購入しました。", color=discord.Color.blue())
-            log_embed.add_field(name="合計金額", value=f"¥{total_price}")
-            log_embed.add_field(name="リンク", value=pay_link, inline=False)
-            if sender_icon:
-                log_embed.set_thumbnail(url=sender_icon)
-            log_embed.set_footer(text=f"DiscordユーザーID: {buyer.id}")
-            await pay_channel.send(embed=log_embed)
+        # 受け取った注文は配送が終わるまでディスクに残し、配送はワーカーに任せてすぐに応答する
+        order = order_queue.enqueue(guild_id, order_data)
+        self.outcome = "success"
+        try:
+            await status_msg.edit(embed=Embed(title="お支払い完了", description=f"支払いを受け取りました。商品（{item_name} x{purchase_count}）をDMに送信しています…\n注文ID: `{order['id']}`", color=discord.Color.green()))
+        finally:
+            order_workers.submit(order, status_msg)
+            record_sale(order)
 
 # ------------------------
 # パネル管理 / 商品管理 / 在庫操作（元コードを統合）
@@ -318,152 +778,422 @@ class NewPanelModal(ui.Modal, title="新しいパネルを作成"):
         if role_id_input.isdigit():
             panel_data["reward_role"] = int(role_id_input)
 
+        # パネルのキーはメッセージIDなので、送信してからそのIDでボタンを付ける
         embed = Embed(title=title, description="現在商品はありません", color=discord.Color.green())
-        message = await interaction.channel.send(embed=embed, view=PurchaseView(panel_id))
+        message = await interaction.channel.send(embed=embed)
+        await message.edit(view=PurchaseView(str(message.id)))
 
         panels[str(message.id)] = panel_data
         save_json(get_data_path(guild_id, "panels.json"), panels)
+        catalog_search.panel_changed(guild_id, str(message.id), panel_data)
 
         await interaction.response.send_message(f"パネルを作成しました！（ID: {message.id}）", ephemeral=True)
 
-async def update_panel(guild_id, panel_id):
-    items = load_json(get_data_path(guild_id, "items.json"))
-    panels = load_json(get_data_path(guild_id, "panels.json"))
+# パネル更新は PanelRefresher がまとめて行う（連続した購入・在庫追加でも編集は短時間に1回）
+class PanelRefresher:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._pending = {}   # (guild_id, panel_id) -> 待機中の更新タスク
+        self._messages = {}  # (guild_id, panel_id) -> PartialMessage（fetch せずに編集する）
+        self._rendered = {}  # (guild_id, panel_id) -> 最後に反映した embed の内容
+
+    def request(self, guild_id, panel_id):
+        key = (guild_id, panel_id)
+        if key in self._pending:
+            return
+        self._pending[key] = asyncio.get_running_loop().create_task(self._run(key))
 
-    if panel_id not in panels:
-        print("パネルが存在しません")
-        return
+    def forget(self, guild_id, panel_id):
+        key = (guild_id, panel_id)
+        self._messages.pop(key, None)
+        self._rendered.pop(key, None)
 
-    channel_id = panels[panel_id]["channel"]
-    channel = bot.get_channel(channel_id)
-    if not channel:
-        print("チャンネルが見つかりません")
-        return
+    async def _run(self, key):
+        await asyncio.sleep(self.delay)
+        # 編集中に来た要求は次の更新として受け付けられるよう、先に外しておく
+        self._pending.pop(key, None)
+        try:
+            await self.refresh_now(*key)
+        except Exception as e:
+            print(f"⚠️ パネル更新エラー: {e}")
 
-    try:
-        message = await channel.fetch_message(int(panel_id))
-    except discord.NotFound:
-        print("パネルメッセージが存在しません。削除します。")
-        del panels[panel_id]
-        save_json(get_data_path(guild_id, "panels.json"), panels)
-        return
+    async def refresh_now(self, guild_id, panel_id):
+        panels = load_json(get_data_path(guild_id, "panels.json"))
+
+        if panel_id not in panels:
+            print("パネルが存在しません")
+            self.forget(guild_id, panel_id)
+            return
+
+        key = (guild_id, panel_id)
+        embed = render_panel_embed(guild_id, panel_id, panels[panel_id])
+        rendered = embed.to_dict()
+        if self._rendered.get(key) == rendered:
+            return
+
+        message = self._messages.get(key)
+        if message is None:
+            channel = bot.get_channel(panels[panel_id]["channel"])
+            if not channel:
+                print("チャンネルが見つかりません")
+                return
+            message = self._messages[key] = channel.get_partial_message(int(panel_id))
 
-    title = panels[panel_id].get("title", "自販機パネル")
-    panel_items = {k: v for k, v in items.items() if v.get("panel_id") == panel_id}
+        try:
+            await message.edit(embed=embed, view=PurchaseView(panel_id))
+        except discord.NotFound:
+            print("パネルメッセージが存在しません。削除します。")
+            del panels[panel_id]
+            save_json(get_data_path(guild_id, "panels.json"), panels)
+            self.forget(guild_id, panel_id)
+            catalog_search.panel_removed(guild_id, panel_id)
+            return
+        self._rendered[key] = rendered
 
+def render_panel_embed(guild_id, panel_id, panel: dict) -> Embed:
     item_list = []
-    for idx, (item_id, item) in enumerate(panel_items.items(), 1):
+    for idx, item in enumerate(item_store.panel_items(guild_id, panel_id).values(), 1):
         description = item.get("description", "説明なし")
         item_list.append(f"**{idx}. {item.get('name','不明')}**\n{description}\n価格: ¥{item.get('price',0)}")
 
     description = "\n".join(item_list) if item_list else "現在商品はありません"
     description += "\n\n※DMに商品が送られますのでご注意ください"
+    return Embed(title=panel.get("title", "自販機パネル"), description=description, color=discord.Color.green())
+
+panel_refresher = PanelRefresher(PANEL_REFRESH_DELAY)
+
+# 購入ログはチャンネル毎のキューに積み、まとめて送る（1メッセージに embed 最大10件）
+class LogDispatcher:
+    MAX_EMBEDS = 10
+    MAX_TOTAL_CHARS = 6000  # 1メッセージ内の embed 合計文字数の上限
+
+    def __init__(self, window: float):
+        self.window = window
+        self._queues = {}   # channel_id -> asyncio.Queue
+        self._workers = {}  # channel_id -> 送信タスク
+
+    def send(self, channel_id, embed: Embed):
+        queue = self._queues.get(channel_id)
+        if queue is None:
+            queue = self._queues[channel_id] = asyncio.Queue()
+        worker = self._workers.get(channel_id)
+        if worker is None or worker.done():
+            self._workers[channel_id] = asyncio.get_running_loop().create_task(self._worker(channel_id, queue))
+        queue.put_nowait(embed)
+
+    async def _worker(self, channel_id, queue: asyncio.Queue):
+        # チャンネル毎に送信は常に1件ずつ。レート制限の待ちは discord.py 側のバケット管理に任せる
+        carry = None
+        while True:
+            embed = carry or await queue.get()
+            carry = None
+            await asyncio.sleep(self.window)
+            batch, total = [embed], len(embed)
+            while len(batch) < self.MAX_EMBEDS and not queue.empty():
+                nxt = queue.get_nowait()
+                if total + len(nxt) > self.MAX_TOTAL_CHARS:
+                    carry = nxt
+                    break
+                batch.append(nxt)
+                total += len(nxt)
+            channel = bot.get_channel(channel_id)
+            if channel is None:
+                continue
+            try:
+                with purchase_stage_seconds.time(stage="log_post"):
+                    await channel.send(embeds=batch)
+            except discord.HTTPException as e:
+                purchase_errors_total.inc(stage="log_post")
+                print(f"⚠️ ログ送信エラー: channel={channel_id}: {e}")
 
-    embed = message.embeds[0] if message.embeds else Embed()
-    embed.title = title
-    embed.description = description
+log_dispatcher = LogDispatcher(LOG_BATCH_WINDOW)
 
-    view = ui.View(timeout=None)
-    view.add_item(PurchaseButton(panel_id))
-    view.add_item(CheckStockButton(panel_id))
+async def update_panel(guild_id, panel_id):
+    panel_refresher.request(guild_id, panel_id)
 
-    await message.edit(embed=embed, view=view)
+def build_delivery_embed(item: dict, count: int, accounts) -> Embed:
+    embed = discord.Embed(title=f"{item.get('name','不明')} を {count}個 購入しました！", color=discord.Color.green())
 
-async def give_item_automatically(user, guild_id, item_id, count=1):
-    items = load_json(get_data_path(guild_id, "items.json"))
-    config = load_json(get_data_path(guild_id, "config.json"))
+    if accounts:
+        for idx, acc in enumerate(accounts, 1):
+            embed.add_field(name=f"[{idx}] メールアドレス", value=acc.get("email",""), inline=False)
+            embed.add_field(name=f"[{idx}] パスワード", value=acc.get("password",""), inline=False)
+    else:
+        if item.get("url"):
+            embed.description = f"[商品をクリック]({item.get('url')})"
+        else:
+            embed.description = "ご購入ありがとうございます！"
+    return embed
+
+def build_account_file(accounts, filename: str) -> discord.File:
+    # Excel でも文字化けしないよう BOM 付き UTF-8 の CSV にする
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["email", "password"])
+    for acc in accounts:
+        writer.writerow([acc.get("email", ""), acc.get("password", "")])
+    return discord.File(io.BytesIO(buf.getvalue().encode("utf-8-sig")), filename=filename)
+
+def build_delivery_messages(item: dict, count: int, accounts) -> list:
+    """DM で送るメッセージ（user.send の引数）のリスト。
+
+    アカウントが DELIVERY_ATTACHMENT_THRESHOLD 件以下なら従来どおり embed 1通、
+    それを超えるとメモリ上で作った CSV を添付し、ファイル数が多ければ複数のメッセージに分ける。
+    """
+    if not accounts or len(accounts) <= DELIVERY_ATTACHMENT_THRESHOLD:
+        return [{"embed": build_delivery_embed(item, count, accounts)}]
+    chunks = [accounts[i:i + DELIVERY_FILE_ACCOUNTS] for i in range(0, len(accounts), DELIVERY_FILE_ACCOUNTS)]
+    files = [build_account_file(chunk, f"accounts_{n}.csv" if len(chunks) > 1 else "accounts.csv") for n, chunk in enumerate(chunks, 1)]
+    groups = [files[i:i + DELIVERY_FILES_PER_MESSAGE] for i in range(0, len(files), DELIVERY_FILES_PER_MESSAGE)]
+    embed = discord.Embed(title=f"{item.get('name','不明')} を {count}個 購入しました！", description=f"アカウント {len(accounts)}件 を添付ファイル（CSV: email,password）でお送りします。", color=discord.Color.green())
+    if len(groups) > 1:
+        embed.set_footer(text=f"{len(groups)}通に分けて送信します")
+    messages = [{"embed": embed, "files": groups[0]}]
+    messages += [{"content": f"（{n} / {len(groups)}）", "files": group} for n, group in enumerate(groups[1:], 2)]
+    return messages
+
+async def send_purchase_dm(user, item: dict, count: int, accounts, sent_parts=(), on_part_sent=None):
+    """購入した商品を DM で送る。sent_parts に含まれるメッセージ番号は送信済みとして飛ばす（再試行用）"""
+    try:
+        with purchase_stage_seconds.time(stage="dm_delivery"):
+            for part, message in enumerate(build_delivery_messages(item, count, accounts)):
+                if part in sent_parts:
+                    continue
+                await user.send(**message)
+                if on_part_sent is not None:
+                    on_part_sent(part)
+    except discord.HTTPException:
+        purchase_errors_total.inc(stage="dm_delivery")
+        raise
+
+async def grant_reward_role(guild_id, panel_id, user_id):
     panels = load_json(get_data_path(guild_id, "panels.json"))
+    role_id = panels.get(panel_id, {}).get("reward_role")
+    if not role_id:
+        return
+    # 見つからないときは例外にして、配送ワーカーにこの手順を再試行させる（完了扱いにしない）
+    guild = bot.get_guild(guild_id)
+    if guild is None:
+        raise RuntimeError(f"サーバーが見つかりません: {guild_id}")
+    role = guild.get_role(role_id)
+    if role is None:
+        raise RuntimeError(f"付与するロールが見つかりません: {role_id}")
+    # メンバーをキャッシュしていない（省メモリモード・未チャンク）場合は API から取得する
+    member = guild.get_member(user_id)
+    if member is None:
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.NotFound:
+            return
+    try:
+        with purchase_stage_seconds.time(stage="role_grant"):
+            await member.add_roles(role, reason="商品購入によるロール付与")
+    except discord.Forbidden:
+        purchase_errors_total.inc(stage="role_grant")
+
+def post_purchase_log(guild_id, user, item: dict, count: int):
+    # ログ送信（購入処理を待たせないようキューに積むだけ）
+    config = load_json(get_data_path(guild_id, "config.json"))
+    if config.get("log_channel"):
+        log_embed = discord.Embed(title="🛒購入実績", description=f"{user.mention} が **{item.get('name','不明')}** を {count}個 購入しました！", color=discord.Color.blue())
+        log_embed.set_thumbnail(url=user.display_avatar.url)
+        log_dispatcher.send(config.get("log_channel"), log_embed)
 
-    item = items.get(item_id)
+def post_payment_log(guild_id, order: dict):
+    config = load_json(get_data_path(guild_id, "config.json"))
+    if config.get("pay_channel"):
+        payment = order["payment"]
+        log_embed = Embed(title="購入ログ", description=f"{payment['sender_name']} (PayPay ID: {payment['sender_id']}) が {order['item']['name']} x{order['count']} を購入しました。", color=discord.Color.blue())
+        log_embed.add_field(name="合計金額", value=f"¥{order['total_price']}")
+        log_embed.add_field(name="リンク", value=payment["link"], inline=False)
+        if payment.get("sender_icon"):
+            log_embed.set_thumbnail(url=payment["sender_icon"])
+        log_embed.set_footer(text=f"DiscordユーザーID: {order['buyer_id']}")
+        log_dispatcher.send(config.get("pay_channel"), log_embed)
+
+async def give_item_automatically(user, guild_id, item_id, count=1, reserved=None):
+    # reserved: 呼び出し側が item_store.consume で確保済みの在庫（None ならここで確保する）
+    item = item_store.get_item(guild_id, item_id)
     if not item:
         return False
 
     panel_id = item.get("panel_id")
-    role_id = panels.get(panel_id, {}).get("reward_role")
 
-    count = item.get("purchase_count", 1)
     try:
         count = int(count)
     except (ValueError, TypeError):
         count = 1
 
-    accounts_to_send = []
-
-    if "accounts" in item:
-        stock_data = item.get("accounts", [])
-        if len(stock_data) < count:
+    # 在庫の減算（アカウント型は先頭から取り出す）はバックエンド側でまとめて行う
+    accounts_to_send = reserved
+    if accounts_to_send is None:
+        accounts_to_send = item_store.consume(guild_id, item_id, count)
+        if accounts_to_send is None:
             return False
 
-        for _ in range(count):
-            acc = stock_data.pop(0)
-            accounts_to_send.append(acc)
-
-        item["accounts"] = stock_data
-        item["stock"] = len(stock_data)
-
-    else:
-        stock = item.get("stock")
-
-        if isinstance(stock, str):
-            if stock.isdigit():
-                stock = int(stock)
-                item["stock"] = stock
-            elif stock in ("∞", "∞️"):
-                pass
-            else:
-                return False
-
-        if isinstance(item.get("stock"), int):
-            if item["stock"] < count:
-                return False
-            item["stock"] = max(item["stock"] - count, 0)
-        elif item.get("stock") in ("∞", "∞️"):
-            pass
+    sent_parts = set()
+    try:
+        await send_purchase_dm(user, item, count, accounts_to_send, on_part_sent=sent_parts.add)
+    except discord.HTTPException:
+        if sent_parts:
+            # 一部のメッセージは届いているので、在庫に戻すと同じアカウントを二重に売ってしまう
+            print(f"⚠️ DM の一部だけ送信できました: user={user.id} item={item_id} sent={sorted(sent_parts)}")
         else:
-            return False
+            # 1通も届けられなかった在庫は戻す
+            item_store.release(guild_id, item_id, accounts_to_send, count)
+        return False
 
-    save_json(get_data_path(guild_id, "items.json"), items)
     await update_panel(guild_id, panel_id)
+    await grant_reward_role(guild_id, panel_id, user.id)
+    post_purchase_log(guild_id, user, item, count)
+    return True
 
-    embed = discord.Embed(title=f"{item.get('name','不明')} を {count}個 購入しました！", color=discord.Color.green())
+# 注文の配送。DM・ロール付与・パネル更新は互いに独立しているので並行して行い、購入ログは DM を送れてから出す。
+# 終わった手順は記録して、失敗した手順だけを間隔を空けて再試行する
+class OrderWorkerPool:
+    STEPS = ("dm", "role", "panel", "log", "pay_log")
+    AFTER_DM = ("log", "pay_log")  # 購入実績などの公開ログは DM を送り終えてから出す
+
+    def __init__(self, workers: int, max_attempts: int, retry_delay: float):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue = None
+        self._tasks = []
+        self._status = {}        # order_id -> 購入者への応答メッセージ（再起動後は無い）
+        self._outstanding = set()  # 配送待ち・再試行待ちの order_id
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def submit(self, order: dict, status_msg=None):
+        if status_msg is not None:
+            self._status[order["id"]] = status_msg
+        self._outstanding.add(order["id"])
+        orders_outstanding.set(len(self._outstanding))
+        self._idle.clear()
+        self._queue.put_nowait(order)
+
+    async def wait_idle(self):
+        await self._idle.wait()
+
+    def _settle(self, order: dict):
+        self._outstanding.discard(order["id"])
+        self._status.pop(order["id"], None)
+        orders_outstanding.set(len(self._outstanding))
+        if not self._outstanding:
+            self._idle.set()
+
+    async def _worker(self):
+        while True:
+            order = await self._queue.get()
+            # 接続前（起動直後・再接続中）はギルドやチャンネルのキャッシュが空なので、接続し終わるまで待つ
+            await bot.wait_until_ready()
+            try:
+                await self.process(order)
+            except Exception as e:
+                print(f"⚠️ 注文処理エラー: order={order['id']}: {e}")
+
+    async def _step(self, step: str, order: dict, user):
+        guild_id = order["guild_id"]
+        item = order["item"]
+        if step == "dm":
+            # 分割して送る大口注文は、送れたメッセージを記録して再試行時に送り直さない
+            sent_parts = {int(done[3:]) for done in order["done"] if done.startswith("dm:")}
+            await send_purchase_dm(user, item, order["count"], order["accounts"], sent_parts,
+                                   lambda part: order_queue.complete_step(guild_id, order["id"], f"dm:{part}"))
+        elif step == "role":
+            await grant_reward_role(guild_id, item.get("panel_id"), order["buyer_id"])
+        elif step == "panel":
+            await update_panel(guild_id, item.get("panel_id"))
+        elif step == "log":
+            post_purchase_log(guild_id, user, item, order["count"])
+        elif step == "pay_log":
+            post_payment_log(guild_id, order)
+
+    async def _run_steps(self, order: dict, user, steps: list, errors: list):
+        results = await asyncio.gather(*(self._step(step, order, user) for step in steps), return_exceptions=True)
+        for step, result in zip(steps, results):
+            if isinstance(result, Exception):
+                errors.append(f"{step}: {result}")
+            else:
+                order_queue.complete_step(order["guild_id"], order["id"], step)
 
-    if accounts_to_send:
-        for idx, acc in enumerate(accounts_to_send, 1):
-            embed.add_field(name=f"[{idx}] メールアドレス", value=acc.get("email",""), inline=False)
-            embed.add_field(name=f"[{idx}] パスワード", value=acc.get("password",""), inline=False)
-    else:
-        if item.get("url"):
-            embed.description = f"[商品をクリック]({item.get('url')})"
+    async def process(self, order: dict):
+        guild_id = order["guild_id"]
+        steps = [step for step in self.STEPS if step not in order["done"]]
+        errors = []
+        try:
+            with purchase_stage_seconds.time(stage="fetch_user"):
+                user = await bot.fetch_user(order["buyer_id"])
+        except Exception as e:
+            purchase_errors_total.inc(stage="fetch_user")
+            errors.append(f"fetch_user: {e}")
         else:
-            embed.description = "ご購入ありがとうございます！"
+            await self._run_steps(order, user, [step for step in steps if step not in self.AFTER_DM], errors)
+            # DM を送れていなければログは出さず、次の試行に回す
+            if "dm" in order["done"]:
+                await self._run_steps(order, user, [step for step in steps if step in self.AFTER_DM], errors)
+
+        if not errors:
+            order_queue.finish(guild_id, order["id"])
+            orders_total.inc(result="delivered")
+            await self._notify(order, Embed(title="商品送信完了", description=f"<@{order['buyer_id']}> に商品（{order['item']['name']} x{order['count']}）を送信しました。", color=discord.Color.green()))
+            self._settle(order)
+            return
 
-    try:
-        await user.send(embed=embed)
-    except discord.Forbidden:
-        return False
+        attempts = order_queue.record_attempt(guild_id, order["id"], "; ".join(errors))
+        if attempts >= self.max_attempts:
+            # 支払いは受け取っているので在庫は戻さず、管理者の対応を待つ
+            order_queue.finish(guild_id, order["id"], "failed")
+            orders_total.inc(result="failed")
+            print(f"⚠️ 注文の配送に失敗しました: guild={guild_id} order={order['id']}: {'; '.join(errors)}")
+            await self._notify(order, Embed(title="商品送信失敗", description=f"商品をDMに送る際に問題が発生しました。管理者にお問い合わせください。\n注文ID: `{order['id']}`", color=discord.Color.red()))
+            self._settle(order)
+            return
 
-    # ロール付与
-    if role_id:
-        guild = bot.get_guild(guild_id)
-        member = guild.get_member(user.id)
-        role = guild.get_role(role_id)
-        if member and role:
-            try:
-                await member.add_roles(role, reason="商品購入によるロール付与")
-            except discord.Forbidden:
-                pass
+        orders_total.inc(result="retry")
+        delay = min(self.retry_delay * 2 ** (attempts - 1), 600) * random.uniform(0.5, 1.5)
+        asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, order)
 
-    # ログ送信
-    log_channel = bot.get_channel(config.get("log_channel"))
-    if log_channel:
-        log_embed = discord.Embed(title="🛒購入実績", description=f"{user.mention} が **{item.get('name','不明')}** を {count}個 購入しました！", color=discord.Color.blue())
-        log_embed.set_thumbnail(url=user.display_avatar.url)
-        await log_channel.send(embed=log_embed)
+    async def _notify(self, order: dict, embed: Embed):
+        status_msg = self._status.get(order["id"])
+        if status_msg is None:
+            return
+        try:
+            await status_msg.edit(embed=embed)
+        except discord.HTTPException:
+            pass
 
-    return True
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(loop.create_task(self._resume()))
+
+    async def _resume(self):
+        # 前回の起動で終わらなかった注文を、接続してキャッシュが揃ってから再開する
+        await bot.wait_until_ready()
+        pending = order_queue.load_pending(owns_guild)
+        for order in pending:
+            self.submit(order)
+        if pending:
+            print(f"✅ 未配送の注文を再開しました: {len(pending)}件")
+
+order_queue = OrderQueue(state_store)
+sales_ledger = SalesLedger(state_store, hourly_retention=SALES_HOURLY_RETENTION_DAYS * 86400)
+order_workers = OrderWorkerPool(ORDER_WORKERS, ORDER_MAX_ATTEMPTS, ORDER_RETRY_DELAY)
+
+def record_sale(order: dict, ts: float = None):
+    """注文を売上に記録する（失敗しても配送は止めない）"""
+    try:
+        sales_ledger.record(order["guild_id"], order["item_id"], order["item"].get("panel_id"), order["count"], order["total_price"], order["buyer_id"], ts=ts)
+    except Exception as e:
+        print(f"⚠️ 売上の記録に失敗しました: order={order['id']}: {e}")
 
 def format_item_stock_display(item: dict) -> str:
-    if "accounts" in item and isinstance(item["accounts"], list):
+    if is_account_item(item):
         return str(item.get("stock", 0))
     if str(item.get("stock")) == "∞":
         return "∞"
@@ -474,16 +1204,12 @@ def format_item_stock_display(item: dict) -> str:
         return "在庫エラー"
 
 async def send_existing_panel(channel, guild_id, panel_id):
-    items = load_json(get_data_path(guild_id, "items.json"))
     panels = load_json(get_data_path(guild_id, "panels.json"))
 
     item_lines = []
-    count = 1
-    for item_id, item in items.items():
-        if item.get("panel_id") == panel_id:
-            description = item.get("description", "説明なし")
-            item_lines.append(f"**{count}. {item.get('name','不明')}**\n{description}\n価格: ¥{item.get('price',0)}")
-            count += 1
+    for count, item in enumerate(item_store.panel_items(guild_id, panel_id).values(), 1):
+        description = item.get("description", "説明なし")
+        item_lines.append(f"**{count}. {item.get('name','不明')}**\n{description}\n価格: ¥{item.get('price',0)}")
 
     title = panels.get(panel_id, {}).get("title", "自販機パネル")
     embed = Embed(title=title, description="\n".join(item_lines) if item_lines else "現在商品はありません", color=discord.Color.green())
@@ -500,13 +1226,13 @@ class AddItemModal(ui.Modal, title="商品を追加"):
 
     async def on_submit(self, interaction: Interaction):
         guild_id = interaction.guild_id
-        items = load_json(get_data_path(guild_id, "items.json"))
         panels = load_json(get_data_path(guild_id, "panels.json"))
+        if not panels:
+            await interaction.response.send_message("パネルが存在しません。先に /自販機パネル設置 で作成してください。", ephemeral=True)
+            return
 
-        select = ui.Select(placeholder="追加先パネルを選んでください", options=[discord.SelectOption(label=f"パネル {pid}", value=pid) for pid in panels])
-        async def callback(inner: Interaction):
-            panel_id = select.values[0]
-            item_id = f"{panel_id}_{len(items)+1}"
+        async def callback(inner: Interaction, panel_id):
+            item_id = item_store.allocate_item_id(guild_id, panel_id)
 
             try:
                 price = int(self.children[2].value.replace("円", "").strip())
@@ -519,7 +1245,7 @@ class AddItemModal(ui.Modal, title="商品を追加"):
                 await inner.response.send_message("値段は数字で、在庫は数字または「∞」で入力してください。", ephemeral=True)
                 return
 
-            items[item_id] = {
+            item = {
                 "panel_id": panel_id,
                 "name": self.children[1].value,
                 "price": price,
@@ -532,14 +1258,14 @@ class AddItemModal(ui.Modal, title="商品を追加"):
             if panel_title:
                 panels[panel_id]["title"] = panel_title
                 save_json(get_data_path(guild_id, "panels.json"), panels)
+                catalog_search.panel_changed(guild_id, panel_id, panels[panel_id])
 
-            save_json(get_data_path(guild_id, "items.json"), items)
+            item_store.put_item(guild_id, item_id, item)
+            catalog_search.item_changed(guild_id, item_id, item)
             await update_panel(guild_id, panel_id)
             await inner.response.send_message("商品とパネルタイトルを追加/更新しました", ephemeral=True)
 
-        select.callback = callback
-        view = ui.View()
-        view.add_item(select)
+        view = PagedSelectView([discord.SelectOption(label=f"パネル {pid}", value=pid) for pid in panels], "追加先パネルを選んでください", callback)
         await interaction.response.send_message("どのパネルに追加しますか？", view=view, ephemeral=True)
 
 class AddProductModal(ui.Modal, title="商品を追加"):
@@ -552,7 +1278,6 @@ class AddProductModal(ui.Modal, title="商品を追加"):
 
     async def on_submit(self, interaction: Interaction):
         guild_id = interaction.guild_id
-        items = load_json(get_data_path(guild_id, "items.json"))
 
         try:
             price = int(self.children[1].value.strip())
@@ -560,11 +1285,9 @@ class AddProductModal(ui.Modal, title="商品を追加"):
             await interaction.response.send_message("数値のみ入力してください", ephemeral=True)
             return
 
-        panel_items = [i for i in items if items[i].get("panel_id") == self.panel_id]
-        item_number = len(panel_items) + 1
-        item_id = f"{self.panel_id}_{item_number}"
+        item_id = item_store.allocate_item_id(guild_id, self.panel_id)
 
-        items[item_id] = {
+        item = {
             "panel_id": self.panel_id,
             "name": self.children[0].value,
             "price": price,
@@ -575,7 +1298,8 @@ class AddProductModal(ui.Modal, title="商品を追加"):
             "accounts": []
         }
 
-        save_json(get_data_path(guild_id, "items.json"), items)
+        item_store.put_item(guild_id, item_id, item)
+        catalog_search.item_changed(guild_id, item_id, item)
         await update_panel(guild_id, self.panel_id)
         await interaction.response.send_message("商品を追加しました（在庫は0）", ephemeral=True)
 
@@ -588,31 +1312,23 @@ class AccountStockModal(ui.Modal, title="アカウント在庫を追加"):
 
     async def on_submit(self, interaction: Interaction):
         guild_id = interaction.guild_id
-        items = load_json(get_data_path(guild_id, "items.json"))
 
-        item = items.get(self.item_id)
+        item = item_store.get_item(guild_id, self.item_id)
         if not item:
             await interaction.response.send_message("商品が見つかりませんでした。", ephemeral=True)
             return
 
-        if "accounts" not in item:
-            item["accounts"] = []
-
-        item["accounts"].append({
+        item_store.add_accounts(guild_id, self.item_id, [{
             "email": self.children[0].value,
             "password": self.children[1].value
-        })
-
-        item["stock"] = item.get("stock", 0) + 1
-
-        save_json(get_data_path(guild_id, "items.json"), items)
+        }])
         await update_panel(guild_id, item["panel_id"])
         await interaction.response.send_message("アカウント在庫を追加しました！", ephemeral=True)
 
 async def is_payment_confirmed(paypay: PayPay, link: str, price: int) -> bool:
     try:
         note = link.split("/")[-1]
-        transfers = paypay.search_transfer(note)
+        transfers = await run_paypay(None, paypay.search_transfer, note)
         for tx in transfers:
             if int(tx["amount"]) == price:
                 return True
@@ -632,15 +1348,19 @@ class PaypayRegisterModal(ui.Modal, title="PayPay-SMS認証URL入力"):
     async def on_submit(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
         try:
-            self.paypay.login(self.auth_link_input.value)
+            await run_paypay(self.guild_id, self.paypay.login, self.auth_link_input.value)
             config_path = get_data_path(self.guild_id, "config.json")
             config = load_json(config_path)
-            secret_key = os.getenv("TOKEN_ENCRYPT_KEY")
+            secret_key = get_encrypt_key()
             config["paypay_access_token"] = encrypt_token(self.paypay.access_token, secret_key)
             config["paypay_refresh_token"] = encrypt_token(self.paypay.refresh_token, secret_key)
+            config["paypay_token_refreshed_at"] = time.time()
             save_json(config_path, config)
+            secret_cache.invalidate(self.guild_id)
+            await state_store.flush_async()
+            paypay_pool.put(self.guild_id, self.paypay, config)
             await interaction.followup.send("PayPayログイン成功", ephemeral=True)
-        except PayPayLoginError:
+        except (PayPayLoginError, asyncio.TimeoutError):
             embed = discord.Embed(title="PayPayログインエラー", description="認証URLが正しいか確認してください。", color=discord.Color.red())
             await interaction.followup.send(embed=embed, ephemeral=True)
 
@@ -678,6 +1398,49 @@ class Paginator(ui.View):
             self.current += 1
             await self.update_message(interaction)
 
+# ------------------------
+# オートコンプリート（商品・パネル・チャンネル）
+# ------------------------
+def _choices(index: SearchIndex, keys) -> list:
+    return [app_commands.Choice(name=index.label(key)[:100], value=key) for key in keys]
+
+async def item_autocomplete(interaction: Interaction, current: str) -> list:
+    if interaction.guild_id is None:
+        return []
+    index = catalog_search.items(interaction.guild_id)
+    return _choices(index, index.search(current))
+
+async def account_item_autocomplete(interaction: Interaction, current: str) -> list:
+    if interaction.guild_id is None:
+        return []
+    guild_id = interaction.guild_id
+    index = catalog_search.items(guild_id)
+    return _choices(index, index.search(current, predicate=lambda item_id: is_account_item(item_store.get_item(guild_id, item_id) or {})))
+
+async def panel_autocomplete(interaction: Interaction, current: str) -> list:
+    if interaction.guild_id is None:
+        return []
+    index = catalog_search.panels(interaction.guild_id)
+    return _choices(index, index.search(current))
+
+ORDER_STATUS_LABELS = {"review": "要確認", "failed": "配送失敗"}
+
+async def order_autocomplete(interaction: Interaction, current: str) -> list:
+    if interaction.guild_id is None:
+        return []
+    choices = []
+    for order in order_queue.needs_review(interaction.guild_id):
+        label = f"{ORDER_STATUS_LABELS[order['status']]}｜{order['item']['name']} x{order['count']}｜{order['id']}"
+        if current in label:
+            choices.append(app_commands.Choice(name=label[:100], value=order["id"]))
+    return choices[:25]
+
+async def channel_autocomplete(interaction: Interaction, current: str) -> list:
+    if interaction.guild is None:
+        return []
+    index = catalog_search.channels(interaction.guild)
+    return _choices(index, index.search(current))
+
 # ------------------------
 # スラッシュコマンド（自販機 / 管理コマンド群）
 # ------------------------
@@ -700,13 +1463,10 @@ async def setpanel(interaction: Interaction):
             await i.response.send_modal(NewPanelModal())
         elif choice == "existing":
             panel_options = [discord.SelectOption(label=f"{panels[pid].get('title','自販機パネル')} (ID: {pid})", value=pid) for pid in panels]
-            panel_select = ui.Select(placeholder="再表示するパネルを選択", options=panel_options)
-            async def panel_callback(i2: Interaction):
-                await send_existing_panel(i2.channel, interaction.guild_id, panel_select.values[0])
+            async def panel_callback(i2: Interaction, panel_id):
+                await send_existing_panel(i2.channel, interaction.guild_id, panel_id)
                 await i2.response.send_message("パネルを再表示しました！", ephemeral=True)
-            panel_select.callback = panel_callback
-            view2 = ui.View()
-            view2.add_item(panel_select)
+            view2 = PagedSelectView(panel_options, "再表示するパネルを選択", panel_callback)
             await i.response.send_message("再表示するパネルを選んでください：", view=view2, ephemeral=True)
     select.callback = callback
     view = ui.View()
@@ -726,7 +1486,9 @@ async def additem(interaction: Interaction):
 
 @tree.command(name="実績報告設定", description="実績報告チャンネルを設定します")
 @app_commands.checks.has_permissions(administrator=True)
-async def setchannels(interaction: Interaction):
+@app_commands.describe(channel="実績報告チャンネル（省略すると一覧から選択）")
+@app_commands.autocomplete(channel=channel_autocomplete)
+async def setchannels(interaction: Interaction, channel: Optional[str] = None):
     guild = interaction.guild
     if guild is None:
         return
@@ -736,65 +1498,66 @@ async def setchannels(interaction: Interaction):
     guild_id = interaction.guild_id
     config_path = get_data_path(guild_id, "config.json")
     config = load_json(config_path)
-    channels = [discord.SelectOption(label=channel.name, value=str(channel.id)) for channel in guild.text_channels][:25]
-    select_log = ui.Select(placeholder="実績報告チャンネルを選んでください", options=channels)
-    async def log_selected_callback(log_interaction: Interaction):
-        config["log_channel"] = int(select_log.values[0])
+    async def log_selected_callback(log_interaction: Interaction, channel_id):
+        if not channel_id.isdigit() or not isinstance(guild.get_channel(int(channel_id)), discord.TextChannel):
+            await log_interaction.response.send_message("チャンネルが見つかりません。", ephemeral=True)
+            return
+        config["log_channel"] = int(channel_id)
         save_json(config_path, config)
         await log_interaction.response.send_message("実績報告チャンネルを設定しました！", ephemeral=True)
-    select_log.callback = log_selected_callback
-    view = ui.View()
-    view.add_item(select_log)
+    if channel:
+        await log_selected_callback(interaction, channel)
+        return
+    channels = [discord.SelectOption(label=ch.name, value=str(ch.id)) for ch in guild.text_channels]
+    view = PagedSelectView(channels, "実績報告チャンネルを選んでください", log_selected_callback)
     await interaction.response.send_message("実績報告チャンネルを選択してください", view=view, ephemeral=True)
 
 @tree.command(name="商品削除", description="商品を削除します（パネル→商品選択）")
 @app_commands.checks.has_permissions(administrator=True)
-async def deleteitem(interaction: Interaction):
+@app_commands.describe(item="削除する商品（省略するとパネルから選択）")
+@app_commands.autocomplete(item=item_autocomplete)
+async def deleteitem(interaction: Interaction, item: Optional[str] = None):
     guild_id = interaction.guild_id
-    items = load_json(get_data_path(guild_id, "items.json"))
+    async def item_selected(i2: Interaction, selected_item_id):
+        selected = item_store.get_item(guild_id, selected_item_id)
+        if selected is not None and item_store.delete_item(guild_id, selected_item_id):
+            catalog_search.item_removed(guild_id, selected_item_id)
+            await update_panel(guild_id, selected.get("panel_id"))
+            await i2.response.send_message("🗑️商品を削除しました。", ephemeral=True)
+        else:
+            await i2.response.send_message("商品が見つかりません。", ephemeral=True)
+    if item:
+        await item_selected(interaction, item)
+        return
     panels = load_json(get_data_path(guild_id, "panels.json"))
     panel_options = [discord.SelectOption(label=f"パネル {pid}", value=pid) for pid in panels]
     if not panel_options:
         await interaction.response.send_message("パネルが存在しません。", ephemeral=True)
         return
-    panel_select = ui.Select(placeholder="パネルを選択してください", options=panel_options)
-    async def panel_selected(i: Interaction):
-        selected_panel_id = panel_select.values[0]
-        item_options = [discord.SelectOption(label=item.get("name",""), value=item_id) for item_id, item in items.items() if item.get("panel_id") == selected_panel_id]
+    async def panel_selected(i: Interaction, selected_panel_id):
+        item_options = [discord.SelectOption(label=item.get("name",""), value=item_id) for item_id, item in item_store.panel_items(guild_id, selected_panel_id).items()]
         if not item_options:
             await i.response.send_message("商品がありません。", ephemeral=True)
             return
-        item_select = ui.Select(placeholder="削除する商品を選んでください", options=item_options)
-        async def item_selected(i2: Interaction):
-            selected_item_id = item_select.values[0]
-            if selected_item_id in items:
-                del items[selected_item_id]
-                save_json(get_data_path(guild_id, "items.json"), items)
-                await update_panel(guild_id, selected_panel_id)
-                await i2.response.send_message("🗑️商品を削除しました。", ephemeral=True)
-            else:
-                await i2.response.send_message("商品が見つかりません。", ephemeral=True)
-        item_select.callback = item_selected
-        view = ui.View()
-        view.add_item(item_select)
+        view = PagedSelectView(item_options, "削除する商品を選んでください", item_selected)
         await i.response.send_message("商品を選んでください", view=view, ephemeral=True)
-    panel_select.callback = panel_selected
-    view = ui.View()
-    view.add_item(panel_select)
+    view = PagedSelectView(panel_options, "パネルを選択してください", panel_selected)
     await interaction.response.send_message("パネルを選んでください", view=view, ephemeral=True)
 
 @tree.command(name="パネル削除", description="パネルを削除します")
 @app_commands.checks.has_permissions(administrator=True)
-async def delete_panel(interaction: Interaction):
+@app_commands.describe(panel="削除するパネル（省略すると一覧から選択）")
+@app_commands.autocomplete(panel=panel_autocomplete)
+async def delete_panel(interaction: Interaction, panel: Optional[str] = None):
     guild_id = interaction.guild_id
     panels = load_json(get_data_path(guild_id, "panels.json"))
-    items = load_json(get_data_path(guild_id, "items.json"))
     if not panels:
         await interaction.response.send_message("削除可能なパネルが存在しません。", ephemeral=True)
         return
-    select = ui.Select(placeholder="削除するパネルを選んでください", options=[discord.SelectOption(label=f"{panels[pid].get('title','自販機パネル')}（ID: {pid}）", value=pid) for pid in panels])
-    async def callback(i: Interaction):
-        selected_id = select.values[0]
+    async def callback(i: Interaction, selected_id):
+        if selected_id not in panels:
+            await i.response.send_message("パネルが見つかりません。", ephemeral=True)
+            return
         channel = bot.get_channel(panels[selected_id]["channel"])
         try:
             msg = await channel.fetch_message(int(selected_id))
@@ -802,15 +1565,109 @@ async def delete_panel(interaction: Interaction):
         except Exception:
             pass
         del panels[selected_id]
-        items = {k: v for k, v in items.items() if v.get("panel_id") != selected_id}
+        deleted_item_ids = item_store.delete_panel_items(guild_id, selected_id)
+        panel_refresher.forget(guild_id, selected_id)
+        panel_render_cache.forget(guild_id, selected_id)
+        catalog_search.panel_removed(guild_id, selected_id)
+        catalog_search.item_removed(guild_id, *deleted_item_ids)
         save_json(get_data_path(guild_id, "panels.json"), panels)
-        save_json(get_data_path(guild_id, "items.json"), items)
         await i.response.send_message(f"パネルと関連商品を削除しました（ID: {selected_id}）", ephemeral=True)
-    select.callback = callback
-    view = ui.View()
-    view.add_item(select)
+    if panel:
+        await callback(interaction, panel)
+        return
+    view = PagedSelectView([discord.SelectOption(label=f"{panels[pid].get('title','自販機パネル')}（ID: {pid}）", value=pid) for pid in panels], "削除するパネルを選んでください", callback)
     await interaction.response.send_message("削除するパネルを選んでください：", view=view, ephemeral=True)
 
+@tree.command(name="売上", description="期間内の売上をパネル別・商品別に表示します")
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(days="集計する日数（今日を含む過去○日）", group="集計の単位")
+@app_commands.choices(group=[app_commands.Choice(name="パネル別", value="panels"), app_commands.Choice(name="商品別", value="items")])
+async def sales(interaction: Interaction, days: app_commands.Range[int, 1, 3650] = 7, group: str = "panels"):
+    guild = interaction.guild
+    if guild is None:
+        return
+    if not interaction.user or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("このコマンドは管理者のみ実行可能です。", ephemeral=True)
+        return
+    guild_id = interaction.guild_id
+    now = time.time()
+    # 今日の0時から (days - 1) 日前の0時まで遡る
+    start = sales_ledger.day_bucket(now) - (days - 1) * 86400
+    totals = sales_ledger.query(guild_id, start, now + 1, group)
+    if not totals:
+        await interaction.response.send_message(f"📭 過去{days}日間の売上はありません。", ephemeral=True)
+        return
+
+    if group == "panels":
+        panels = load_json(get_data_path(guild_id, "panels.json"))
+        name_of = lambda key: panels[key].get("title", "自販機パネル") if key in panels else f"削除済みパネル（ID: {key}）"
+    else:
+        name_of = lambda key: (item_store.get_item(guild_id, key) or {}).get("name", f"削除済み商品（ID: {key}）")
+
+    units = sum(c[0] for c in totals.values())
+    revenue = sum(c[1] for c in totals.values())
+    orders = sum(c[2] for c in totals.values())
+    embed = Embed(title=f"📈 売上（過去{days}日・{'パネル別' if group == 'panels' else '商品別'}）", description=f"売上合計: **¥{revenue:,}**｜注文: {orders}件｜個数: {units}個", color=discord.Color.gold())
+    ranked = sorted(totals.items(), key=lambda kv: kv[1][1], reverse=True)
+    for key, (count, amount, order_count) in ranked[:20]:
+        embed.add_field(name=name_of(key)[:256], value=f"¥{amount:,}｜{order_count}件｜{count}個", inline=False)
+    if len(ranked) > 20:
+        embed.set_footer(text=f"ほか {len(ranked) - 20}件")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@tree.command(name="注文確認", description="支払いの確認が必要な注文・配送に失敗した注文を表示し、配送または取り消しを行います")
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(order="対象の注文（省略すると一覧を表示）", action="注文に対して行う操作")
+@app_commands.choices(action=[app_commands.Choice(name="配送する（支払いを確認済み）", value="deliver"), app_commands.Choice(name="取り消す（在庫を戻す）", value="cancel")])
+@app_commands.autocomplete(order=order_autocomplete)
+async def review_orders(interaction: Interaction, order: Optional[str] = None, action: Optional[str] = None):
+    guild = interaction.guild
+    if guild is None:
+        return
+    if not interaction.user or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("このコマンドは管理者のみ実行可能です。", ephemeral=True)
+        return
+    guild_id = interaction.guild_id
+    if order is None:
+        orders = order_queue.needs_review(guild_id)
+        if not orders:
+            await interaction.response.send_message("📭 対応が必要な注文はありません。", ephemeral=True)
+            return
+        embed = Embed(title="対応が必要な注文", color=discord.Color.orange())
+        for o in orders[:20]:
+            value = f"<@{o['buyer_id']}>｜¥{o['total_price']:,}｜<t:{int(o['created_at'])}:f>"
+            if o.get("last_error"):
+                value += f"\n```{o['last_error'][:200]}```"
+            embed.add_field(name=f"{ORDER_STATUS_LABELS[o['status']]}｜{o['item']['name']} x{o['count']}｜{o['id']}"[:256], value=value, inline=False)
+        if len(orders) > 20:
+            embed.set_footer(text=f"ほか {len(orders) - 20}件")
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+
+    target = order_queue.get(guild_id, order)
+    if target is None or target["status"] not in ORDER_STATUS_LABELS:
+        await interaction.response.send_message("対応が必要な注文が見つかりません。", ephemeral=True)
+        return
+    if action is None:
+        await interaction.response.send_message("操作（配送する / 取り消す）を選んでください。", ephemeral=True)
+        return
+    if action == "deliver":
+        if target["status"] == "review":
+            # 支払いを確認できたので売上に計上する
+            record_sale(target, ts=target["created_at"])
+        order_workers.submit(order_queue.reopen(guild_id, order))
+        await interaction.response.send_message(f"注文 `{order}` の配送を開始しました。", ephemeral=True)
+        return
+    # 取り消し: DM を1通も送っていなければ確保した在庫を戻す
+    if not any(step.startswith("dm") for step in target["done"]):
+        item_store.release(guild_id, target["item_id"], target["accounts"], target["count"])
+        await update_panel(guild_id, target["item"].get("panel_id"))
+        released = "確保していた在庫を戻しました。"
+    else:
+        released = "商品の一部を送信済みのため、在庫は戻していません。"
+    order_queue.finish(guild_id, order, "cancelled")
+    await interaction.response.send_message(f"注文 `{order}` を取り消しました。{released}", ephemeral=True)
+
 @tree.command(name="パネル一覧", description="このサーバーの自販機パネル一覧を表示")
 async def listpanels(interaction: Interaction):
     guild = interaction.guild
@@ -821,19 +1678,21 @@ async def listpanels(interaction: Interaction):
         return
     guild_id = interaction.guild_id
     panels = load_json(get_data_path(guild_id, "panels.json"))
-    items = load_json(get_data_path(guild_id, "items.json"))
     if not panels:
         await interaction.response.send_message("📭 パネルが存在しません。", ephemeral=True)
         return
     embed = Embed(title="パネル一覧", color=discord.Color.orange())
+    panel_counts = item_store.panel_counts(guild_id)
     for panel_id, info in panels.items():
-        count = sum(1 for i in items.values() if i.get("panel_id") == panel_id)
+        count = panel_counts.get(panel_id, 0)
         embed.add_field(name=f"パネルID: {panel_id}", value=f"商品数: {count}｜チャンネルID: {info.get('channel')}", inline=False)
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @tree.command(name="アカウント型商品追加", description="商品をパネルに追加します")
 @app_commands.checks.has_permissions(administrator=True)
-async def add_product(interaction: Interaction):
+@app_commands.describe(panel="商品を追加するパネル（省略すると一覧から選択）")
+@app_commands.autocomplete(panel=panel_autocomplete)
+async def add_product(interaction: Interaction, panel: Optional[str] = None):
     guild = interaction.guild
     if guild is None:
         return
@@ -845,17 +1704,22 @@ async def add_product(interaction: Interaction):
     if not panels:
         await interaction.response.send_message("パネルが存在しません。先に /自販機パネル設置 で作成してください。", ephemeral=True)
         return
-    select = ui.Select(placeholder="パネルを選択してください", options=[discord.SelectOption(label=f"パネル {pid}", value=pid) for pid in panels])
-    async def callback(i: Interaction):
-        await i.response.send_modal(AddProductModal(select.values[0]))
-    select.callback = callback
-    view = ui.View()
-    view.add_item(select)
+    async def callback(i: Interaction, panel_id):
+        if panel_id not in panels:
+            await i.response.send_message("パネルが見つかりません。", ephemeral=True)
+            return
+        await i.response.send_modal(AddProductModal(panel_id))
+    if panel:
+        await callback(interaction, panel)
+        return
+    view = PagedSelectView([discord.SelectOption(label=f"パネル {pid}", value=pid) for pid in panels], "パネルを選択してください", callback)
     await interaction.response.send_message("商品を追加するパネルを選んでください", view=view, ephemeral=True)
 
 @tree.command(name="アカウント在庫追加", description="アカウント型商品の在庫を追加します")
 @app_commands.checks.has_permissions(administrator=True)
-async def add_stock(interaction: Interaction):
+@app_commands.describe(item="在庫を追加する商品（省略するとパネルから選択）")
+@app_commands.autocomplete(item=account_item_autocomplete)
+async def add_stock(interaction: Interaction, item: Optional[str] = None):
     guild = interaction.guild
     if guild is None:
         return
@@ -863,30 +1727,104 @@ async def add_stock(interaction: Interaction):
         await interaction.response.send_message("このコマンドは管理者のみ実行可能です。", ephemeral=True)
         return
     guild_id = interaction.guild_id
-    items = load_json(get_data_path(guild_id, "items.json"))
+    async def item_selected_callback(item_interaction: Interaction, selected_item_id):
+        if item_store.get_item(guild_id, selected_item_id) is None:
+            await item_interaction.response.send_message("商品が見つかりません。", ephemeral=True)
+            return
+        await item_interaction.response.send_modal(AccountStockModal(selected_item_id))
+    if item:
+        await item_selected_callback(interaction, item)
+        return
     panels = load_json(get_data_path(guild_id, "panels.json"))
     panel_options = [discord.SelectOption(label=f"パネル {pid}", value=pid) for pid in panels]
     if not panel_options:
         await interaction.response.send_message("パネルが存在しません。", ephemeral=True)
         return
-    panel_select = ui.Select(placeholder="パネルを選んでください", options=panel_options)
-    async def panel_selected_callback(panel_interaction: Interaction):
-        selected_panel_id = panel_select.values[0]
-        item_options = [discord.SelectOption(label=item.get("name",""), value=item_id) for item_id, item in items.items() if item.get("panel_id") == selected_panel_id]
+    async def panel_selected_callback(panel_interaction: Interaction, selected_panel_id):
+        item_options = [discord.SelectOption(label=item.get("name",""), value=item_id) for item_id, item in item_store.panel_items(guild_id, selected_panel_id).items()]
         if not item_options:
             await panel_interaction.response.send_message("このパネルには商品がありません。", ephemeral=True)
             return
-        item_select = ui.Select(placeholder="在庫を追加する商品を選択", options=item_options)
-        async def item_selected_callback(item_interaction: Interaction):
-            selected_item_id = item_select.values[0]
-            await item_interaction.response.send_modal(AccountStockModal(selected_item_id))
-        item_select.callback = item_selected_callback
-        view = ui.View()
-        view.add_item(item_select)
+        view = PagedSelectView(item_options, "在庫を追加する商品を選択", item_selected_callback)
         await panel_interaction.response.send_message("商品を選んでください", view=view, ephemeral=True)
-    panel_select.callback = panel_selected_callback
-    view = ui.View()
-    view.add_item(panel_select)
+    view = PagedSelectView(panel_options, "パネルを選んでください", panel_selected_callback)
+    await interaction.response.send_message("パネルを選んでください", view=view, ephemeral=True)
+
+async def import_account_stock(guild_id, item_id, data: bytes):
+    """アップロードされたファイルを1行ずつ読み、既存在庫と重複しないアカウントをまとめて追加する。
+
+    (追加数, 重複数, 不正行数) を返す。
+    """
+    seen = {acc.get("email") for acc in item_store.account_stock(guild_id, item_id)}
+    accepted = duplicate = malformed = 0
+    chunk = []
+    lines = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", errors="replace")
+    for _, account in parse_account_lines(lines):
+        if account is None:
+            malformed += 1
+            continue
+        if account["email"] in seen:
+            duplicate += 1
+            continue
+        seen.add(account["email"])
+        chunk.append(account)
+        if len(chunk) >= BULK_IMPORT_CHUNK:
+            item_store.add_accounts(guild_id, item_id, chunk)
+            accepted += len(chunk)
+            chunk = []
+            await asyncio.sleep(0)
+    if chunk:
+        item_store.add_accounts(guild_id, item_id, chunk)
+        accepted += len(chunk)
+    return accepted, duplicate, malformed
+
+@tree.command(name="アカウント在庫一括追加", description="ファイル（CSV / TSV / email:password）からアカウント在庫をまとめて追加します")
+@app_commands.checks.has_permissions(administrator=True)
+@app_commands.describe(file="1行に1アカウントのファイル（CSV / TSV / email:password）", item="在庫を追加する商品（省略するとパネルから選択）")
+@app_commands.autocomplete(item=account_item_autocomplete)
+async def bulk_add_stock(interaction: Interaction, file: discord.Attachment, item: Optional[str] = None):
+    guild = interaction.guild
+    if guild is None:
+        return
+    if not interaction.user or not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("このコマンドは管理者のみ実行可能です。", ephemeral=True)
+        return
+    if file.size > BULK_IMPORT_MAX_BYTES:
+        await interaction.response.send_message(f"ファイルが大きすぎます（上限 {BULK_IMPORT_MAX_BYTES // (1024 * 1024)}MB）。", ephemeral=True)
+        return
+    guild_id = interaction.guild_id
+    async def item_selected_callback(item_interaction: Interaction, selected_item_id):
+        selected = item_store.get_item(guild_id, selected_item_id)
+        if selected is None or not is_account_item(selected):
+            await item_interaction.response.send_message("アカウント型商品が見つかりません。", ephemeral=True)
+            return
+        await item_interaction.response.defer(ephemeral=True, thinking=True)
+        try:
+            data = await file.read()
+        except discord.HTTPException as e:
+            await item_interaction.followup.send(f"ファイルの取得に失敗しました: {e}", ephemeral=True)
+            return
+        accepted, duplicate, malformed = await import_account_stock(guild_id, selected_item_id, data)
+        # 書き込みとパネル更新は最後に1回だけ
+        await state_store.flush_async()
+        await update_panel(guild_id, selected.get("panel_id"))
+        await item_interaction.followup.send(f"アカウント在庫を追加しました。\n追加: {accepted}件｜重複: {duplicate}件｜不正な行: {malformed}件", ephemeral=True)
+    if item:
+        await item_selected_callback(interaction, item)
+        return
+    panels = load_json(get_data_path(guild_id, "panels.json"))
+    panel_options = [discord.SelectOption(label=f"パネル {pid}", value=pid) for pid in panels]
+    if not panel_options:
+        await interaction.response.send_message("パネルが存在しません。", ephemeral=True)
+        return
+    async def panel_selected_callback(panel_interaction: Interaction, selected_panel_id):
+        item_options = [discord.SelectOption(label=item.get("name",""), value=item_id) for item_id, item in item_store.panel_items(guild_id, selected_panel_id).items() if is_account_item(item)]
+        if not item_options:
+            await panel_interaction.response.send_message("このパネルにはアカウント型商品がありません。", ephemeral=True)
+            return
+        view = PagedSelectView(item_options, "在庫を追加する商品を選択", item_selected_callback)
+        await panel_interaction.response.send_message("商品を選んでください", view=view, ephemeral=True)
+    view = PagedSelectView(panel_options, "パネルを選んでください", panel_selected_callback)
     await interaction.response.send_message("パネルを選んでください", view=view, ephemeral=True)
 
 @tree.command(name="paypay登録", description="PayPayのアカウント情報を登録します")
@@ -898,8 +1836,8 @@ async def paypay_register(interaction: discord.Interaction, phone: str, password
         return
     await interaction.response.defer(ephemeral=True)
     try:
-        paypay = PayPay(phone, password)
-    except PayPayLoginError:
+        paypay = await run_paypay(interaction.guild_id, PayPay, phone, password)
+    except (PayPayLoginError, asyncio.TimeoutError):
         embed = discord.Embed(title="PayPayログインエラー", description="電話番号・パスワードが合っているか確認してください。", color=discord.Color.red())
         await interaction.followup.send(embed=embed)
         return
@@ -912,18 +1850,12 @@ async def paypay_register(interaction: discord.Interaction, phone: str, password
 # ------------------------
 @bot.event
 async def on_ready():
+    global activity_task
     print(f"✅ ログイン完了: {bot.user}（ID: {bot.user.id}）")
 
-    # ギルド毎のパネル／ボタン再登録（既存パネルがあれば view を再登録）
-    for guild in bot.guilds:
-        guild_id = guild.id
-        panels = load_json(get_data_path(guild_id, "panels.json"))
-        for panel_id in panels:
-            view = ui.View(timeout=None)
-            view.add_item(PurchaseButton(panel_id))
-            view.add_item(CheckStockButton(panel_id))
-            bot.add_view(view)
-    print("✅ 自販機パネルのボタンを再登録しました。")
+    # on_ready は再接続のたびに呼ばれるので、以下は初回だけ行う
+    if activity_task is not None and not activity_task.done():
+        return
 
     # 起動完了メッセージ（任意のチャンネルが設定されていれば送信）
     if DISCORD_CHANNEL:
@@ -935,85 +1867,164 @@ async def on_ready():
                 pass
 
     # アクティビティ更新タスク
-    bot.loop.create_task(update_activity())
+    activity_task = bot.loop.create_task(update_activity())
 
 # ------------------------
 # setup_hook：チケット永続化・Cogロード・コマンド同期（ここで sync する）
 # ------------------------
-@bot.event
-async def setup_hook():
-    # チケット永続化（ticket_view_config.json があれば再登録）
-    try:
-        if os.path.exists("ticket_view_config.json"):
-            with open("ticket_view_config.json", "r", encoding="utf-8") as f:
-                config = json.load(f)
-
-            log_channel = bot.get_channel(config.get("log_channel"))
-            category = bot.get_channel(config.get("category")) if config.get("category") else None
-            staff_role = None
-            if log_channel and config.get("staff_role"):
-                staff_role = log_channel.guild.get_role(config.get("staff_role"))
-            ticket_limit = config.get("ticket_limit", 1)
-            open_message = config.get("open_message", "サポートチケットが作成されました。")
-
-            bot.add_view(TicketView(log_channel, category, staff_role, ticket_limit, open_message))
-            print("✅ チケットボタンを再登録しました。")
-        else:
-            print("ℹ️ 初回起動: ticket_view_config.json がありません。")
-    except Exception as e:
-        print(f"⚠️ チケット永続化エラー: {e}")
+COMMAND_TREE_HASH_PATH = os.path.join(BASE_DATA_DIR, "command_tree.hash")
+startup_timings = {}  # 起動フェーズ名 -> 所要時間（秒）
 
-    # Cog（拡張）をロード
+@contextlib.contextmanager
+def startup_phase(name: str):
+    started = time.perf_counter()
     try:
-        # ticket と 認証 はファイル名（拡張名）に応じて import される想定
-        await bot.load_extension("ticket")
-        await bot.load_extension("認証")
-        await bot.load_extension("embed")  
-        await bot.load_extension("参加ログ")
-        await bot.load_extension("vending_giveaway_stats")
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - started
+
+def register_ticket_view():
+    if not os.path.exists("ticket_view_config.json"):
+        print("ℹ️ 初回起動: ticket_view_config.json がありません。")
+        return
+    with open("ticket_view_config.json", "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    log_channel = bot.get_channel(config.get("log_channel"))
+    category = bot.get_channel(config.get("category")) if config.get("category") else None
+    staff_role = None
+    if log_channel and config.get("staff_role"):
+        staff_role = log_channel.guild.get_role(config.get("staff_role"))
+    ticket_limit = config.get("ticket_limit", 1)
+    open_message = config.get("open_message", "サポートチケットが作成されました。")
+
+    bot.add_view(TicketView(log_channel, category, staff_role, ticket_limit, open_message))
+    print("✅ チケットボタンを再登録しました。")
+
+async def load_extension_timed(name: str) -> bool:
+    # 1つ失敗しても他の拡張のロードは続ける（再接続時はロード済みなので何もしない）
+    if name in bot.extensions:
+        return True
+    with startup_phase(f"拡張: {name}"):
+        try:
+            await bot.load_extension(name)
+            return True
+        except Exception as e:
+            print(f"⚠️ Cogロードエラー（{name}）: {e}")
+            return False
 
+def command_tree_hash() -> str:
+    payload = {
+        "application_id": bot.application_id,
+        "commands": sorted((cmd.to_dict(tree) for cmd in tree.get_commands()), key=lambda c: (c.get("type", 1), c["name"])),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+async def sync_command_tree():
+    # コマンド定義が前回の同期から変わっていなければ sync しない（FORCE_COMMAND_SYNC=1 で強制）
+    # コマンドはアプリケーション全体で共通なので、同期するのはクラスタ 0 だけ
+    if CLUSTER_ID != 0:
+        return
+    digest = command_tree_hash()
+    previous = None
+    if os.path.exists(COMMAND_TREE_HASH_PATH):
+        with open(COMMAND_TREE_HASH_PATH, "r", encoding="utf-8") as f:
+            previous = f.read().strip()
+    if digest == previous and os.getenv("FORCE_COMMAND_SYNC") != "1":
+        print("✅ スラッシュコマンドに変更がないため同期を省略しました。")
+        return
+    synced = await bot.tree.sync()
+    os.makedirs(BASE_DATA_DIR, exist_ok=True)
+    with open(COMMAND_TREE_HASH_PATH, "w", encoding="utf-8") as f:
+        f.write(digest)
+    print(f"✅ スラッシュコマンド同期完了: {len(synced)}件")
 
+@bot.event
+async def setup_hook():
+    # スーパーバイザーが再接続するたびに呼ばれる。バックグラウンド処理の開始は多重起動しないので、
+    # ここでは bot.clear() で消える View の登録などをやり直すだけになる
+    started = time.perf_counter()
+    startup_timings.clear()
+
+    # ギルドデータの書き戻しループ / PayPay トークンの定期更新 / 使用済みリンクの整理
+    with startup_phase("バックグラウンド処理"):
+        state_store.start()
+        paypay_pool.start()
+        used_links.start()
+        order_workers.start()
+
+        # 自販機パネルのボタン（purchase:/stock:）はまとめて1つのハンドラで受ける
+        bot.add_dynamic_items(PanelButton)
+
+        # 計測: イベントループの遅延と /metrics エンドポイント
+        metrics.start_loop_lag_monitor(event_loop_lag_seconds)
+        if METRICS_PORT:
+            try:
+                await metrics.serve(METRICS_HOST, METRICS_PORT + CLUSTER_ID)
+                print(f"✅ 計測エンドポイント: http://{METRICS_HOST}:{METRICS_PORT + CLUSTER_ID}/metrics")
+            except OSError as e:
+                print(f"⚠️ 計測エンドポイントの起動に失敗しました: {e}")
 
+    # チケット永続化（ticket_view_config.json があれば再登録）
+    with startup_phase("チケット永続化"):
+        try:
+            register_ticket_view()
+        except Exception as e:
+            print(f"⚠️ チケット永続化エラー: {e}")
 
-        print("✅ ticket と 認証 の Cog をロードしました。")
-    except Exception as e:
-        print(f"⚠️ Cogロードエラー: {e}")
+    # Cog（拡張）を並行してロード
+    with startup_phase("拡張ロード"):
+        results = await asyncio.gather(*(load_extension_timed(name) for name in EXTENSIONS))
+    print(f"✅ Cog をロードしました（{sum(results)} / {len(EXTENSIONS)}）。")
 
     # スラッシュコマンド同期（ここで行う）
-    try:
-        synced = await bot.tree.sync()
-        print(f"✅ スラッシュコマンド同期完了: {len(synced)}件")
-    except Exception as e:
-        print(f"⚠️ スラッシュコマンド同期エラー: {e}")
-
+    with startup_phase("コマンド同期"):
+        try:
+            await sync_command_tree()
+        except Exception as e:
+            print(f"⚠️ スラッシュコマンド同期エラー: {e}")
 
-    try:
-        if os.path.exists("ticket_view_config.json"):
-            with open("ticket_view_config.json", "r", encoding="utf-8") as f:
-                config = json.load(f)
-
-            log_channel = bot.get_channel(config["log_channel"])
-            category = bot.get_channel(config["category"]) if config["category"] else None
-            staff_role = log_channel.guild.get_role(config["staff_role"]) if config["staff_role"] else None
-            ticket_limit = config["ticket_limit"]
-            open_message = config["open_message"]
-
-            bot.add_view(TicketView(log_channel, category, staff_role, ticket_limit, open_message))
-            print("✅ チケット作成ボタンを永続化しました。")
-        else:
-            print("ℹ️ ticket_view_config.json が存在しません。初回起動です。")
-    except Exception as e:
-        print(f"⚠️ チケットViewの永続化に失敗しました: {e}")
+    startup_timings["合計"] = time.perf_counter() - started
+    print("⏱️ 起動時間: " + " / ".join(f"{name} {elapsed * 1000:.0f}ms" for name, elapsed in startup_timings.items()))
 
 # ------------------------
 # プレイ中のステータス更新
 # ------------------------
+activity_task = None
+
+def cluster_totals():
+    """全クラスタのサーバー数・ユーザー数の合計。
+
+    各クラスタが自分の集計を cluster_stats/<CLUSTER_ID>.json に書き、他のクラスタの分はファイルを読むだけで済ませる。
+    更新が止まった（2時間以上古い）クラスタの分は数えない。
+    """
+    guild_count = len(bot.guilds)
+    member_count = sum(g.member_count or 0 for g in bot.guilds)
+    if CLUSTER_COUNT <= 1:
+        return guild_count, member_count
+    os.makedirs(CLUSTER_STATS_DIR, exist_ok=True)
+    now = time.time()
+    own_path = os.path.join(CLUSTER_STATS_DIR, f"{CLUSTER_ID}.json")
+    tmp_path = own_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"guilds": guild_count, "members": member_count, "updated_at": now}, f)
+    os.replace(tmp_path, own_path)
+    for name in os.listdir(CLUSTER_STATS_DIR):
+        if not name.endswith(".json") or name == f"{CLUSTER_ID}.json":
+            continue
+        try:
+            with open(os.path.join(CLUSTER_STATS_DIR, name), "r", encoding="utf-8") as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if now - stats.get("updated_at", 0) < 7200:
+            guild_count += stats.get("guilds", 0)
+            member_count += stats.get("members", 0)
+    return guild_count, member_count
+
 async def update_activity():
     while True:
-        now = datetime.now()
-        hour = now.hour
-        guild_count = len(bot.guilds)
-        member_count = sum(g.member_count for g in bot.guilds)
+        guild_count, member_count = cluster_totals()
         activity = discord.Game(f"サーバー数: {guild_count} | ユーザー数: {member_count}")
         try:
             await bot.change_presence(activity=activity)
@@ -1021,12 +2032,114 @@ async def update_activity():
             pass
         await asyncio.sleep(3600)
 
-if __name__ == "__main__":
+# ------------------------
+# スーパーバイザー（同じプロセス内で再接続し、メモリ上のデータやキャッシュを保つ）
+# ------------------------
+full_restart_requested = False
+shutdown_requested = False
+supervisor_connected = False        # login() 〜 close までの間 True
+supervisor_wakeup = asyncio.Event()  # 再接続待ちの sleep を途中で起こす
+
+async def close_connection():
+    """Gateway と HTTP セッションを閉じる（commands.Bot.close と違って拡張機能・Cog はアンロードしない）"""
+    await super(commands.bot.BotBase, bot).close()
+
+def reset_connection():
+    """close_connection() の後、次の login() で接続し直せる状態に戻す（永続ビューは残す）"""
+    # bot.clear() はビューの登録（ViewStore）も作り直してしまうので、同じ処理を views=False で個別に行う
+    bot._closing_task = None
+    if bot._ready is not discord.utils.MISSING:
+        bot._ready.clear()
+    bot._connection.clear(views=False)
+    bot.http.clear()
+    # http.close() はセッションと一緒にコネクタも閉じるが clear() では戻らないので、次の login() で作り直させる
+    bot.http.connector = discord.utils.MISSING
+
+def _interrupt():
+    supervisor_wakeup.set()
+    if supervisor_connected:
+        asyncio.get_running_loop().create_task(close_connection())
+
+def request_restart(full: bool = False):
+    """再接続を要求する。full=True ならプロセスごと再起動する"""
+    global full_restart_requested
+    full_restart_requested = full_restart_requested or full
+    _interrupt()
+
+def request_shutdown():
+    global shutdown_requested
+    shutdown_requested = True
+    _interrupt()
+
+@tree.command(name="再起動", description="Botを再接続します（Botのオーナーのみ）")
+@app_commands.describe(full="プロセスごと再起動する")
+async def restart_bot(interaction: Interaction, full: bool = False):
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("このコマンドはBotのオーナーのみ実行可能です。", ephemeral=True)
+        return
+    await interaction.response.send_message("プロセスごと再起動します。" if full else "再接続します。", ephemeral=True)
+    request_restart(full)
+
+async def supervise() -> bool:
+    """Bot を動かし続ける。プロセスごと再起動すべきときは True を返す"""
+    global supervisor_connected
+    loop = asyncio.get_running_loop()
+    # SIGHUP: 再接続 / SIGUSR1: プロセスごと再起動 / SIGTERM: 終了（Windows では使えないので無視する）
+    for name, handler in (("SIGHUP", request_restart), ("SIGUSR1", lambda: request_restart(full=True)), ("SIGTERM", request_shutdown)):
+        if hasattr(signal, name):
+            try:
+                loop.add_signal_handler(getattr(signal, name), handler)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+    failures = 0
     while True:
+        supervisor_wakeup.clear()
+        supervisor_connected = True
         try:
-            bot.run("")
+            await bot.login(TOKEN)
+            await bot.connect(reconnect=True)
+        except discord.LoginFailure:
+            print("❌ ログインに失敗しました。BOT_TOKEN を確認してください。")
+            return False
         except Exception as e:
             print(f"\n[⚠️ Botがエラーで停止しました] {e}")
-            print("3秒後に完全再起動します...")
-            time.sleep(3)
-            os.execv(sys.executable, ["python"] + sys.argv)
+        finally:
+            supervisor_connected = False
+            was_ready = bot.is_ready()
+            await close_connection()
+            reset_connection()
+            await state_store.flush_async()
+
+        if shutdown_requested:
+            return False
+        if full_restart_requested:
+            return True
+        failures = 0 if was_ready else failures + 1
+        if failures >= SUPERVISOR_MAX_FAILURES:
+            print(f"⚠️ 接続に{failures}回続けて失敗しました。")
+            return True
+        delay = min(SUPERVISOR_BACKOFF_MAX, SUPERVISOR_BACKOFF_BASE * 2 ** failures) * random.uniform(0.5, 1.5)
+        print(f"{delay:.1f}秒後に再接続します...")
+        # SIGTERM などで起こされたらすぐに抜ける（SIGHUP ならすぐに再接続する）
+        try:
+            await asyncio.wait_for(supervisor_wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        if shutdown_requested:
+            return False
+        if full_restart_requested:
+            return True
+
+if __name__ == "__main__":
+    discord.utils.setup_logging()
+    try:
+        full_restart = asyncio.run(supervise())
+    except KeyboardInterrupt:
+        full_restart = False
+    finally:
+        state_store.flush()
+    if full_restart:
+        print("3秒後に完全再起動します...")
+        time.sleep(3)
+        os.execv(sys.executable, ["python"] + sys.argv)
@@ -0,0 +1,136 @@
+# launcher.py — シャードをいくつかのグループ（クラスタ）に分け、クラスタ毎に bot.py を別プロセスで起動する
+#
+#   python launcher.py --clusters 4            # シャード数は Discord の推奨値
+#   python launcher.py --clusters 4 --shards 32
+#
+# 各プロセスには SHARD_COUNT / SHARD_IDS / CLUSTER_ID / CLUSTER_COUNT を環境変数で渡す。
+# 落ちたプロセスは間隔を空けて起動し直し、Ctrl+C / SIGTERM で全プロセスを終了する。
+import argparse
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+import requests
+from dotenv import load_dotenv
+
+from storage import GuildStateStore, create_item_backend
+
+IDENTIFY_INTERVAL = 5.0  # 1シャードの接続（IDENTIFY）にかかる時間の目安（秒）
+BASE_DATA_DIR = "data"  # bot.py と同じ
+
+
+def recommended_shards(token: str) -> int:
+    res = requests.get("https://discord.com/api/v10/gateway/bot", headers={"Authorization": f"Bot {token}"}, timeout=10)
+    res.raise_for_status()
+    return int(res.json()["shards"])
+
+
+def migrate_storage():
+    """STORAGE_BACKEND=sqlite なら、クラスタを起動する前に items.json → SQLite の移行を済ませておく"""
+    if os.getenv("STORAGE_BACKEND", "json") != "sqlite":
+        return
+    sqlite_path = os.getenv("SQLITE_PATH") or os.path.join(BASE_DATA_DIR, "store.sqlite3")
+    create_item_backend("sqlite", GuildStateStore(BASE_DATA_DIR), sqlite_path).conn.close()
+
+
+def split_shards(shard_count: int, clusters: int) -> list:
+    """0..shard_count-1 を clusters 個の連続したグループに分ける"""
+    size, extra = divmod(shard_count, clusters)
+    groups, start = [], 0
+    for i in range(clusters):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(list(range(start, end)))
+        start = end
+    return [g for g in groups if g]
+
+
+class Cluster:
+    def __init__(self, cluster_id: int, shard_ids: list, shard_count: int, cluster_count: int):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.cluster_count = cluster_count
+        self.process = None
+        self.failures = 0
+        self.started_at = 0.0
+        self.restart_at = 0.0
+
+    def start(self):
+        env = dict(
+            os.environ,
+            SHARDED="1",
+            SHARD_COUNT=str(self.shard_count),
+            SHARD_IDS=",".join(map(str, self.shard_ids)),
+            CLUSTER_ID=str(self.cluster_id),
+            CLUSTER_COUNT=str(self.cluster_count),
+        )
+        bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+        self.process = subprocess.Popen([sys.executable, bot_path], env=env)
+        self.started_at = time.time()
+        print(f"✅ クラスタ {self.cluster_id} を起動しました（pid={self.process.pid} シャード {self.shard_ids[0]}〜{self.shard_ids[-1]}）")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="シャードをクラスタに分けて bot.py を複数プロセスで起動する")
+    parser.add_argument("--clusters", type=int, default=os.cpu_count() or 1, help="起動するプロセス数")
+    parser.add_argument("--shards", type=int, default=None, help="全体のシャード数（省略すると Discord の推奨値）")
+    args = parser.parse_args()
+
+    shard_count = args.shards or recommended_shards(os.getenv("BOT_TOKEN", ""))
+    groups = split_shards(shard_count, max(1, args.clusters))
+    clusters = [Cluster(i, ids, shard_count, len(groups)) for i, ids in enumerate(groups)]
+    print(f"シャード数: {shard_count} / クラスタ数: {len(clusters)}")
+    migrate_storage()
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, "SIGTERM"):
+        signal.signal(signal.SIGTERM, stop)
+
+    # 同時に接続するとレート制限にかかるので、前のクラスタのシャードが接続し終わる頃に次を起動する
+    for cluster in clusters:
+        if stopping:
+            break
+        cluster.start()
+        time.sleep(len(cluster.shard_ids) * IDENTIFY_INTERVAL)
+
+    while not stopping:
+        time.sleep(1)
+        now = time.time()
+        for cluster in clusters:
+            if cluster.process is None or cluster.process.poll() is None:
+                continue
+            if cluster.restart_at == 0.0:
+                # 長く動いていたプロセスなら失敗回数を数え直す
+                cluster.failures = 0 if now - cluster.started_at > 600 else cluster.failures + 1
+                delay = min(300, 5 * 2 ** cluster.failures) * random.uniform(0.5, 1.5)
+                cluster.restart_at = now + delay
+                print(f"⚠️ クラスタ {cluster.cluster_id} が終了しました（code={cluster.process.returncode}）。{delay:.0f}秒後に再起動します。")
+            elif now >= cluster.restart_at:
+                cluster.restart_at = 0.0
+                cluster.start()
+
+    print("全クラスタを終了します...")
+    for cluster in clusters:
+        cluster.stop()
+    for cluster in clusters:
+        if cluster.process:
+            try:
+                cluster.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                cluster.process.kill()
+
+
+if __name__ == "__main__":
+    main()
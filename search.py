@@ -0,0 +1,86 @@
+# search.py — 商品・パネル・チャンネル名の絞り込み用インデックス（1文字 / 2-gram の転置索引）
+import unicodedata
+
+
+def normalize(text) -> str:
+    """全角半角・大文字小文字の違いを吸収する"""
+    return unicodedata.normalize("NFKC", str(text)).casefold()
+
+
+def _grams(text: str) -> set:
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+class SearchIndex:
+    """表示名の部分一致検索。前方一致を優先して並べる。
+
+    key ごとに 1文字と 2-gram の転置索引を持ち、追加・削除はその key の分だけ更新する。
+    """
+
+    def __init__(self):
+        self._labels = {}  # key -> 表示名（登録順を保つ）
+        self._texts = {}   # key -> 正規化した検索対象文字列
+        self._postings = {}  # 1文字 / 2-gram -> {key: None}
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __contains__(self, key):
+        return key in self._labels
+
+    def label(self, key) -> str:
+        return self._labels.get(key, str(key))
+
+    def add(self, key, label: str, *terms):
+        """key を登録する（既にあれば置き換える）。terms も検索対象に含める（ID など）"""
+        if key in self._labels:
+            self.remove(key)
+        text = normalize(" ".join([label, *map(str, terms)]))
+        self._labels[key] = label
+        self._texts[key] = text
+        for gram in _grams(text):
+            self._postings.setdefault(gram, {})[key] = None
+
+    def remove(self, key):
+        text = self._texts.pop(key, None)
+        if text is None:
+            return
+        del self._labels[key]
+        for gram in _grams(text):
+            posting = self._postings.get(gram)
+            if posting is not None:
+                posting.pop(key, None)
+                if not posting:
+                    del self._postings[gram]
+
+    def search(self, query: str, limit: int = 25, predicate=None) -> list:
+        """query を含む key を最大 limit 件返す。空の query なら登録順に返す"""
+        query = normalize(query).strip()
+        if not query:
+            candidates = self._labels
+        else:
+            grams = [query] if len(query) == 1 else [query[i:i + 2] for i in range(len(query) - 1)]
+            postings = sorted((self._postings.get(g, {}) for g in set(grams)), key=len)
+            if not postings[0]:
+                return []
+            candidates = [k for k in postings[0] if all(k in p for p in postings[1:]) and query in self._texts[k]]
+            # 先頭一致 → 単語の先頭一致 → 部分一致、同順位なら短い名前を先に
+            candidates.sort(key=lambda k: (self._rank(self._texts[k], query), len(self._texts[k])))
+
+        results = []
+        for key in candidates:
+            if predicate is None or predicate(key):
+                results.append(key)
+                if len(results) >= limit:
+                    break
+        return results
+
+    @staticmethod
+    def _rank(text: str, query: str) -> int:
+        if text.startswith(query):
+            return 0
+        if any(word.startswith(query) for word in text.split()):
+            return 1
+        return 2
@@ -0,0 +1,1352 @@
+# storage.py — ギルド毎データ（data/<guild_id>/*.json）のメモリ常駐ストア
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from urllib.parse import quote
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except Exception:
+            return {}
+
+
+def _write_synced(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_atomic(path, text):
+    # 一時ファイルに書いてから置き換えるので、書き込み途中で落ちても元ファイルは壊れない
+    tmp = path + ".tmp"
+    _write_synced(tmp, text)
+    os.replace(tmp, path)
+
+
+def apply_journal_record(data: dict, rec: dict):
+    """ジャーナル1件をメモリ上のデータに適用する（起動時の再生用）"""
+    op = rec.get("op")
+    item_id = rec.get("id")
+    if op == "put":
+        data[item_id] = rec["item"]
+    elif op == "del":
+        data.pop(item_id, None)
+    elif op == "set":
+        item = data.get(item_id)
+        if item is not None:
+            item.update(rec["fields"])
+    elif op == "pop":
+        item = data.get(item_id)
+        if item is not None:
+            del item.setdefault("accounts", [])[:rec["n"]]
+    elif op == "push":
+        item = data.get(item_id)
+        if item is not None:
+            item.setdefault("accounts", []).extend(rec["accounts"])
+
+
+def _replay_journal(path, data, truncate=True) -> int:
+    """ジャーナルを再生し、適用した件数を返す。途中で切れた末尾行は切り詰める（truncate=False なら読むだけ）"""
+    if not os.path.exists(path):
+        return 0
+    applied = 0
+    good_offset = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except Exception:
+                break
+            if not line.endswith(b"\n"):
+                break
+            apply_journal_record(data, rec)
+            applied += 1
+            good_offset += len(line)
+    if truncate and good_offset < os.path.getsize(path):
+        print(f"⚠️ ジャーナル末尾の壊れた記録を破棄しました: {path}")
+        with open(path, "r+b") as f:
+            f.truncate(good_offset)
+    return applied
+
+
+class _Journal:
+    """items.json などへの変更を1行1レコードで追記するファイル"""
+
+    def __init__(self, path: str):
+        self.path = path + ".journal"
+        self.compacting_path = path + ".compacting"
+        self.fh = None
+        self.records = 0
+        self.unsynced = 0
+        self.last_compacted = time.monotonic()
+
+    def append(self, rec: dict):
+        if self.fh is None:
+            self.fh = open(self.path, "a", encoding="utf-8")
+        self.fh.write(json.dumps(rec, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.fh.flush()
+        self.records += 1
+        self.unsynced += 1
+
+    def sync(self):
+        if self.fh is not None and self.unsynced:
+            self.unsynced = 0
+            os.fsync(self.fh.fileno())
+
+    def close(self):
+        if self.fh is not None:
+            self.sync()
+            self.fh.close()
+            self.fh = None
+
+    def rotate(self):
+        """現在のジャーナルを .compacting に退避し、新しいジャーナルを空で始める"""
+        self.close()
+        if os.path.exists(self.path):
+            if os.path.exists(self.compacting_path):
+                # 前回のコンパクションが未完了なら、その記録の後ろに追記して失わないようにする
+                with open(self.path, "rb") as src, open(self.compacting_path, "ab") as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.compacting_path)
+        self.records = 0
+        self.last_compacted = time.monotonic()
+
+
+def _commit_snapshot(path, text):
+    """コンパクション: スナップショットを .next に書き、退避ジャーナルを消してから差し替える。
+
+    どの時点で落ちても、起動時の _recover() で「スナップショット + 未反映ジャーナル」に戻せる。
+    """
+    _write_synced(path + ".next", text)
+    if os.path.exists(path + ".compacting"):
+        os.remove(path + ".compacting")
+    os.replace(path + ".next", path)
+
+
+class GuildStateStore:
+    """ギルド毎の JSON ファイルを一度だけ読み込み、以降はメモリから返す。
+
+    save() はメモリ上のデータを差し替えて dirty 扱いにするだけで、
+    実際の書き込みはバックグラウンドの flush ループ（または終了時の flush()）が行う。
+    load() が返すのはキャッシュそのものなので、変更したら必ず save() すること。
+
+    journaled に含まれるファイル（既定は items.json）は、record() で小さな変更レコードを
+    ジャーナルに追記し、一定件数・一定時間ごとにスナップショットへまとめ直す。
+    """
+
+    def __init__(self, base_dir: str, flush_interval: float = 5.0, journaled=("items.json",),
+                 fsync_interval: float = 0.5, compact_records: int = 1000, compact_interval: float = 600.0):
+        self.base_dir = base_dir
+        self.flush_interval = flush_interval
+        self.journaled = set(journaled)
+        self.fsync_interval = fsync_interval
+        self.compact_records = compact_records
+        self.compact_interval = compact_interval
+        self._cache = {}
+        self._dirty = set()
+        self._dirs = set()
+        self._journals = {}
+        self._flush_lock = None
+        self._tasks = []
+        self._writers = []  # 書き戻しのたびに呼ぶ関数（独自の形式で保存するデータ用）
+
+    def path(self, guild_id: int, filename: str) -> str:
+        guild_dir = os.path.join(self.base_dir, str(guild_id))
+        if guild_dir not in self._dirs:
+            os.makedirs(guild_dir, exist_ok=True)
+            self._dirs.add(guild_dir)
+        return os.path.join(guild_dir, filename)
+
+    def _is_journaled(self, path) -> bool:
+        return os.path.basename(path) in self.journaled
+
+    def _recover(self, path):
+        compacting, nxt = path + ".compacting", path + ".next"
+        if os.path.exists(compacting):
+            # スナップショットの書き込みが終わる前に落ちている: 書きかけの .next は捨てる
+            if os.path.exists(nxt):
+                os.remove(nxt)
+        elif os.path.exists(nxt):
+            # 退避ジャーナルの削除後に落ちている: .next は完成済みなので差し替えを完了させる
+            os.replace(nxt, path)
+        data = _read_json(path)
+        journal = _Journal(path)
+        journal.records = _replay_journal(compacting, data) + _replay_journal(journal.path, data)
+        self._journals[path] = journal
+        if journal.records >= self.compact_records or os.path.exists(compacting):
+            self._dirty.add(path)
+        return data
+
+    def load(self, path):
+        data = self._cache.get(path)
+        if data is None:
+            data = self._recover(path) if self._is_journaled(path) else _read_json(path)
+            self._cache[path] = data
+        return data
+
+    def save(self, path, data):
+        if self._is_journaled(path) and path not in self._journals:
+            # 既存のジャーナルを取り込んでから丸ごと置き換える（次回起動時に古い記録が再生されないように）
+            self.load(path)
+        self._cache[path] = data
+        self._dirty.add(path)
+
+    def mark_dirty(self, path):
+        if path in self._cache:
+            self._dirty.add(path)
+
+    def record(self, path, rec: dict):
+        """ジャーナル対象ファイルへの変更を1件追記する（メモリ上のデータは呼び出し側で変更済みであること）"""
+        if not self._is_journaled(path):
+            self.mark_dirty(path)
+            return
+        self.load(path)
+        journal = self._journals[path]
+        journal.append(rec)
+        if journal.records >= self.compact_records:
+            self._dirty.add(path)
+
+    def add_writer(self, take_jobs):
+        """書き戻しのたびに take_jobs() を呼び、返された (path, text, write) も一緒に書き出す。
+
+        take_jobs はイベントループ上で呼ばれ、write(path, text) は別スレッドで実行される。
+        write が失敗したときの再試行は take_jobs 側で管理すること。
+        """
+        self._writers.append(take_jobs)
+
+    def _take_dirty(self):
+        # シリアライズとジャーナルの退避はイベントループ上で行い、書き込み中にデータが変わっても壊れないようにする
+        dirty, self._dirty = self._dirty, set()
+        jobs = [job for take_jobs in self._writers for job in take_jobs()]
+        for path in dirty:
+            text = json.dumps(self._cache[path], indent=2, ensure_ascii=False)
+            journal = self._journals.get(path)
+            if journal is not None:
+                journal.rotate()
+                jobs.append((path, text, _commit_snapshot))
+            else:
+                jobs.append((path, text, _write_atomic))
+        return jobs
+
+    def _due_compactions(self):
+        now = time.monotonic()
+        for path, journal in self._journals.items():
+            if journal.records and now - journal.last_compacted >= self.compact_interval:
+                self._dirty.add(path)
+
+    def flush(self):
+        """dirty なファイルとジャーナルを同期的に書き出す（終了時用）"""
+        for path, text, write in self._take_dirty():
+            try:
+                write(path, text)
+            except Exception as e:
+                if path in self._cache:
+                    self._dirty.add(path)
+                print(f"⚠️ データ書き込みエラー: {path}: {e}")
+        for journal in self._journals.values():
+            journal.close()
+
+    def _lock(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    async def flush_async(self):
+        async with self._lock():
+            self._due_compactions()
+            for path, text, write in self._take_dirty():
+                try:
+                    await asyncio.to_thread(write, path, text)
+                except Exception as e:
+                    if path in self._cache:
+                        self._dirty.add(path)
+                    print(f"⚠️ データ書き込みエラー: {path}: {e}")
+
+    async def sync_journals(self):
+        # 追記は即座に OS へ渡し、fsync だけをまとめて行う
+        async with self._lock():
+            for journal in self._journals.values():
+                if journal.unsynced and journal.fh is not None:
+                    journal.unsynced = 0
+                    await asyncio.to_thread(os.fsync, journal.fh.fileno())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_async()
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            await self.sync_journals()
+
+    def start(self):
+        """実行中のイベントループ上で flush / fsync ループを開始する（多重起動しない）"""
+        if not self._tasks or any(t.done() for t in self._tasks):
+            for t in self._tasks:
+                t.cancel()
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._flush_loop()), loop.create_task(self._sync_loop())]
+        return self._tasks
+
+
+# ------------------------
+# 商品データのバックエンド（items.json / SQLite）
+# ------------------------
+def is_account_item(item: dict) -> bool:
+    return "accounts" in item or item.get("kind") == "account"
+
+
+def _item_number(item_id: str) -> int:
+    # 商品IDは「<panel_id>_<連番>」
+    suffix = str(item_id).rsplit("_", 1)[-1]
+    return int(suffix) if suffix.isdigit() else 0
+
+
+def _decrement_stock(stock, count: int):
+    """在庫を count 減らした値を返す。∞ はそのまま、在庫不足・不正な値なら None"""
+    if isinstance(stock, str) and stock.isdigit():
+        stock = int(stock)
+    if stock in ("∞", "∞️"):
+        return stock
+    if isinstance(stock, int) and stock >= count:
+        return stock - count
+    return None
+
+
+class _PanelVersions:
+    """パネル毎の版数。商品・在庫が変わるたびに上がるので、描画結果のキャッシュの鍵に使える"""
+
+    def __init__(self):
+        self._versions = {}  # (guild_id, panel_id) -> 版数
+
+    def panel_version(self, guild_id, panel_id) -> int:
+        return self._versions.get((guild_id, panel_id), 0)
+
+    def _bump(self, guild_id, *panel_ids):
+        for panel_id in panel_ids:
+            self._versions[(guild_id, panel_id)] = self._versions.get((guild_id, panel_id), 0) + 1
+
+
+class AccountQueue:
+    """アカウント在庫を「1行1件の追記専用ファイル + 読み取り位置（.cursor）」で管理する。
+
+    取り出しは読み取り位置から k 行読んで位置を進めるだけなので O(k) で、売れ残りは書き直さない。
+    売れた分がファイルの半分を超えたら残りだけの新しい世代に作り直す（償却 O(1)）。
+    """
+
+    COMPACT_BYTES = 1 << 20
+
+    def __init__(self, directory: str, item_id: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = quote(item_id, safe="")
+        self.cursor_path = os.path.join(directory, self.name + ".cursor")
+        self.generation, self.offset = self._read_cursor()
+        self._remove_stale_generations()
+        self.count = self._count_remaining()
+
+    def _data_path(self, generation=None) -> str:
+        return os.path.join(self.directory, f"{self.name}.{self.generation if generation is None else generation}.jsonl")
+
+    def _read_cursor(self):
+        return self._parse_cursor(self.cursor_path)
+
+    @staticmethod
+    def _parse_cursor(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                generation, offset = f.read().split()
+            return int(generation), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    @classmethod
+    def read_remaining(cls, directory: str, item_id: str) -> list:
+        """ファイルを一切変更せずに未販売の在庫を読む（SQLite への移行用）。書きかけの末尾行は読まない"""
+        name = quote(item_id, safe="")
+        generation, offset = cls._parse_cursor(os.path.join(directory, name + ".cursor"))
+        path = os.path.join(directory, f"{name}.{generation}.jsonl")
+        if not os.path.exists(path):
+            return []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        return [json.loads(line) for line in data[:data.rfind(b"\n") + 1].splitlines()]
+
+    def _write_cursor(self):
+        _write_atomic(self.cursor_path, f"{self.generation} {self.offset}\n")
+
+    def _remove_stale_generations(self):
+        # 世代の切り替え（_maybe_compact / reset）の途中で落ちると、前後どちらかの世代のファイルが残る
+        for generation in (self.generation - 1, self.generation + 1):
+            path = self._data_path(generation)
+            if generation >= 0 and os.path.exists(path):
+                os.remove(path)
+
+    def _count_remaining(self) -> int:
+        path = self._data_path()
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r+b") as f:
+            data = f.read()
+            # 追記途中で落ちた末尾の1行は捨てる
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)
+        return data.count(b"\n", self.offset, end)
+
+    def push(self, accounts: list):
+        with open(self._data_path(), "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(acc, ensure_ascii=False) + "\n" for acc in accounts))
+            f.flush()
+            os.fsync(f.fileno())
+        self.count += len(accounts)
+
+    def pop(self, n: int):
+        """先頭から n 件取り出す。足りなければ None を返して何も変更しない"""
+        if n > self.count:
+            return None
+        with open(self._data_path(), "rb") as f:
+            f.seek(self.offset)
+            lines = [f.readline() for _ in range(n)]
+        self.offset += sum(len(line) for line in lines)
+        self.count -= n
+        self._write_cursor()
+        self._maybe_compact()
+        return [json.loads(line) for line in lines]
+
+    def peek_all(self) -> list:
+        """未販売の在庫をすべて読む（重複チェックなど管理操作用）"""
+        path = self._data_path()
+        if not os.path.exists(path):
+            return []
+        with open(path, "rb") as f:
+            f.seek(self.offset)
+            return [json.loads(line) for line in f]
+
+    def _maybe_compact(self):
+        path = self._data_path()
+        size = os.path.getsize(path)
+        if self.offset < self.COMPACT_BYTES or self.offset < size - self.offset:
+            return
+        # 新しい世代に残りを書き、カーソルを切り替えてから古い世代を消す（どこで落ちても整合する）
+        with open(path, "rb") as f:
+            f.seek(self.offset)
+            remainder = f.read()
+        new_generation = self.generation + 1
+        with open(self._data_path(new_generation), "wb") as f:
+            f.write(remainder)
+            f.flush()
+            os.fsync(f.fileno())
+        self.generation, self.offset = new_generation, 0
+        self._write_cursor()
+        os.remove(path)
+
+    def reset(self, accounts: list):
+        """在庫を accounts で置き換える（旧形式からの移行用）"""
+        new_generation = self.generation + 1
+        with open(self._data_path(new_generation), "w", encoding="utf-8") as f:
+            f.write("".join(json.dumps(acc, ensure_ascii=False) + "\n" for acc in accounts))
+            f.flush()
+            os.fsync(f.fileno())
+        old_path = self._data_path()
+        self.generation, self.offset, self.count = new_generation, 0, len(accounts)
+        self._write_cursor()
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+    def delete(self):
+        for path in (self._data_path(), self.cursor_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.count = 0
+
+
+class JsonItemBackend(_PanelVersions):
+    """items.json（+ジャーナル）に商品を保存する既定のバックエンド。
+
+    アカウント型商品の在庫は items.json には持たず、商品毎の AccountQueue（data/<guild_id>/accounts/）に置く。
+    パネル → 商品ID の索引を追加・削除のたびに更新するので、パネル単位の取得は O(パネル内の商品数)。
+    get_item / items / panel_items が返す dict はキャッシュそのものなので読み取り専用として扱い、
+    変更は put_item などのメソッド経由で行う。
+    """
+
+    def __init__(self, store: GuildStateStore):
+        super().__init__()
+        self.store = store
+        self._queues = {}
+        self._loaded = set()
+        self._index = {}  # guild_id -> {panel_id: {item_id: None}}（追加順を保つ）
+
+    def _path(self, guild_id):
+        return self.store.path(guild_id, "items.json")
+
+    def _record(self, guild_id, rec):
+        self.store.record(self._path(guild_id), rec)
+
+    def _queue(self, guild_id, item_id) -> AccountQueue:
+        queue = self._queues.get((guild_id, item_id))
+        if queue is None:
+            queue = self._queues[(guild_id, item_id)] = AccountQueue(self.store.path(guild_id, "accounts"), item_id)
+        return queue
+
+    def _adopt_accounts(self, guild_id, item_id, item: dict):
+        """item["accounts"] のリストをキューへ移し、在庫数をキューの件数に合わせる"""
+        queue = self._queue(guild_id, item_id)
+        if "accounts" in item:
+            queue.reset(item.pop("accounts") or [])
+            item["kind"] = "account"
+        if item.get("stock") != queue.count:
+            item["stock"] = queue.count
+            return True
+        return False
+
+    def items(self, guild_id) -> dict:
+        items = self.store.load(self._path(guild_id))
+        if guild_id not in self._loaded:
+            self._loaded.add(guild_id)
+            # 旧形式（accounts のリストを items.json に持つ）の商品をキューへ移し、在庫数をキューと揃える
+            for item_id, item in items.items():
+                if not is_account_item(item):
+                    continue
+                migrating = "accounts" in item
+                if self._adopt_accounts(guild_id, item_id, item) or migrating:
+                    self._record(guild_id, {"op": "put", "id": item_id, "item": item})
+            index = self._index[guild_id] = {}
+            for item_id, item in items.items():
+                index.setdefault(item.get("panel_id"), {})[item_id] = None
+        return items
+
+    def _panel_index(self, guild_id) -> dict:
+        self.items(guild_id)
+        return self._index[guild_id]
+
+    def _unindex(self, guild_id, item_id, panel_id):
+        ids = self._panel_index(guild_id).get(panel_id)
+        if ids is not None:
+            ids.pop(item_id, None)
+            if not ids:
+                del self._index[guild_id][panel_id]
+
+    def allocate_item_id(self, guild_id, panel_id) -> str:
+        """削除後も重複しない商品IDを払い出す（ギルド毎の単調増加の連番）"""
+        path = self.store.path(guild_id, "item_seq.json")
+        counter = self.store.load(path)
+        if "next" not in counter:
+            counter["next"] = max((_item_number(i) for i in self.items(guild_id)), default=0) + 1
+        item_id = f"{panel_id}_{counter['next']}"
+        while item_id in self.items(guild_id):
+            counter["next"] += 1
+            item_id = f"{panel_id}_{counter['next']}"
+        counter["next"] += 1
+        self.store.save(path, counter)
+        return item_id
+
+    def get_item(self, guild_id, item_id):
+        return self.items(guild_id).get(item_id)
+
+    def count_items(self, guild_id) -> int:
+        return len(self.items(guild_id))
+
+    def panel_items(self, guild_id, panel_id) -> dict:
+        items = self.items(guild_id)
+        return {item_id: items[item_id] for item_id in self._panel_index(guild_id).get(panel_id, ())}
+
+    def panel_counts(self, guild_id) -> dict:
+        return {panel_id: len(ids) for panel_id, ids in self._panel_index(guild_id).items()}
+
+    def put_item(self, guild_id, item_id, item: dict):
+        if is_account_item(item):
+            self._adopt_accounts(guild_id, item_id, item)
+        items = self.items(guild_id)
+        old = items.get(item_id)
+        if old is not None:
+            self._unindex(guild_id, item_id, old.get("panel_id"))
+            self._bump(guild_id, old.get("panel_id"))
+        items[item_id] = item
+        self._index[guild_id].setdefault(item.get("panel_id"), {})[item_id] = None
+        self._bump(guild_id, item.get("panel_id"))
+        self._record(guild_id, {"op": "put", "id": item_id, "item": item})
+
+    def delete_item(self, guild_id, item_id) -> bool:
+        items = self.items(guild_id)
+        if item_id not in items:
+            return False
+        if is_account_item(items[item_id]):
+            self._queue(guild_id, item_id).delete()
+            self._queues.pop((guild_id, item_id), None)
+        self._unindex(guild_id, item_id, items[item_id].get("panel_id"))
+        self._bump(guild_id, items[item_id].get("panel_id"))
+        del items[item_id]
+        self._record(guild_id, {"op": "del", "id": item_id})
+        return True
+
+    def delete_panel_items(self, guild_id, panel_id) -> list:
+        item_ids = list(self.panel_items(guild_id, panel_id))
+        for item_id in item_ids:
+            self.delete_item(guild_id, item_id)
+        return item_ids
+
+    def account_stock(self, guild_id, item_id) -> list:
+        item = self.get_item(guild_id, item_id)
+        if item is None or not is_account_item(item):
+            return []
+        return self._queue(guild_id, item_id).peek_all()
+
+    def add_accounts(self, guild_id, item_id, accounts: list):
+        """アカウント在庫を末尾に追加し、追加後の在庫数を返す（商品がなければ None）"""
+        item = self.get_item(guild_id, item_id)
+        if item is None:
+            return None
+        queue = self._queue(guild_id, item_id)
+        queue.push(accounts)
+        item["kind"] = "account"
+        item["stock"] = queue.count
+        self._bump(guild_id, item.get("panel_id"))
+        self._record(guild_id, {"op": "set", "id": item_id, "fields": {"kind": "account", "stock": item["stock"]}})
+        return item["stock"]
+
+    def consume(self, guild_id, item_id, count: int):
+        """在庫を count 個減らす。アカウント型は先頭から取り出したアカウントのリストを返す。
+
+        在庫不足・商品なしの場合は None を返し、在庫は変更しない。
+        確認と減算の間に await を挟まないので、同じ商品の同時購入でも在庫を超えて確保されない。
+        """
+        item = self.get_item(guild_id, item_id)
+        if item is None:
+            return None
+        if is_account_item(item):
+            queue = self._queue(guild_id, item_id)
+            taken = queue.pop(count)
+            if taken is None:
+                return None
+            item["stock"] = queue.count
+            self._bump(guild_id, item.get("panel_id"))
+            self._record(guild_id, {"op": "set", "id": item_id, "fields": {"stock": item["stock"]}})
+            return taken
+        stock = _decrement_stock(item.get("stock"), count)
+        if stock is None:
+            return None
+        if stock != item.get("stock"):
+            item["stock"] = stock
+            self._bump(guild_id, item.get("panel_id"))
+            self._record(guild_id, {"op": "set", "id": item_id, "fields": {"stock": stock}})
+        return []
+
+    def release(self, guild_id, item_id, taken: list, count: int):
+        """consume() で確保した在庫を戻す（支払いの受け取りや配送に失敗したとき用）"""
+        item = self.get_item(guild_id, item_id)
+        if item is None:
+            return
+        if is_account_item(item):
+            if taken:
+                self.add_accounts(guild_id, item_id, taken)
+        elif isinstance(item.get("stock"), int):
+            item["stock"] += count
+            self._bump(guild_id, item.get("panel_id"))
+            self._record(guild_id, {"op": "set", "id": item_id, "fields": {"stock": item["stock"]}})
+
+
+class SqliteItemBackend(_PanelVersions):
+    """SQLite（WAL）に商品とアカウント在庫を保存するバックエンド。
+
+    (guild_id, panel_id) のインデックスでパネル単位の取得を行い、在庫の減算はトランザクション内で行う。
+    返す dict は毎回新しく作られるため、変更は put_item などのメソッド経由で行う。
+    """
+
+    def __init__(self, db_path: str):
+        super().__init__()
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                guild_id INTEGER NOT NULL,
+                item_id TEXT NOT NULL,
+                panel_id TEXT,
+                kind TEXT NOT NULL DEFAULT 'item',
+                stock,
+                data TEXT NOT NULL,
+                PRIMARY KEY (guild_id, item_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_items_panel ON items (guild_id, panel_id);
+            CREATE TABLE IF NOT EXISTS accounts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                guild_id INTEGER NOT NULL,
+                item_id TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_accounts_item ON accounts (guild_id, item_id, id);
+            CREATE TABLE IF NOT EXISTS item_seq (
+                guild_id INTEGER PRIMARY KEY,
+                next INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS migrations (
+                guild_id INTEGER PRIMARY KEY,
+                migrated_at REAL NOT NULL
+            );
+        """)
+
+    @contextmanager
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        else:
+            self.conn.execute("COMMIT")
+
+    @staticmethod
+    def _row_to_item(kind, stock, data):
+        item = json.loads(data)
+        item["stock"] = stock
+        if kind == "account":
+            item["kind"] = "account"
+        return item
+
+    def _query_items(self, where, params) -> dict:
+        rows = self.conn.execute(f"SELECT item_id, kind, stock, data FROM items WHERE {where} ORDER BY rowid", params)
+        return {item_id: self._row_to_item(kind, stock, data) for item_id, kind, stock, data in rows}
+
+    def items(self, guild_id) -> dict:
+        return self._query_items("guild_id = ?", (guild_id,))
+
+    def get_item(self, guild_id, item_id):
+        row = self.conn.execute("SELECT kind, stock, data FROM items WHERE guild_id = ? AND item_id = ?", (guild_id, item_id)).fetchone()
+        return self._row_to_item(*row) if row else None
+
+    def count_items(self, guild_id) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM items WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+
+    def panel_items(self, guild_id, panel_id) -> dict:
+        return self._query_items("guild_id = ? AND panel_id = ?", (guild_id, panel_id))
+
+    def allocate_item_id(self, guild_id, panel_id) -> str:
+        """削除後も重複しない商品IDを払い出す（ギルド毎の単調増加の連番）"""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT next FROM item_seq WHERE guild_id = ?", (guild_id,)).fetchone()
+            if row is None:
+                existing = [r[0] for r in conn.execute("SELECT item_id FROM items WHERE guild_id = ?", (guild_id,))]
+                number = max((_item_number(i) for i in existing), default=0) + 1
+            else:
+                number = row[0]
+            while conn.execute("SELECT 1 FROM items WHERE guild_id = ? AND item_id = ?", (guild_id, f"{panel_id}_{number}")).fetchone():
+                number += 1
+            conn.execute(
+                "INSERT INTO item_seq (guild_id, next) VALUES (?, ?) ON CONFLICT (guild_id) DO UPDATE SET next = excluded.next",
+                (guild_id, number + 1),
+            )
+        return f"{panel_id}_{number}"
+
+    def panel_counts(self, guild_id) -> dict:
+        rows = self.conn.execute("SELECT panel_id, COUNT(*) FROM items WHERE guild_id = ? GROUP BY panel_id", (guild_id,))
+        return dict(rows.fetchall())
+
+    def _put(self, conn, guild_id, item_id, item: dict):
+        data = {k: v for k, v in item.items() if k not in ("stock", "accounts", "kind")}
+        kind = "account" if is_account_item(item) else "item"
+        conn.execute(
+            "INSERT INTO items (guild_id, item_id, panel_id, kind, stock, data) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (guild_id, item_id) DO UPDATE SET panel_id = excluded.panel_id, kind = excluded.kind, "
+            "stock = excluded.stock, data = excluded.data",
+            (guild_id, item_id, item.get("panel_id"), kind, item.get("stock", 0), json.dumps(data, ensure_ascii=False)),
+        )
+        accounts = item.get("accounts")
+        if accounts:
+            self._push_accounts(conn, guild_id, item_id, accounts)
+
+    @staticmethod
+    def _push_accounts(conn, guild_id, item_id, accounts):
+        conn.executemany(
+            "INSERT INTO accounts (guild_id, item_id, data) VALUES (?, ?, ?)",
+            [(guild_id, item_id, json.dumps(acc, ensure_ascii=False)) for acc in accounts],
+        )
+        conn.execute(
+            "UPDATE items SET stock = (SELECT COUNT(*) FROM accounts WHERE guild_id = ? AND item_id = ?) WHERE guild_id = ? AND item_id = ?",
+            (guild_id, item_id, guild_id, item_id),
+        )
+
+    @staticmethod
+    def _panel_of(conn, guild_id, item_id):
+        row = conn.execute("SELECT panel_id FROM items WHERE guild_id = ? AND item_id = ?", (guild_id, item_id)).fetchone()
+        return row[0] if row else None
+
+    def put_item(self, guild_id, item_id, item: dict):
+        with self._transaction() as conn:
+            old_panel_id = self._panel_of(conn, guild_id, item_id)
+            conn.execute("DELETE FROM accounts WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
+            self._put(conn, guild_id, item_id, item)
+        self._bump(guild_id, old_panel_id, item.get("panel_id"))
+
+    def delete_item(self, guild_id, item_id) -> bool:
+        with self._transaction() as conn:
+            panel_id = self._panel_of(conn, guild_id, item_id)
+            conn.execute("DELETE FROM accounts WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
+            deleted = conn.execute("DELETE FROM items WHERE guild_id = ? AND item_id = ?", (guild_id, item_id)).rowcount > 0
+        self._bump(guild_id, panel_id)
+        return deleted
+
+    def delete_panel_items(self, guild_id, panel_id) -> list:
+        with self._transaction() as conn:
+            item_ids = [r[0] for r in conn.execute("SELECT item_id FROM items WHERE guild_id = ? AND panel_id = ?", (guild_id, panel_id))]
+            conn.executemany("DELETE FROM accounts WHERE guild_id = ? AND item_id = ?", [(guild_id, i) for i in item_ids])
+            conn.execute("DELETE FROM items WHERE guild_id = ? AND panel_id = ?", (guild_id, panel_id))
+        self._bump(guild_id, panel_id)
+        return item_ids
+
+    def account_stock(self, guild_id, item_id) -> list:
+        rows = self.conn.execute("SELECT data FROM accounts WHERE guild_id = ? AND item_id = ? ORDER BY id", (guild_id, item_id))
+        return [json.loads(r[0]) for r in rows]
+
+    def add_accounts(self, guild_id, item_id, accounts: list):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT panel_id FROM items WHERE guild_id = ? AND item_id = ?", (guild_id, item_id)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE items SET kind = 'account' WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
+            self._push_accounts(conn, guild_id, item_id, accounts)
+            stock = conn.execute("SELECT stock FROM items WHERE guild_id = ? AND item_id = ?", (guild_id, item_id)).fetchone()[0]
+        self._bump(guild_id, row[0])
+        return stock
+
+    def consume(self, guild_id, item_id, count: int):
+        taken = self._consume(guild_id, item_id, count)
+        if taken is not None:
+            self._bump(guild_id, self._panel_of(self.conn, guild_id, item_id))
+        return taken
+
+    def _consume(self, guild_id, item_id, count: int):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT kind, stock FROM items WHERE guild_id = ? AND item_id = ?", (guild_id, item_id)).fetchone()
+            if row is None:
+                return None
+            kind, stock = row
+            if kind == "account":
+                rows = conn.execute(
+                    "SELECT id, data FROM accounts WHERE guild_id = ? AND item_id = ? ORDER BY id LIMIT ?",
+                    (guild_id, item_id, count),
+                ).fetchall()
+                if len(rows) < count:
+                    return None
+                conn.execute(f"DELETE FROM accounts WHERE id IN ({','.join('?' * len(rows))})", [r[0] for r in rows])
+                conn.execute("UPDATE items SET stock = stock - ? WHERE guild_id = ? AND item_id = ?", (count, guild_id, item_id))
+                return [json.loads(r[1]) for r in rows]
+            new_stock = _decrement_stock(stock, count)
+            if new_stock is None:
+                return None
+            if new_stock != stock:
+                conn.execute("UPDATE items SET stock = ? WHERE guild_id = ? AND item_id = ?", (new_stock, guild_id, item_id))
+            return []
+
+    def release(self, guild_id, item_id, taken: list, count: int):
+        """consume() で確保した在庫を戻す（支払いの受け取りや配送に失敗したとき用）"""
+        if taken:
+            self.add_accounts(guild_id, item_id, taken)
+            return
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE items SET stock = stock + ? WHERE guild_id = ? AND item_id = ? AND kind = 'item' AND typeof(stock) = 'integer'",
+                (count, guild_id, item_id),
+            )
+            panel_id = self._panel_of(conn, guild_id, item_id)
+        self._bump(guild_id, panel_id)
+
+    def migrate_from_json(self, base_dir: str) -> int:
+        """data/<guild_id>/items.json（+ジャーナル）を一度だけ取り込む。取り込んだギルド数を返す
+
+        複数のプロセスから呼ばれても同じギルドを二重に取り込まないよう、移行済みかどうかは
+        BEGIN IMMEDIATE の中で確かめ直し、旧形式のファイルもその中で読む。
+        旧形式のファイルは read_legacy_items() で読むだけなので、移行後もバックアップとしてそのまま残る。
+        """
+        if not os.path.isdir(base_dir):
+            return 0
+        done = {r[0] for r in self.conn.execute("SELECT guild_id FROM migrations")}
+        migrated = 0
+        for name in os.listdir(base_dir):
+            if not name.isdigit() or int(name) in done:
+                continue
+            guild_id = int(name)
+            with self._transaction() as conn:
+                if conn.execute("SELECT 1 FROM migrations WHERE guild_id = ?", (guild_id,)).fetchone():
+                    continue
+                for item_id, item in read_legacy_items(os.path.join(base_dir, name)).items():
+                    self._put(conn, guild_id, item_id, item)
+                conn.execute("INSERT INTO migrations (guild_id, migrated_at) VALUES (?, ?)", (guild_id, time.time()))
+            migrated += 1
+        return migrated
+
+
+def read_legacy_items(guild_dir: str) -> dict:
+    """json 版の商品（items.json + ジャーナル + accounts/）を読み取り専用で読む。
+
+    起動時の _recover() と同じ順でスナップショットとジャーナルを重ねるが、ファイルは一切変更しない。
+    アカウント型商品は未販売の在庫を accounts に入れて返す。
+    """
+    path = os.path.join(guild_dir, "items.json")
+    compacting, nxt = path + ".compacting", path + ".next"
+    # .compacting が無く .next がある = 差し替え直前に落ちている（.next が完成済みのスナップショット）
+    data = _read_json(nxt if not os.path.exists(compacting) and os.path.exists(nxt) else path)
+    _replay_journal(compacting, data, truncate=False)
+    _replay_journal(path + ".journal", data, truncate=False)
+    for item_id, item in data.items():
+        if not is_account_item(item):
+            continue
+        if "accounts" not in item:
+            item["accounts"] = AccountQueue.read_remaining(os.path.join(guild_dir, "accounts"), item_id)
+        item["stock"] = len(item["accounts"])
+    return data
+
+
+def create_item_backend(kind: str, store: GuildStateStore, sqlite_path: str = None, migrate: bool = True):
+    """STORAGE_BACKEND の値から商品バックエンドを作る（json / sqlite）
+
+    migrate=False なら items.json からの移行を行わない（クラスタ起動時は launcher.py とクラスタ 0 だけが移行する）。
+    """
+    if kind == "sqlite":
+        backend = SqliteItemBackend(sqlite_path or os.path.join(store.base_dir, "store.sqlite3"))
+        migrated = backend.migrate_from_json(store.base_dir) if migrate else 0
+        if migrated:
+            print(f"✅ {migrated}件のギルドの items.json を SQLite に移行しました。")
+        return backend
+    return JsonItemBackend(store)
+
+
+# ------------------------
+# 使用済み PayPay リンクの索引
+# ------------------------
+class UsedLinkRegistry:
+    """使用済みリンクを link_id -> 使用時刻 の dict で保持し、O(1) で判定する。
+
+    保存は used_links.log への追記のみで、保持期間を過ぎた記録は prune() で間引く。
+    旧形式の used_links.json があれば初回読み込み時に取り込む。
+    """
+
+    def __init__(self, store: GuildStateStore, retention: float):
+        self.store = store
+        self.retention = retention
+        self._links = {}     # guild_id -> {link_id: 使用時刻}
+        self._pending = {}   # guild_id -> 処理中の link_id（同じリンクの同時送信を弾く）
+        self._prune_task = None
+
+    def _log_path(self, guild_id):
+        return self.store.path(guild_id, "used_links.log")
+
+    def _load(self, guild_id) -> dict:
+        links = self._links.get(guild_id)
+        if links is not None:
+            return links
+        links = {}
+        log_path = self._log_path(guild_id)
+        legacy_path = self.store.path(guild_id, "used_links.json")
+        if os.path.exists(log_path):
+            with open(log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    link_id, _, used_at = line.rstrip("\n").partition("\t")
+                    try:
+                        links[link_id] = float(used_at)
+                    except ValueError:
+                        continue
+        elif os.path.exists(legacy_path):
+            # 旧形式には使用時刻がないので、取り込んだ時刻を使用時刻とみなす
+            now = time.time()
+            links = {link_id: now for link_id in _read_json(legacy_path)}
+            _write_atomic(log_path, "".join(f"{link_id}\t{now}\n" for link_id in links))
+            os.replace(legacy_path, legacy_path + ".migrated")
+        self._links[guild_id] = links
+        self.prune(guild_id)
+        return links
+
+    def is_used(self, guild_id, link_id: str) -> bool:
+        return link_id in self._load(guild_id)
+
+    def mark(self, guild_id, link_id: str):
+        links = self._load(guild_id)
+        if link_id in links:
+            return
+        now = time.time()
+        links[link_id] = now
+        with open(self._log_path(guild_id), "a", encoding="utf-8") as f:
+            f.write(f"{link_id}\t{now}\n")
+
+    def claim(self, guild_id, link_id: str) -> bool:
+        """未使用かつ処理中でなければ処理中にして True を返す。終わったら release() すること"""
+        pending = self._pending.setdefault(guild_id, set())
+        if link_id in pending or self.is_used(guild_id, link_id):
+            return False
+        pending.add(link_id)
+        return True
+
+    def release(self, guild_id, link_id: str):
+        self._pending.get(guild_id, set()).discard(link_id)
+
+    def prune(self, guild_id):
+        """保持期間を過ぎた記録を消し、ログを書き直す"""
+        links = self._links.get(guild_id)
+        if not links:
+            return
+        cutoff = time.time() - self.retention
+        expired = [link_id for link_id, used_at in links.items() if used_at < cutoff]
+        if not expired:
+            return
+        for link_id in expired:
+            del links[link_id]
+        _write_atomic(self._log_path(guild_id), "".join(f"{link_id}\t{used_at}\n" for link_id, used_at in links.items()))
+
+    async def _prune_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            for guild_id in list(self._links):
+                self.prune(guild_id)
+
+    def start(self, interval: float = 86400.0):
+        if self._prune_task is None or self._prune_task.done():
+            self._prune_task = asyncio.get_running_loop().create_task(self._prune_loop(interval))
+        return self._prune_task
+
+
+class OrderQueue:
+    """支払いを受け取った注文を、配送が終わるまで orders.log（追記のみ・1行1記録）に残す。
+
+    記録は受け付け（put）・完了した配送手順（step）・失敗した試行（attempt）・終了（finish）・再開（reopen）の5種類。
+    受け付け・終了・再開と DM の送信記録は fsync してから返すので、再起動後は load_pending() で未完了の注文から
+    再開でき、支払い済みの注文や送信済みの DM を失わない。それ以外の記録（ロール・パネル・ログの完了、試行回数）は
+    OS に渡すだけで、次に fsync する記録と一緒にディスクへ書かれる（失っても手順をやり直すだけで済む）。
+    支払いを受け取れたか分からない注文は status="review" で受け付け、管理者が配送（reopen）か取り消しを決める。
+    終了した注文の記録が COMPACT_BYTES を超え、かつ未完了の注文の記録より大きくなったら書き直して取り除く
+    （失敗・要確認の注文は残るので、それだけでログが大きくても毎回書き直すことはない）。
+    """
+
+    COMPACT_BYTES = 64 * 1024
+    CLOSED = ("done", "cancelled")
+    SYNCED_OPS = ("put", "finish", "reopen")
+
+    def __init__(self, store: GuildStateStore):
+        self.store = store
+        self._orders = {}  # guild_id -> {order_id: 注文}
+        self._live = {}    # guild_id -> {order_id: その注文の記録のバイト数}（未完了の注文のみ）
+        self._garbage = {}  # guild_id -> 終了した注文・読めない行のバイト数
+
+    def _log_path(self, guild_id):
+        return self.store.path(guild_id, "orders.log")
+
+    def _append(self, guild_id, rec: dict, sync: bool = None):
+        line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+        with open(self._log_path(guild_id), "ab") as f:
+            f.write(line)
+            f.flush()
+            if sync or (sync is None and rec["op"] in self.SYNCED_OPS):
+                os.fsync(f.fileno())
+        live = self._live[guild_id]
+        if rec["id"] in live:
+            live[rec["id"]] += len(line)
+        else:
+            self._garbage[guild_id] += len(line)
+
+    def _load(self, guild_id) -> dict:
+        orders = self._orders.get(guild_id)
+        if orders is not None:
+            return orders
+        orders = {}
+        sizes = {}
+        garbage = 0
+        path = self._log_path(guild_id)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            good = data.rfind(b"\n") + 1
+            if good < len(data):
+                # 書き込み途中で落ちた最終行は捨てる（続けて追記すると次の記録まで壊れるため）
+                with open(path, "r+b") as f:
+                    f.truncate(good)
+            for raw in data[:good].splitlines(keepends=True):
+                try:
+                    rec = json.loads(raw)
+                except ValueError:
+                    garbage += len(raw)
+                    continue
+                order = orders.get(rec.get("id"))
+                if rec.get("op") == "put":
+                    order = orders[rec["id"]] = rec["order"]
+                elif order is None:
+                    garbage += len(raw)
+                    continue
+                elif rec["op"] == "step":
+                    order["done"].append(rec["step"])
+                elif rec["op"] == "attempt":
+                    order["attempts"] = rec["attempts"]
+                    order["last_error"] = rec.get("error")
+                elif rec["op"] == "finish":
+                    order["status"] = rec["status"]
+                elif rec["op"] == "reopen":
+                    order["status"] = "pending"
+                    order["attempts"] = 0
+                sizes[rec["id"]] = sizes.get(rec["id"], 0) + len(raw)
+        self._orders[guild_id] = {order_id: o for order_id, o in orders.items() if o["status"] not in self.CLOSED}
+        self._live[guild_id] = {order_id: sizes[order_id] for order_id in self._orders[guild_id]}
+        self._garbage[guild_id] = garbage + sum(size for order_id, size in sizes.items() if order_id not in self._orders[guild_id])
+        return self._orders[guild_id]
+
+    def _maybe_compact(self, guild_id):
+        garbage = self._garbage[guild_id]
+        if garbage > self.COMPACT_BYTES and garbage > sum(self._live[guild_id].values()):
+            self._compact(guild_id)
+
+    def _compact(self, guild_id):
+        lines = {o["id"]: json.dumps({"op": "put", "id": o["id"], "order": o}, ensure_ascii=False) + "\n" for o in self._load(guild_id).values()}
+        _write_atomic(self._log_path(guild_id), "".join(lines.values()))
+        self._live[guild_id] = {order_id: len(line.encode("utf-8")) for order_id, line in lines.items()}
+        self._garbage[guild_id] = 0
+
+    def enqueue(self, guild_id, order: dict, status: str = "pending") -> dict:
+        order = dict(order, id=uuid.uuid4().hex, guild_id=guild_id, created_at=time.time(), status=status, attempts=0, done=[])
+        self._load(guild_id)[order["id"]] = order
+        self._live[guild_id][order["id"]] = 0
+        self._append(guild_id, {"op": "put", "id": order["id"], "order": order})
+        return order
+
+    def get(self, guild_id, order_id):
+        return self._load(guild_id).get(order_id)
+
+    def complete_step(self, guild_id, order_id, step: str):
+        order = self._load(guild_id)[order_id]
+        if step not in order["done"]:
+            order["done"].append(step)
+            # DM の送信記録だけは失うと二重送信になるので fsync する
+            self._append(guild_id, {"op": "step", "id": order_id, "step": step}, sync=step.startswith("dm"))
+
+    def record_attempt(self, guild_id, order_id, error: str) -> int:
+        order = self._load(guild_id)[order_id]
+        order["attempts"] += 1
+        order["last_error"] = error
+        self._append(guild_id, {"op": "attempt", "id": order_id, "attempts": order["attempts"], "error": error})
+        return order["attempts"]
+
+    def finish(self, guild_id, order_id, status: str = "done"):
+        orders = self._load(guild_id)
+        orders[order_id]["status"] = status
+        self._append(guild_id, {"op": "finish", "id": order_id, "status": status})
+        if status in self.CLOSED:
+            orders.pop(order_id, None)
+            self._garbage[guild_id] += self._live[guild_id].pop(order_id, 0)
+            self._maybe_compact(guild_id)
+
+    def reopen(self, guild_id, order_id) -> dict:
+        """要確認・失敗の注文を配送待ちに戻す（試行回数も数え直す）"""
+        order = self._load(guild_id)[order_id]
+        order["status"] = "pending"
+        order["attempts"] = 0
+        self._append(guild_id, {"op": "reopen", "id": order_id})
+        return order
+
+    def failed(self, guild_id) -> list:
+        return [o for o in self._load(guild_id).values() if o["status"] == "failed"]
+
+    def needs_review(self, guild_id) -> list:
+        """管理者の対応が必要な注文（要確認・配送失敗）を古い順に返す"""
+        return sorted((o for o in self._load(guild_id).values() if o["status"] in ("review", "failed")), key=lambda o: o["created_at"])
+
+    def load_pending(self, guild_filter=None) -> list:
+        """全ギルド（guild_filter があれば True を返すギルドだけ）の未完了の注文を古い順に返す（起動時の再開用）"""
+        pending = []
+        if os.path.isdir(self.store.base_dir):
+            for name in os.listdir(self.store.base_dir):
+                if guild_filter is not None and name.isdigit() and not guild_filter(int(name)):
+                    continue
+                if name.isdigit() and os.path.exists(os.path.join(self.store.base_dir, name, "orders.log")):
+                    pending += [o for o in self._load(int(name)).values() if o["status"] == "pending"]
+        return sorted(pending, key=lambda o: o["created_at"])
+
+
+class SalesLedger:
+    """売上の記録。sales.log に1件1行で追記し、時間別・日別の集計をその都度更新する。
+
+    集計は日毎のファイル（sales/<日の開始時刻>.json）に {"offset", "day", "hour": {時刻: ...}} の形で持ち、
+    "day" と各時間は {"items"|"panels": {ID: [個数, 金額, 件数]}}。state_store の書き戻しに合わせて、
+    変わった日のファイルだけを改行・インデントなしで書き、最後に反映済みのログの位置（sales/offset.json）を書く。
+    日のファイルにもその日に反映したログの位置を持たせるので、書き戻しの途中で落ちても、
+    次回の読み込み時に残りのログから二重に数えずに追いつける。
+    """
+
+    def __init__(self, store: GuildStateStore, tz_offset: float = 9 * 3600, hourly_retention: float = 90 * 86400):
+        self.store = store
+        self.tz_offset = tz_offset  # 日の区切り（既定は日本時間の0時）
+        self.hourly_retention = hourly_retention
+        self._days = {}     # guild_id -> {日: 集計}（読み込んだ日だけ）
+        self._known = {}    # guild_id -> ファイルがある（または作った）日の set
+        self._offsets = {}  # guild_id -> 集計に反映済みの sales.log の位置
+        self._pruned = {}   # guild_id -> この日より前は時間別の集計を消し終えている
+        self._dirty = {}    # guild_id -> 書き戻しが必要な日の set
+        store.add_writer(self._take_dirty)
+
+    def _dir(self, guild_id):
+        directory = self.store.path(guild_id, "sales")
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def _day_path(self, guild_id, day):
+        return os.path.join(self._dir(guild_id), f"{day}.json")
+
+    def hour_bucket(self, ts: float) -> int:
+        return int(ts // 3600 * 3600)
+
+    def day_bucket(self, ts: float) -> int:
+        return int((ts + self.tz_offset) // 86400 * 86400 - self.tz_offset)
+
+    @staticmethod
+    def _cells() -> dict:
+        return {"items": {}, "panels": {}}
+
+    def _day(self, guild_id, day: int, create: bool = False):
+        days = self._days[guild_id]
+        data = days.get(day)
+        if data is None and day in self._known[guild_id]:
+            data = days[day] = _read_json(self._day_path(guild_id, day)) or None
+        if data is None and create:
+            data = days[day] = {"offset": 0, "day": self._cells(), "hour": {}}
+            self._known[guild_id].add(day)
+            self._prune_hours(guild_id)
+        return data
+
+    def _load(self, guild_id):
+        if guild_id in self._offsets:
+            return
+        directory = self._dir(guild_id)
+        self._days[guild_id] = {}
+        self._known[guild_id] = {int(name[:-5]) for name in os.listdir(directory) if name.endswith(".json") and name[:-5].lstrip("-").isdigit()}
+        self._dirty[guild_id] = set()
+        self._pruned[guild_id] = min(self._known[guild_id], default=0)
+        offset = _read_json(os.path.join(directory, "offset.json")).get("offset", 0)
+        log_path = self.store.path(guild_id, "sales.log")
+        size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        if size < offset:
+            # ログが消された・差し替えられた場合は最初から集計し直す
+            for day in self._known[guild_id]:
+                os.remove(self._day_path(guild_id, day))
+            self._known[guild_id] = set()
+            offset = 0
+        legacy = self.store.path(guild_id, "sales_rollup.json")
+        if os.path.exists(legacy):
+            os.remove(legacy)  # 旧形式の集計（ログから作り直せる）
+        if size > offset:
+            with open(log_path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+            for line in data[:data.rfind(b"\n") + 1].splitlines(keepends=True):
+                offset += len(line)
+                try:
+                    self._apply(guild_id, json.loads(line), offset)
+                except (ValueError, TypeError, IndexError):
+                    continue
+        self._offsets[guild_id] = offset
+
+    def _apply(self, guild_id, rec: list, end: int):
+        """sales.log の1件（ログ上の終わりの位置が end）を集計に加える。その日に反映済みなら何もしない"""
+        ts, item_id, panel_id, count, total_price = rec[:5]
+        day = self.day_bucket(ts)
+        data = self._day(guild_id, day, create=True)
+        if data["offset"] >= end:
+            return
+        targets = [data["day"]]
+        hour = self.hour_bucket(ts)
+        if hour >= time.time() - self.hourly_retention:
+            targets.append(data["hour"].setdefault(str(hour), self._cells()))
+        for cells in targets:
+            for group, group_id in (("items", item_id), ("panels", panel_id)):
+                cell = cells[group].setdefault(str(group_id), [0, 0, 0])
+                cell[0] += count
+                cell[1] += total_price
+                cell[2] += 1
+        data["offset"] = end
+        self._dirty[guild_id].add(day)
+
+    def _prune_hours(self, guild_id):
+        """保持期間を過ぎた日の時間別集計を消す（前回消し終えた日より後の日だけを見る）"""
+        cutoff = self.day_bucket(time.time() - self.hourly_retention)
+        if cutoff <= self._pruned[guild_id]:
+            return
+        for day in [d for d in self._known[guild_id] if self._pruned[guild_id] <= d < cutoff]:
+            data = self._day(guild_id, day)
+            if data and data["hour"]:
+                data["hour"] = {}
+                self._dirty[guild_id].add(day)
+        self._pruned[guild_id] = cutoff
+
+    def _take_dirty(self):
+        jobs = []
+        for guild_id, days in self._dirty.items():
+            if not days:
+                continue
+            self._dirty[guild_id] = set()
+            texts = [(self._day_path(guild_id, day), json.dumps(self._days[guild_id][day], ensure_ascii=False, separators=(",", ":"))) for day in days]
+            # 反映済みの位置は、日のファイルを書き終えてから書く
+            offset_path = os.path.join(self._dir(guild_id), "offset.json")
+            texts.append((offset_path, json.dumps({"offset": self._offsets[guild_id]})))
+            jobs.append((offset_path, (guild_id, days, texts), self._write_days))
+        return jobs
+
+    def _write_days(self, path, job):
+        guild_id, days, texts = job
+        try:
+            for day_path, text in texts:
+                _write_atomic(day_path, text)
+        except Exception:
+            self._dirty[guild_id].update(days)  # 次の書き戻しでやり直す
+            raise
+
+    def record(self, guild_id, item_id, panel_id, count: int, total_price: int, buyer_id: int, ts: float = None):
+        self._load(guild_id)
+        rec = [ts or time.time(), item_id, panel_id, count, total_price, buyer_id]
+        with open(self.store.path(guild_id, "sales.log"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            offset = f.tell()
+        self._apply(guild_id, rec, offset)
+        self._offsets[guild_id] = offset
+
+    def query(self, guild_id, start: float, end: float, group: str = "panels") -> dict:
+        """[start, end) の売上を {ID: [個数, 金額, 件数]} で返す。丸1日分は日別、端は時間別の集計を使う"""
+        self._load(guild_id)
+        result = {}
+
+        def add(cells):
+            if not cells:
+                return
+            for group_id, (count, revenue, orders) in cells[group].items():
+                cell = result.setdefault(group_id, [0, 0, 0])
+                cell[0] += count
+                cell[1] += revenue
+                cell[2] += orders
+
+        known = self._known[guild_id]
+        if not known:
+            return result
+        t = self.hour_bucket(max(start, min(known)))
+        while t < end:
+            day = self.day_bucket(t)
+            data = self._day(guild_id, day) if day in known else None
+            if day == t and t + 86400 <= end:
+                add(data and data["day"])
+                t += 86400
+            else:
+                add(data and data["hour"].get(str(t)))
+                t += 3600
+        return result
@@ -0,0 +1,38 @@
+from account_import import detect_delimiter, parse_account_line, parse_account_lines
+
+
+def parse(text):
+    return [account for _, account in parse_account_lines(text.splitlines(keepends=True))]
+
+
+def test_colon_password_may_contain_comma_and_tab():
+    assert parse("a@b.com:pa,ss\n") == [{"email": "a@b.com", "password": "pa,ss"}]
+    assert parse("a@b.com:p\tq\n") == [{"email": "a@b.com", "password": "p\tq"}]
+    assert parse("a@b.com:x:y\n") == [{"email": "a@b.com", "password": "x:y"}]
+
+
+def test_delimiter_is_decided_once_per_file():
+    # 1行目で email:password と決まったら、区切りの違う行は不正行になる
+    assert parse("a@b.com:pw\nc@d.com,pw\n") == [{"email": "a@b.com", "password": "pw"}, None]
+    assert parse("a@b.com,pw\nc@d.com:pw\n") == [{"email": "a@b.com", "password": "pw"}, None]
+
+
+def test_csv_and_tsv_lines_must_have_exactly_two_fields():
+    assert parse("email,password\na@b.com,pa,ss\n") == [None]
+    assert parse('email,password\na@b.com,"pa,ss"\n') == [{"email": "a@b.com", "password": "pa,ss"}]
+    assert parse("a@b.com\tp\tq\n") == [None]
+    assert parse("a@b.com\tpw\n") == [{"email": "a@b.com", "password": "pw"}]
+
+
+def test_ambiguous_email_is_rejected():
+    assert parse_account_line("a@b.com:pa,ss", ",") is None
+    assert parse_account_line("a@b.com:p\tq", "\t") is None
+    assert parse_account_line("nobody:pw", ":") is None
+    assert parse_account_line("a@b.com:", ":") is None
+
+
+def test_header_and_blank_lines_are_skipped():
+    assert parse("email\tpassword\n\na@b.com\tpw\n\n") == [{"email": "a@b.com", "password": "pw"}]
+    assert detect_delimiter("email,password") == ","
+    assert detect_delimiter("a@b.com:pa,ss") == ":"
+    assert detect_delimiter("hello") is None
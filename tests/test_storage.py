@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import time
+
+from storage import AccountQueue, GuildStateStore, JsonItemBackend, OrderQueue, SalesLedger, SqliteItemBackend
+
+
+def snapshot_files(directory):
+    digests = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                digests[os.path.relpath(path, directory)] = hashlib.sha256(f.read()).hexdigest()
+    return digests
+
+
+def test_migrate_from_json_leaves_legacy_files_untouched(tmp_path):
+    base = str(tmp_path / "data")
+    store = GuildStateStore(base)
+    backend = JsonItemBackend(store)
+    backend.put_item(1, "p_1", {"panel_id": "p", "name": "queue", "price": 100, "stock": 0, "kind": "account"})
+    backend.add_accounts(1, "p_1", [{"email": f"{n}@example.com", "password": "pw"} for n in range(5)])
+    assert len(backend.consume(1, "p_1", 2)) == 2
+    backend.put_item(1, "p_2", {"panel_id": "p", "name": "stock", "price": 50, "stock": 7})
+    store.flush()
+    # items.json に accounts のリストを持つ旧々形式の商品（ジャーナルの末尾は書きかけ）
+    os.makedirs(os.path.join(base, "2"))
+    with open(os.path.join(base, "2", "items.json"), "w", encoding="utf-8") as f:
+        json.dump({"p_1": {"panel_id": "p", "name": "old", "price": 1, "stock": 2,
+                           "accounts": [{"email": "a@example.com", "password": "pw"}, {"email": "b@example.com", "password": "pw"}]}}, f)
+    with open(os.path.join(base, "2", "items.json.journal"), "w", encoding="utf-8") as f:
+        f.write('{"op":"pop","id":"p_1","n":1}\n{"op":"del","id"')
+    before = snapshot_files(base)
+
+    sqlite = SqliteItemBackend(str(tmp_path / "store.sqlite3"))
+    assert sqlite.migrate_from_json(base) == 2
+    assert snapshot_files(base) == before
+    assert [acc["email"] for acc in sqlite.account_stock(1, "p_1")] == ["2@example.com", "3@example.com", "4@example.com"]
+    assert sqlite.get_item(1, "p_2")["stock"] == 7
+    assert [acc["email"] for acc in sqlite.account_stock(2, "p_1")] == ["b@example.com"]
+    assert sqlite.migrate_from_json(base) == 0
+
+
+# ------------------------
+# 落ちた後の復旧（ジャーナル / スナップショット / アカウント在庫 / 注文ログ）
+# ------------------------
+def write_text(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def read_text(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def test_torn_journal_tail_is_dropped_and_truncated(tmp_path):
+    store = GuildStateStore(str(tmp_path))
+    path = store.path(1, "items.json")
+    store.load(path)["a"] = {"name": "a"}
+    store.record(path, {"op": "put", "id": "a", "item": {"name": "a"}})
+    store.flush()
+    with open(path + ".journal", "a", encoding="utf-8") as f:
+        f.write('{"op":"put","id":"b","item":{"na')
+
+    recovered = GuildStateStore(str(tmp_path))
+    assert recovered.load(path) == {"a": {"name": "a"}}
+    assert read_text(path + ".journal").endswith("\n")
+    # 切り詰めた後の追記は次の再生でも読める
+    recovered.load(path)["c"] = {"name": "c"}
+    recovered.record(path, {"op": "put", "id": "c", "item": {"name": "c"}})
+    recovered.flush()
+    assert set(GuildStateStore(str(tmp_path)).load(path)) == {"a", "c"}
+
+
+def test_crash_while_writing_snapshot_replays_compacting_journal(tmp_path):
+    store = GuildStateStore(str(tmp_path))
+    path = store.path(1, "items.json")
+    write_text(path, json.dumps({"a": {"stock": 1}}))
+    write_text(path + ".compacting", '{"op":"set","id":"a","fields":{"stock":2}}\n')
+    write_text(path + ".next", '{"a": {"sto')  # 書きかけのスナップショット
+    write_text(path + ".journal", '{"op":"put","id":"b","item":{"stock":5}}\n')
+
+    assert store.load(path) == {"a": {"stock": 2}, "b": {"stock": 5}}
+    assert not os.path.exists(path + ".next")
+    # 次の flush でまとめ直され、退避ジャーナルが消える
+    store.flush()
+    assert not os.path.exists(path + ".compacting")
+    assert GuildStateStore(str(tmp_path)).load(path) == {"a": {"stock": 2}, "b": {"stock": 5}}
+
+
+def test_crash_before_snapshot_replace_uses_next(tmp_path):
+    store = GuildStateStore(str(tmp_path))
+    path = store.path(1, "items.json")
+    write_text(path, json.dumps({"a": {"stock": 1}}))
+    write_text(path + ".next", json.dumps({"a": {"stock": 2}}))  # .compacting は削除済み
+
+    assert store.load(path) == {"a": {"stock": 2}}
+    assert not os.path.exists(path + ".next")
+    assert json.loads(read_text(path)) == {"a": {"stock": 2}}
+
+
+def accounts(*names):
+    return [{"email": f"{n}@example.com", "password": "pw"} for n in names]
+
+
+def test_account_queue_survives_generation_switch_crashes(tmp_path):
+    directory = str(tmp_path / "accounts")
+    queue = AccountQueue(directory, "p_1")
+    queue.push(accounts(1, 2, 3))
+    queue.pop(1)
+
+    # 新しい世代を書き終えたがカーソルを切り替える前に落ちた: 新しい世代は捨てて元の世代を使う
+    write_text(queue._data_path(queue.generation + 1), json.dumps(accounts(9)[0]) + "\n")
+    reopened = AccountQueue(directory, "p_1")
+    assert not os.path.exists(queue._data_path(queue.generation + 1))
+    assert reopened.peek_all() == accounts(2, 3)
+
+    # カーソルを切り替えたが古い世代を消す前に落ちた: 古い世代を消す
+    reopened.reset(accounts(4, 5))
+    write_text(reopened._data_path(reopened.generation - 1), json.dumps(accounts(1)[0]) + "\n")
+    again = AccountQueue(directory, "p_1")
+    assert not os.path.exists(again._data_path(again.generation - 1))
+    assert (again.generation, again.count, again.peek_all()) == (reopened.generation, 2, accounts(4, 5))
+
+
+def test_account_queue_drops_torn_push_and_compacts(tmp_path, monkeypatch):
+    directory = str(tmp_path / "accounts")
+    queue = AccountQueue(directory, "p_1")
+    queue.push(accounts(1, 2))
+    with open(queue._data_path(), "a", encoding="utf-8") as f:
+        f.write('{"email": "3@exa')
+    reopened = AccountQueue(directory, "p_1")
+    assert reopened.count == 2
+    assert reopened.peek_all() == accounts(1, 2)
+
+    monkeypatch.setattr(AccountQueue, "COMPACT_BYTES", 1)
+    reopened.push(accounts(3, 4))
+    assert reopened.pop(3) == accounts(1, 2, 3)
+    assert reopened.generation == 1 and reopened.offset == 0
+    assert sorted(os.listdir(directory)) == ["p_1.1.jsonl", "p_1.cursor"]
+    assert AccountQueue(directory, "p_1").peek_all() == accounts(4)
+
+
+def test_order_log_replay(tmp_path):
+    store = GuildStateStore(str(tmp_path))
+    orders = OrderQueue(store)
+    delivered = orders.enqueue(1, {"item_id": "p_1"})
+    pending = orders.enqueue(1, {"item_id": "p_2"})
+    failed = orders.enqueue(1, {"item_id": "p_3"})
+    orders.complete_step(1, delivered["id"], "dm")
+    orders.finish(1, delivered["id"])
+    orders.complete_step(1, pending["id"], "dm")
+    orders.complete_step(1, pending["id"], "dm")
+    orders.record_attempt(1, pending["id"], "role: missing")
+    orders.record_attempt(1, failed["id"], "dm: closed")
+    orders.finish(1, failed["id"], "failed")
+    with open(store.path(1, "orders.log"), "a", encoding="utf-8") as f:
+        f.write('{"op": "step", "id": "%s", "st' % pending["id"])
+
+    replayed = OrderQueue(store)
+    assert replayed.get(1, delivered["id"]) is None
+    resumed = replayed.load_pending()
+    assert [o["id"] for o in resumed] == [pending["id"]]
+    assert resumed[0]["done"] == ["dm"]
+    assert (resumed[0]["attempts"], resumed[0]["last_error"]) == (1, "role: missing")
+    assert [o["id"] for o in replayed.failed(1)] == [failed["id"]]
+    # 切り詰めた後の追記も読める
+    replayed.complete_step(1, pending["id"], "role")
+    assert OrderQueue(store).get(1, pending["id"])["done"] == ["dm", "role"]
+
+
+def test_order_log_compacts_on_garbage_not_size(tmp_path, monkeypatch):
+    store = GuildStateStore(str(tmp_path))
+    orders = OrderQueue(store)
+    compactions = []
+    compact = OrderQueue._compact
+    monkeypatch.setattr(OrderQueue, "_compact", lambda self, guild_id: (compactions.append(guild_id), compact(self, guild_id)))
+    # 失敗したまま残る大口注文（未完了の記録だけで COMPACT_BYTES を超える）
+    big = orders.enqueue(1, {"item_id": "p_1", "accounts": accounts(*range(5000))})
+    orders.finish(1, big["id"], "failed")
+    size = os.path.getsize(store.path(1, "orders.log"))
+    assert size > OrderQueue.COMPACT_BYTES
+
+    for _ in range(100):
+        order = orders.enqueue(1, {"item_id": "p_2", "accounts": accounts(1)})
+        for step in ("dm", "role", "panel", "log", "pay_log"):
+            orders.complete_step(1, order["id"], step)
+        orders.finish(1, order["id"])
+    assert compactions == []
+
+    # 終了した注文の記録が未完了の注文より大きくなったら1回だけ書き直す
+    while not compactions:
+        order = orders.enqueue(1, {"item_id": "p_2", "accounts": accounts(*range(100))})
+        orders.finish(1, order["id"])
+    assert compactions == [1]
+    assert [o["id"] for o in OrderQueue(store).failed(1)] == [big["id"]]
+    assert os.path.getsize(store.path(1, "orders.log")) < size * 1.1
+
+
+def brute_force_sales(records, start, end, group):
+    result = {}
+    for ts, item_id, panel_id, count, price in records:
+        if start <= ts < end:
+            cell = result.setdefault(str(item_id if group == "items" else panel_id), [0, 0, 0])
+            cell[0] += count
+            cell[1] += price
+            cell[2] += 1
+    return result
+
+
+def test_sales_ledger_rollups_survive_restart_and_partial_flush(tmp_path):
+    now = time.time()
+    store = GuildStateStore(str(tmp_path))
+    ledger = SalesLedger(store)
+    records = [(now - n * 3000, f"p_{n % 3}", f"panel{n % 2}", 1 + n % 4, 100 * (1 + n % 5)) for n in range(300)]
+    for ts, item_id, panel_id, count, price in records[:200]:
+        ledger.record(1, item_id, panel_id, count, price, 42, ts=ts)
+    store.flush()
+    day_files = [name for name in os.listdir(store.path(1, "sales")) if name != "offset.json"]
+    assert day_files and "\n" not in read_text(os.path.join(store.path(1, "sales"), day_files[0]))
+
+    # 日のファイルだけ書けて反映位置を書く前に落ちた状態を作る
+    for ts, item_id, panel_id, count, price in records[200:]:
+        ledger.record(1, item_id, panel_id, count, price, 42, ts=ts)
+    offset_path = os.path.join(store.path(1, "sales"), "offset.json")
+    stale_offset = read_text(offset_path)
+    store.flush()
+    write_text(offset_path, stale_offset)
+
+    start = ledger.day_bucket(now) - 6 * 86400
+    for group in ("items", "panels"):
+        expected = brute_force_sales(records, start, now + 1, group)
+        assert ledger.query(1, start, now + 1, group) == expected
+        assert SalesLedger(GuildStateStore(str(tmp_path))).query(1, start, now + 1, group) == expected
+    # 端が時間単位の範囲は時間別の集計から数える
+    start, end = ledger.hour_bucket(now) - 30 * 3600, ledger.hour_bucket(now) - 5 * 3600
+    assert SalesLedger(GuildStateStore(str(tmp_path))).query(1, start, end, "items") == brute_force_sales(records, start, end, "items")
+
+
+def test_sales_ledger_flush_writes_only_changed_days(tmp_path):
+    store = GuildStateStore(str(tmp_path))
+    ledger = SalesLedger(store)
+    now = time.time()
+    for n in range(90 * 24):
+        ledger.record(1, f"p_{n % 50}", "panel", 1, 100, n, ts=now - n * 3600)
+    store.flush()
+    ledger.record(1, "p_1", "panel", 1, 100, 1, ts=now)
+    jobs = store._take_dirty()
+    assert len(jobs) == 1
+    written = [path for path, _ in jobs[0][1][2]]
+    assert written == [ledger._day_path(1, ledger.day_bucket(now)), os.path.join(store.path(1, "sales"), "offset.json")]
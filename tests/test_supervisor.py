@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+import pytest
+
+discord = pytest.importorskip("discord")
+web = pytest.importorskip("aiohttp.web")
+from discord.ext import commands
+
+USER = {"id": "1", "username": "bot", "discriminator": "0", "global_name": None, "avatar": None, "bot": True}
+APPLICATION = {
+    "id": "1", "name": "bot", "icon": None, "description": "", "bot_public": True, "bot_require_code_grant": False,
+    "verify_key": "", "flags": 0, "owner": USER, "team": None, "summary": "",
+}
+
+
+async def _serve_api():
+    """/users/@me と /oauth2/applications/@me だけを返すローカルの API サーバー"""
+    def route(payload):
+        async def handle(request):
+            # discord.py は Content-Type が application/json ちょうどの時だけ JSON として読む
+            return web.Response(body=json.dumps(payload).encode(), headers={"Content-Type": "application/json"})
+        return handle
+
+    app = web.Application()
+    app.router.add_get("/api/v10/users/@me", route(USER))
+    app.router.add_get("/api/v10/oauth2/applications/@me", route(APPLICATION))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+class Probe(commands.Cog):
+    pass
+
+
+class ProbeView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)
+        self.add_item(discord.ui.Button(label="probe", custom_id="probe:button"))
+
+
+def test_login_after_close_and_clear(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    bot_module = pytest.importorskip("bot")
+
+    async def main():
+        runner, port = await _serve_api()
+        monkeypatch.setattr(discord.http.Route, "BASE", f"http://127.0.0.1:{port}/api/v10")
+        client = commands.Bot(command_prefix="!", intents=discord.Intents.none())
+        monkeypatch.setattr(bot_module, "bot", client)
+        await client.add_cog(Probe())
+        try:
+            await client.login("token")
+            view = ProbeView()
+            client.add_view(view)
+            # supervise() と同じく 切断 → 状態のリセット → 再ログイン を2回繰り返す
+            for _ in range(2):
+                await bot_module.close_connection()
+                bot_module.reset_connection()
+                await client.login("token")
+                assert client.user.id == 1
+            # 再接続では Cog・拡張機能をアンロードしない
+            assert client.get_cog("Probe") is not None
+            # 永続ビュー（再起動後もボタンが反応するよう登録したもの）も残る
+            assert view in client.persistent_views
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(main())